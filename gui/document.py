@@ -399,7 +399,7 @@ class Document (CanvasController):
                     return
             return
         x, y = self.tdw.get_cursor_in_model_coordinates()
-        for layer in reversed(self.model.layers.get_flat_list()):
+        for layer in reversed(self.model.get_layers_at(x, y, 5)):
             if layer.locked:
                 continue
             if not layer.visible:
@@ -489,7 +489,7 @@ class Document (CanvasController):
 
     def pick_layer_cb(self, action):
         x, y = self.tdw.get_cursor_in_model_coordinates()
-        for layer in reversed(self.model.layers.get_flat_list()):
+        for layer in reversed(self.model.get_layers_at(x, y, 5)):
             if layer.locked:
                 continue
             if not layer.visible:
@@ -25,6 +25,7 @@ SAVE_FORMAT_PNGSOLID = 2
 SAVE_FORMAT_PNGTRANS = 3
 SAVE_FORMAT_PNGMULTI = 4
 SAVE_FORMAT_JPEG = 5
+SAVE_FORMAT_DOPEY = 8
 
 # Utility function to work around the fact that gtk FileChooser/FileFilter
 # does not have an easy way to use case insensitive filters
@@ -78,8 +79,9 @@ class FileHandler(object):
         self.set_recent_items()
 
         self.file_filters = [ #(name, patterns)
-        (_("All Recognized Formats"), ("*.ora", "*.png", "*.jpg", "*.jpeg")),
+        (_("All Recognized Formats"), ("*.ora", "*.dopey", "*.png", "*.jpg", "*.jpeg")),
         (_("OpenRaster (*.ora)"), ("*.ora",)),
+        (_("Dopey native (*.dopey)"), ("*.dopey",)),
         (_("PNG (*.png)"), ("*.png",)),
         (_("JPEG (*.jpg; *.jpeg)"), ("*.jpg", "*.jpeg")),
         ]
@@ -92,14 +94,17 @@ class FileHandler(object):
         (_("JPEG 90% quality (*.jpg; *.jpeg)"), '.jpg', {'quality': 90}), #5
         (_("One PNG image for animation frame (*-XXX.png)"), '.png', {'animation': True}), #6
         (_("Animation video (*.avi)"), '.avi', {}), #7
+        (_("Dopey native (*.dopey)"), '.dopey', {}), #8
         ]
         self.ext2saveformat = {
         '.ora': SAVE_FORMAT_ORA, 
+        '.dopey': SAVE_FORMAT_DOPEY,
         '.png': SAVE_FORMAT_PNGSOLID, 
         '.jpeg': SAVE_FORMAT_JPEG, 
         '.jpg': SAVE_FORMAT_JPEG}
         self.config2saveformat = {
         'openraster': SAVE_FORMAT_ORA,
+        'dopey': SAVE_FORMAT_DOPEY,
         'jpeg-90%': SAVE_FORMAT_JPEG,
         'png-solid': SAVE_FORMAT_PNGSOLID,
         }
@@ -378,6 +378,34 @@ class MoveLayer(Action):
         self._notify_canvas_observers([self.layer])
         self._notify_document_observers()
 
+class TransformLayer(Action):
+    display_name = _("Transform Layer")
+    def __init__(self, doc, layer, matrix, filter, snapshot_before=None):
+        """If snapshot_before is given, the layer has already been
+        transformed (interactively), and the first redo only records it."""
+        self.doc = doc
+        self.layer = layer
+        self.matrix = matrix
+        self.filter = filter
+        self.before = snapshot_before
+        self.after = None
+    def redo(self):
+        if self.after is not None:
+            self.layer.load_snapshot(self.after)
+        else:
+            if self.before is None:
+                self.before = self.layer.save_snapshot()
+                self.layer.transform(self.matrix, self.filter)
+            else:
+                self.layer.strokes = []
+            self.after = self.layer.save_snapshot()
+        self._notify_canvas_observers([self.layer])
+        self._notify_document_observers()
+    def undo(self):
+        self.layer.load_snapshot(self.before)
+        self._notify_canvas_observers([self.layer])
+        self._notify_document_observers()
+
 class ReorderSingleLayer(Action):
     display_name = _("Reorder Layer in Stack")
     def __init__(self, doc, layer, new_idx, select_new=False, new_stack=None):
@@ -0,0 +1,664 @@
+/* This file is part of MyPaint.
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+ */
+
+// Vectorised versions of the buffer compositor and the blend modes.
+//
+// These process L pixels at a time, one channel per vector, using the
+// GCC vector extensions. pixops.hpp compiles them for SSE2 (L=4) and for
+// AVX2 (L=8) if PIXOPS_HAVE_SIMD is defined.
+//
+// Every operation mirrors the scalar code in compositing.hpp,
+// blendmodes.hpp and fix15.hpp with the same integer types, including
+// wraparound and the mix of signed and unsigned arithmetic, so the
+// results are bit-exact; branches become selects. (Only invalid
+// premultiplied input can overflow the signed arithmetic of the
+// non-separable modes, which is undefined in the scalar code and wraps
+// here.) Integer divisions are done in double precision, which is exact
+// for 32 bit operands: the quotient never rounds across an integer.
+
+#ifndef __HAVE_COMPOSITING_SIMD
+#define __HAVE_COMPOSITING_SIMD
+
+#include <string.h>
+
+#include "fix15.hpp"
+#include "compositing.hpp"
+#include "blendmodes.hpp"
+
+// The helpers pass vectors around, but are always inlined into the
+// kernels with the target attribute. GCC warns at the end of the file,
+// where the templates are instantiated, so this is not popped.
+#pragma GCC diagnostic ignored "-Wpsabi"
+
+template <int L> struct SimdVec;
+
+template <> struct SimdVec<4> {
+    typedef uint32_t u __attribute__((vector_size(16)));
+    typedef int32_t i __attribute__((vector_size(16)));
+    typedef double d __attribute__((vector_size(32)));
+};
+
+template <> struct SimdVec<8> {
+    typedef uint32_t u __attribute__((vector_size(32)));
+    typedef int32_t i __attribute__((vector_size(32)));
+    typedef double d __attribute__((vector_size(64)));
+};
+
+
+/* Loading and storing L pixels, one channel per vector. A pixel is two
+ * 32 bit words, (c0 | c1<<16) and (c2 | c3<<16). */
+
+template <int L> struct SimdPixels;
+
+template <> struct SimdPixels<4> {
+    typedef SimdVec<4>::u U;
+    typedef SimdVec<4>::i I;
+    static inline PIXOPS_ALWAYS_INLINE void
+    split (const U v0, const U v1, U &lo, U &hi)
+    {
+        lo = __builtin_shuffle(v0, v1, (I){0, 2, 4, 6});
+        hi = __builtin_shuffle(v0, v1, (I){1, 3, 5, 7});
+    }
+    static inline PIXOPS_ALWAYS_INLINE void
+    join (const U lo, const U hi, U &v0, U &v1)
+    {
+        v0 = __builtin_shuffle(lo, hi, (I){0, 4, 1, 5});
+        v1 = __builtin_shuffle(lo, hi, (I){2, 6, 3, 7});
+    }
+};
+
+template <> struct SimdPixels<8> {
+    typedef SimdVec<8>::u U;
+    typedef SimdVec<8>::i I;
+    static inline PIXOPS_ALWAYS_INLINE void
+    split (const U v0, const U v1, U &lo, U &hi)
+    {
+        lo = __builtin_shuffle(v0, v1, (I){0, 2, 4, 6, 8, 10, 12, 14});
+        hi = __builtin_shuffle(v0, v1, (I){1, 3, 5, 7, 9, 11, 13, 15});
+    }
+    static inline PIXOPS_ALWAYS_INLINE void
+    join (const U lo, const U hi, U &v0, U &v1)
+    {
+        v0 = __builtin_shuffle(lo, hi, (I){0, 8, 1, 9, 2, 10, 3, 11});
+        v1 = __builtin_shuffle(lo, hi, (I){4, 12, 5, 13, 6, 14, 7, 15});
+    }
+};
+
+template <int L>
+static inline PIXOPS_ALWAYS_INLINE void
+simd_load_pixels (const fix15_short_t *p,
+                  typename SimdVec<L>::u &c0, typename SimdVec<L>::u &c1,
+                  typename SimdVec<L>::u &c2, typename SimdVec<L>::u &c3)
+{
+    typedef typename SimdVec<L>::u U;
+    U v0, v1, lo, hi;
+    memcpy(&v0, p, sizeof(U));
+    memcpy(&v1, p + 2*L, sizeof(U));
+    SimdPixels<L>::split(v0, v1, lo, hi);
+    c0 = lo & 0xffff;
+    c1 = lo >> 16;
+    c2 = hi & 0xffff;
+    c3 = hi >> 16;
+}
+
+// Stores the low 16 bits of each lane, like assigning to a
+// fix15_short_t does.
+template <int L>
+static inline PIXOPS_ALWAYS_INLINE void
+simd_store_pixels (fix15_short_t *p,
+                   const typename SimdVec<L>::u c0, const typename SimdVec<L>::u c1,
+                   const typename SimdVec<L>::u c2, const typename SimdVec<L>::u c3)
+{
+    typedef typename SimdVec<L>::u U;
+    U v0, v1;
+    SimdPixels<L>::join((c0 & 0xffff) | (c1 << 16), (c2 & 0xffff) | (c3 << 16),
+                        v0, v1);
+    memcpy(p, &v0, sizeof(U));
+    memcpy(p + 2*L, &v1, sizeof(U));
+}
+
+
+/* Helpers. M is a comparison result: all bits set in the lanes where it
+ * holds. */
+
+template <typename V, typename M>
+static inline PIXOPS_ALWAYS_INLINE V
+simd_select (const M m, const V a, const V b)
+{
+    return ((V)m & a) | (~(V)m & b);
+}
+
+template <typename M>
+static inline PIXOPS_ALWAYS_INLINE bool
+simd_none (const M &m)
+{
+    typename SimdVec<sizeof(M)/4>::u bits = (typename SimdVec<sizeof(M)/4>::u)m;
+    uint32_t res = 0;
+    for (unsigned int k=0; k<sizeof(M)/4; k++) {
+        res |= bits[k];
+    }
+    return res == 0;
+}
+
+// Truncating division, like the C operator on V's element type. Lanes
+// dividing by zero give garbage instead of trapping; their results must
+// be discarded.
+template <typename V>
+static inline PIXOPS_ALWAYS_INLINE V
+simd_div (const V n, V d)
+{
+    typedef typename SimdVec<sizeof(V)/4>::d D;
+    d -= (V)(d == 0); // 0 -> 1
+    const D q = __builtin_convertvector(n, D) / __builtin_convertvector(d, D);
+    return __builtin_convertvector(q, V);
+}
+
+// A divisor below 2**16 for several numerators below 2**16 << 15, which
+// the compositor needs to undo the premultiplication. The product with
+// the rounded reciprocal is off by less than 2**-20, so its truncation
+// is either the quotient or, for exact quotients, one less.
+template <typename U>
+struct SimdShortDivisor
+{
+    typedef typename SimdVec<sizeof(U)/4>::i I;
+    typedef typename SimdVec<sizeof(U)/4>::d D;
+    U d;
+    D r;
+
+    inline PIXOPS_ALWAYS_INLINE SimdShortDivisor (U d_)
+    {
+        d = d_ - (U)(d_ == 0);
+        r = 1.0 / __builtin_convertvector((I)d, D);
+    }
+
+    inline PIXOPS_ALWAYS_INLINE U
+    fix15_div (const U a) const
+    {
+        const U n = a << _fix15_fracbits;
+        U q = (U)__builtin_convertvector(__builtin_convertvector((I)n, D) * r, I);
+        q -= (U)(n - q*d >= d);
+        return q;
+    }
+};
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_fix15_mul (const U a, const U b)
+{
+    return (a * b) >> _fix15_fracbits;
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_fix15_div (const U a, const U b)
+{
+    return simd_div<U>(a << _fix15_fracbits, b);
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_fix15_short_clamp (const U n)
+{
+    return simd_select(n > fix15_one, (U){} + fix15_one, n);
+}
+
+// fix15_sqrt() of 0..fix15_one, filled in by simd_init()
+static uint16_t simd_fix15_sqrt_table[fix15_one + 1];
+
+static void
+simd_init ()
+{
+    for (fix15_t x = 0; x <= fix15_one; x++) {
+        simd_fix15_sqrt_table[x] = fix15_sqrt(x);
+    }
+}
+
+// fix15_sqrt() beyond fix15_one (invalid input only): the same
+// Babylonian iterations, until every lane has stopped where the scalar
+// loop would break.
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_fix15_sqrt_big (const U x)
+{
+    const U s = x << 1;
+    const int fracbits = _fix15_fracbits + 1;
+    U n = x;
+    U done = (U){};
+    for (int i = 0; i < 15 && !simd_none(~done); ++i) {
+        const U n_old = n;
+        const U n_new = (n + simd_div<U>(s << fracbits, n)) >> 1;
+        n = simd_select(done, n, n_new);
+        done |= (U)((n == n_old)
+                    | ((n > n_old) & (n-1 == n_old))
+                    | ((n < n_old) & (n+1 == n_old)));
+    }
+    return n >> 1;
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_fix15_sqrt (const U x)
+{
+    const int lanes = sizeof(U)/4;
+    const U big = (U)(x > fix15_one);
+    const U idx = simd_select(big, (U){}, x);
+    U res;
+    for (int k=0; k<lanes; k++) {
+        res[k] = simd_fix15_sqrt_table[idx[k]];
+    }
+    if (!simd_none(big)) {
+        res = simd_select(big, simd_fix15_sqrt_big(x), res);
+    }
+    return res;
+}
+
+
+/* Separable blend modes, see blendmodes.hpp */
+
+template <typename B> struct SimdBlend;
+
+#define SIMD_BLEND_SEPARABLE(MODE) \
+template <> struct SimdBlend<MODE> \
+{ \
+    template <typename U> \
+    static inline PIXOPS_ALWAYS_INLINE void process_channel(const U Cs, U &Cb); \
+    template <typename U> \
+    static inline PIXOPS_ALWAYS_INLINE void apply \
+        (const U src_r, const U src_g, const U src_b, \
+         U &dst_r, U &dst_g, U &dst_b) \
+    { \
+        process_channel(src_r, dst_r); \
+        process_channel(src_g, dst_g); \
+        process_channel(src_b, dst_b); \
+    } \
+}; \
+template <typename U> \
+inline void SimdBlend<MODE>::process_channel(const U Cs, U &Cb)
+
+SIMD_BLEND_SEPARABLE(NormalBlendMode)
+{
+    Cb = Cs;
+}
+
+SIMD_BLEND_SEPARABLE(MultiplyBlendMode)
+{
+    Cb = simd_fix15_mul(Cs, Cb);
+}
+
+SIMD_BLEND_SEPARABLE(ScreenBlendMode)
+{
+    Cb = Cb + Cs - simd_fix15_mul(Cb, Cs);
+}
+
+SIMD_BLEND_SEPARABLE(OverlayBlendMode)
+{
+    const U two_Cb = Cb << 1;
+    const U tmp = two_Cb - fix15_one;
+    Cb = simd_select(two_Cb <= fix15_one,
+                     simd_fix15_mul(Cs, two_Cb),
+                     Cs + tmp - simd_fix15_mul(Cs, tmp));
+}
+
+SIMD_BLEND_SEPARABLE(DarkenBlendMode)
+{
+    Cb = simd_select(Cs < Cb, Cs, Cb);
+}
+
+SIMD_BLEND_SEPARABLE(LightenBlendMode)
+{
+    Cb = simd_select(Cs > Cb, Cs, Cb);
+}
+
+SIMD_BLEND_SEPARABLE(HardLightBlendMode)
+{
+    const U two_Cs = Cs << 1;
+    const U tmp = two_Cs - fix15_one;
+    Cb = simd_select(two_Cs <= fix15_one,
+                     simd_fix15_mul(Cb, two_Cs),
+                     Cb + tmp - simd_fix15_mul(Cb, tmp));
+}
+
+SIMD_BLEND_SEPARABLE(ColorDodgeBlendMode)
+{
+    const U tmp = simd_fix15_div(Cb, fix15_one - Cs);
+    Cb = simd_select((Cs < fix15_one) & (tmp < fix15_one),
+                     tmp, (U){} + fix15_one);
+}
+
+SIMD_BLEND_SEPARABLE(ColorBurnBlendMode)
+{
+    const U tmp = simd_fix15_div(fix15_one - Cb, Cs);
+    Cb = simd_select((Cs > 0) & (tmp < fix15_one),
+                     fix15_one - tmp, (U){});
+}
+
+SIMD_BLEND_SEPARABLE(SoftLightBlendMode)
+{
+    const U two_Cs = Cs << 1;
+    const U low = (U)(two_Cs <= fix15_one);
+    U B = fix15_one - simd_fix15_mul(fix15_one - two_Cs, fix15_one - Cb);
+    B = simd_fix15_mul(B, Cb);
+    if (!simd_none(~low)) {
+        const U four_Cb = Cb << 2;
+        const U Cb_squared = simd_fix15_mul(Cb, Cb);
+        U D = four_Cb;
+        D += 16 * simd_fix15_mul(Cb_squared, Cb);
+        D -= 12 * Cb_squared;
+        const U use_sqrt = ~low & (U)(four_Cb > fix15_one);
+        if (!simd_none(use_sqrt)) {
+            D = simd_select(use_sqrt, simd_fix15_sqrt(Cb), D);
+        }
+        B = simd_select(low, B, Cb + simd_fix15_mul(2*Cs - fix15_one, D - Cb));
+    }
+    Cb = B;
+}
+
+SIMD_BLEND_SEPARABLE(DifferenceBlendMode)
+{
+    Cb = simd_select(Cs >= Cb, Cs - Cb, Cb - Cs);
+}
+
+SIMD_BLEND_SEPARABLE(ExclusionBlendMode)
+{
+    Cb = Cb + Cs - (simd_fix15_mul(Cb, Cs) << 1);
+}
+
+#undef SIMD_BLEND_SEPARABLE
+
+
+/* Non-separable blend modes. As in blendmodes.hpp, they work on signed
+ * values (ufix15_t), except that dividing by fix15_one is unsigned. The
+ * lanes are kept unsigned so that overflows (with invalid premultiplied
+ * input only) wrap; comparisons and divisions are signed. */
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE typename SimdVec<sizeof(U)/4>::i
+simd_signed (const U a)
+{
+    return (typename SimdVec<sizeof(U)/4>::i)a;
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_signed_div (const U n, const U d)
+{
+    return (U)simd_div(simd_signed(n), simd_signed(d));
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_nonsep_lum (const U r, const U g, const U b)
+{
+    return (r * BLENDING_LUM_R_COEFF
+            + g * BLENDING_LUM_G_COEFF
+            + b * BLENDING_LUM_B_COEFF) >> _fix15_fracbits;
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_nonsep_min3 (const U r, const U g, const U b)
+{
+    const U min_rb = simd_select(simd_signed(r) < simd_signed(b), r, b);
+    const U min_gb = simd_select(simd_signed(g) < simd_signed(b), g, b);
+    return simd_select(simd_signed(r) < simd_signed(g), min_rb, min_gb);
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_nonsep_max3 (const U r, const U g, const U b)
+{
+    const U max_rb = simd_select(simd_signed(r) > simd_signed(b), r, b);
+    const U max_gb = simd_select(simd_signed(g) > simd_signed(b), g, b);
+    return simd_select(simd_signed(r) > simd_signed(g), max_rb, max_gb);
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE void
+simd_nonsep_clipcolor (U &r, U &g, U &b)
+{
+    const U lum = simd_nonsep_lum(r, g, b);
+    const U cmin = simd_nonsep_min3(r, g, b);
+    const U cmax = simd_nonsep_max3(r, g, b);
+    const U below = (U)(simd_signed(cmin) < 0);
+    if (!simd_none(below)) {
+        const U lum_minus_cmin = lum - cmin;
+        r = simd_select(below, lum + simd_signed_div((r - lum) * lum, lum_minus_cmin), r);
+        g = simd_select(below, lum + simd_signed_div((g - lum) * lum, lum_minus_cmin), g);
+        b = simd_select(below, lum + simd_signed_div((b - lum) * lum, lum_minus_cmin), b);
+    }
+    const U above = (U)(simd_signed(cmax) > (int32_t)fix15_one);
+    if (!simd_none(above)) {
+        const U one_minus_lum = fix15_one - lum;
+        const U cmax_minus_lum = cmax - lum;
+        r = simd_select(above, lum + simd_signed_div((r - lum) * one_minus_lum, cmax_minus_lum), r);
+        g = simd_select(above, lum + simd_signed_div((g - lum) * one_minus_lum, cmax_minus_lum), g);
+        b = simd_select(above, lum + simd_signed_div((b - lum) * one_minus_lum, cmax_minus_lum), b);
+    }
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE void
+simd_nonsep_setlum (U &r, U &g, U &b, const U lum)
+{
+    const U diff = lum - simd_nonsep_lum(r, g, b);
+    r += diff;
+    g += diff;
+    b += diff;
+    simd_nonsep_clipcolor(r, g, b);
+}
+
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE U
+simd_nonsep_sat (const U r, const U g, const U b)
+{
+    return simd_nonsep_max3(r, g, b) - simd_nonsep_min3(r, g, b);
+}
+
+// blending_nonsep_setsat() sorts pointers to the channels; here the
+// values are sorted together with the index of their channel (r=0,
+// g=1, b=2), with the same comparisons, so ties end up the same way.
+template <typename U>
+static inline PIXOPS_ALWAYS_INLINE void
+simd_nonsep_setsat (U &r, U &g, U &b, const U s)
+{
+    U top = b, mid = g, bot = r;
+    U top_c = (U){} + 2, mid_c = (U){} + 1, bot_c = (U){};
+    U m, tmp;
+    m = (U)(simd_signed(top) < simd_signed(mid));
+    tmp = top; top = simd_select(m, mid, top); mid = simd_select(m, tmp, mid);
+    tmp = top_c; top_c = simd_select(m, mid_c, top_c); mid_c = simd_select(m, tmp, mid_c);
+    m = (U)(simd_signed(top) < simd_signed(bot));
+    tmp = top; top = simd_select(m, bot, top); bot = simd_select(m, tmp, bot);
+    tmp = top_c; top_c = simd_select(m, bot_c, top_c); bot_c = simd_select(m, tmp, bot_c);
+    m = (U)(simd_signed(mid) < simd_signed(bot));
+    tmp = mid; mid = simd_select(m, bot, mid); bot = simd_select(m, tmp, bot);
+    tmp = mid_c; mid_c = simd_select(m, bot_c, mid_c); bot_c = simd_select(m, tmp, bot_c);
+
+    const U spread = (U)(simd_signed(top) > simd_signed(bot));
+    const U new_mid = simd_select(spread, simd_signed_div((mid - bot) * s, top - bot), (U){});
+    const U new_top = simd_select(spread, s, (U){});
+    r = simd_select(top_c == 0, new_top, simd_select(mid_c == 0, new_mid, (U){}));
+    g = simd_select(top_c == 1, new_top, simd_select(mid_c == 1, new_mid, (U){}));
+    b = simd_select(top_c == 2, new_top, simd_select(mid_c == 2, new_mid, (U){}));
+}
+
+#define SIMD_BLEND_NONSEPARABLE(MODE) \
+template <> struct SimdBlend<MODE> \
+{ \
+    template <typename U> \
+    static inline PIXOPS_ALWAYS_INLINE void apply \
+        (const U src_r, const U src_g, const U src_b, \
+         U &dst_r, U &dst_g, U &dst_b); \
+}; \
+template <typename U> \
+inline void SimdBlend<MODE>::apply \
+    (const U src_r, const U src_g, const U src_b, \
+     U &dst_r, U &dst_g, U &dst_b)
+
+SIMD_BLEND_NONSEPARABLE(HueBlendMode)
+{
+    const U dst_lum = simd_nonsep_lum(dst_r, dst_g, dst_b);
+    const U dst_sat = simd_nonsep_sat(dst_r, dst_g, dst_b);
+    U r = src_r, g = src_g, b = src_b;
+    simd_nonsep_setsat(r, g, b, dst_sat);
+    simd_nonsep_setlum(r, g, b, dst_lum);
+    dst_r = r;
+    dst_g = g;
+    dst_b = b;
+}
+
+SIMD_BLEND_NONSEPARABLE(SaturationBlendMode)
+{
+    const U dst_lum = simd_nonsep_lum(dst_r, dst_g, dst_b);
+    const U src_sat = simd_nonsep_sat(src_r, src_g, src_b);
+    U r = dst_r, g = dst_g, b = dst_b;
+    simd_nonsep_setsat(r, g, b, src_sat);
+    simd_nonsep_setlum(r, g, b, dst_lum);
+    dst_r = r;
+    dst_g = g;
+    dst_b = b;
+}
+
+SIMD_BLEND_NONSEPARABLE(ColorBlendMode)
+{
+    U r = src_r, g = src_g, b = src_b;
+    simd_nonsep_setlum(r, g, b, simd_nonsep_lum(dst_r, dst_g, dst_b));
+    dst_r = r;
+    dst_g = g;
+    dst_b = b;
+}
+
+SIMD_BLEND_NONSEPARABLE(LuminosityBlendMode)
+{
+    simd_nonsep_setlum(dst_r, dst_g, dst_b, simd_nonsep_lum(src_r, src_g, src_b));
+}
+
+#undef SIMD_BLEND_NONSEPARABLE
+
+
+/* The compositor: BufferComp::composite_src_over(), L pixels at a time */
+
+template <int L, BufferCompOutputType OUTBUFUSAGE,
+          unsigned int BUFSIZE, typename BLENDFUNC>
+static inline PIXOPS_ALWAYS_INLINE void
+simd_composite_src_over (const fix15_short_t * const src,
+                         fix15_short_t * const dst,
+                         const fix15_short_t opac)
+{
+    typedef typename SimdVec<L>::u U;
+    if (opac == 0) {
+        return;
+    }
+    const bool rgba = (OUTBUFUSAGE == BufferCompOutputRGBA);
+    for (unsigned int i=0; i<BUFSIZE; i+=4*L) {
+        U S0, S1, S2, Sa;
+        simd_load_pixels<L>(src + i, S0, S1, S2, Sa);
+        const U a_s = simd_fix15_mul(Sa, (U){} + opac);
+        // Leave the backdrop alone if the source is fully transparent
+        const U skip = (U)(a_s == 0);
+        if (simd_none(~skip)) {
+            continue;
+        }
+        U D0, D1, D2, Da;
+        simd_load_pixels<L>(dst + i, D0, D1, D2, Da);
+        const U src_a0 = simd_fix15_mul((U){} + opac, S0);
+        const U src_a1 = simd_fix15_mul((U){} + opac, S1);
+        const U src_a2 = simd_fix15_mul((U){} + opac, S2);
+        const U a_b = rgba ? Da : (U){} + fix15_one;
+        // De-premultiplied version of dst
+        U tmp0 = D0, tmp1 = D1, tmp2 = D2;
+        if (rgba) {
+            const SimdShortDivisor<U> div_a_b(a_b);
+            tmp0 = div_a_b.fix15_div(D0);
+            tmp1 = div_a_b.fix15_div(D1);
+            tmp2 = div_a_b.fix15_div(D2);
+        }
+        // Combine using the blend function
+        const SimdShortDivisor<U> div_a_s(a_s);
+        SimdBlend<BLENDFUNC>::apply(div_a_s.fix15_div(src_a0),
+                                    div_a_s.fix15_div(src_a1),
+                                    div_a_s.fix15_div(src_a2),
+                                    tmp0, tmp1, tmp2);
+        // Composite the result using src-over
+        const U asab = rgba ? simd_fix15_mul(a_s, a_b) : a_s;
+        const U one_minus_a_s = fix15_one - a_s;
+        U R0 = (one_minus_a_s*D0 + simd_fix15_short_clamp(tmp0)*asab) >> _fix15_fracbits;
+        U R1 = (one_minus_a_s*D1 + simd_fix15_short_clamp(tmp1)*asab) >> _fix15_fracbits;
+        U R2 = (one_minus_a_s*D2 + simd_fix15_short_clamp(tmp2)*asab) >> _fix15_fracbits;
+        U Ra = Da;
+        if (rgba) {
+            // the scalar code adds to the stored 16 bit value
+            const U one_minus_a_b = fix15_one - a_b;
+            R0 = (R0 & 0xffff) + simd_fix15_mul(one_minus_a_b, src_a0);
+            R1 = (R1 & 0xffff) + simd_fix15_mul(one_minus_a_b, src_a1);
+            R2 = (R2 & 0xffff) + simd_fix15_mul(one_minus_a_b, src_a2);
+            Ra = simd_fix15_short_clamp(a_s + a_b - asab);
+            // If the backdrop is empty, the source contributes fully
+            const U empty = (U)(a_b == 0);
+            R0 = simd_select(empty, simd_fix15_short_clamp(src_a0), R0);
+            R1 = simd_select(empty, simd_fix15_short_clamp(src_a1), R1);
+            R2 = simd_select(empty, simd_fix15_short_clamp(src_a2), R2);
+            Ra = simd_select(empty, a_s, Ra);
+        }
+        R0 = simd_select(skip, D0, R0);
+        R1 = simd_select(skip, D1, R1);
+        R2 = simd_select(skip, D2, R2);
+        Ra = simd_select(skip, Da, Ra);
+        simd_store_pixels<L>(dst + i, R0, R1, R2, Ra);
+    }
+}
+
+// The premultiplied fast path for normal mode without destination alpha,
+// see the BufferComp specialization in blendmodes.hpp
+template <int L, unsigned int BUFSIZE>
+static inline PIXOPS_ALWAYS_INLINE void
+simd_composite_src_over_normal_rgbx (const fix15_short_t * const src,
+                                     fix15_short_t * const dst,
+                                     const fix15_short_t opac)
+{
+    typedef typename SimdVec<L>::u U;
+    for (unsigned int i=0; i<BUFSIZE; i+=4*L) {
+        U S0, S1, S2, Sa, D0, D1, D2, Da;
+        simd_load_pixels<L>(src + i, S0, S1, S2, Sa);
+        simd_load_pixels<L>(dst + i, D0, D1, D2, Da);
+        const U one_minus_Sa = fix15_one - simd_fix15_mul(Sa, (U){} + opac);
+        D0 = (S0*opac + one_minus_Sa*D0) >> _fix15_fracbits;
+        D1 = (S1*opac + one_minus_Sa*D1) >> _fix15_fracbits;
+        D2 = (S2*opac + one_minus_Sa*D2) >> _fix15_fracbits;
+        simd_store_pixels<L>(dst + i, D0, D1, D2, Da);
+    }
+}
+
+template <typename B> struct SimdIsNormal { static const bool value = false; };
+template <> struct SimdIsNormal<NormalBlendMode> { static const bool value = true; };
+
+// Same interface and results as tile_composite_data<B> in pixops.hpp
+template <int L, typename B>
+static inline PIXOPS_ALWAYS_INLINE void
+simd_tile_composite_data (const fix15_short_t *src_p,
+                          fix15_short_t *dst_p,
+                          const bool dst_has_alpha,
+                          const float src_opacity)
+{
+    const unsigned int n = MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE*4;
+    const fix15_short_t opac = fix15_short_clamp(src_opacity * fix15_one);
+    if (opac == 0)
+        return;
+
+    if (dst_has_alpha) {
+        simd_composite_src_over<L, BufferCompOutputRGBA, n, B>(src_p, dst_p, opac);
+    }
+    else if (SimdIsNormal<B>::value) {
+        simd_composite_src_over_normal_rgbx<L, n>(src_p, dst_p, opac);
+    }
+    else {
+        simd_composite_src_over<L, BufferCompOutputRGBX, n, B>(src_p, dst_p, opac);
+    }
+}
+
+#endif //__HAVE_COMPOSITING_SIMD
@@ -12,7 +12,11 @@ import zipfile
 import tempfile
 import time
 import traceback
+import weakref
+import functools
 from os.path import join
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool, AsyncResult
 from cStringIO import StringIO
 import xml.etree.ElementTree as ET
 
@@ -32,9 +36,18 @@ import stroke
 import layer
 import brush
 import animation
+import dopeyfile
 
 N = tiledsurface.N
 LOAD_CHUNK_SIZE = 64*1024
+# Number of flattened tiles kept for the layers below the current layer
+# (32 KiB each), and for how many different layer lists.
+COMPOSITE_CACHE_TILES = 2048
+COMPOSITE_CACHE_STACKS = 4
+# Number of layer PNGs encoded at the same time when saving ORA files.
+ORA_SAVE_THREADS = 4
+# Number of layer PNGs decoded at the same time when loading ORA files.
+ORA_LOAD_THREADS = 4
 
 from layer import DEFAULT_COMPOSITE_OP
 from layer import VALID_COMPOSITE_OPS
@@ -84,6 +97,11 @@ class Document():
         self.symmetry_observers = []  #: See `set_symmetry_axis()`
         self.__symmetry_axis = None
         self.default_background = (255, 255, 255)
+        self._composite_cache = _LayerCompositeCache()
+        #: Which layers have data at which tiles, see `LayerTileIndex`.
+        self.tile_index = LayerTileIndex()
+        #: The layer PNGs of the last saved ORA file, see `save_ora()`.
+        self._ora_saved = None
         self.clear(True)
 
         self._frame = [0, 0, 0, 0]
@@ -234,6 +252,12 @@ class Document():
     def record_layer_move(self, layer, dx, dy):
         self.do(command.MoveLayer(self, layer, dx, dy, True))
 
+    def transform_layer(self, layer, matrix, filter=mypaintlib.TransformFilterBilinear):
+        self.do(command.TransformLayer(self, layer, matrix, filter))
+
+    def record_layer_transform(self, layer, matrix, filter, snapshot_before):
+        self.do(command.TransformLayer(self, layer, matrix, filter, snapshot_before))
+
     def move_layer(self, layer, new_idx, select_new=False, new_stack=None):
         self.do(command.ReorderSingleLayer(self, layer, new_idx, select_new))
 
@@ -360,13 +384,26 @@ class Document():
         layers. It disregards the user-chosen frame.
 
         """
-        res = helpers.Rect()
-        for layer in self.layers:
-            # OPTIMIZE: only visible layers...
-            # careful: currently saving assumes that all layers are included
-            bbox = layer.get_bbox()
-            res.expandToIncludeRect(bbox)
-        return res
+        # careful: currently saving assumes that all layers are included
+        layers = self.layers.get_flat_list()
+        self.tile_index.update_layers(layers)
+        return self.tile_index.get_bbox(layers)
+
+    def get_layers_at(self, x, y, radius=0):
+        """Returns the layers which have data near a point, bottom first.
+
+        This is a quick test against the tiles of the layers; the alpha
+        of the pixels is not checked.
+
+        """
+        layers = self.layers.get_flat_list()
+        self.tile_index.update_layers(layers)
+        tx1 = int(numpy.floor(float(x - radius) / N))
+        ty1 = int(numpy.floor(float(y - radius) / N))
+        tx2 = int(numpy.floor(float(x + radius) / N))
+        ty2 = int(numpy.floor(float(y + radius) / N))
+        tiles = [(tx, ty) for tx in xrange(tx1, tx2+1) for ty in xrange(ty1, ty2+1)]
+        return self.tile_index.get_layers_at_tiles(layers, tiles)
 
 
     def get_effective_bbox(self):
@@ -380,19 +417,73 @@ class Document():
 
 
     def render_into(self, surface, tiles, mipmap_level=0, layers=None, background=None):
-
-        # TODO: move this loop down in C/C++
+        # Collect all destination tiles first so that the whole batch
+        # can be composited in C, in parallel.
+        dst_tiles = []
+        requests = []
         for tx, ty in tiles:
-            with surface.tile_request(tx, ty, readonly=False) as dst:
-                self.blit_tile_into(dst, False, tx, ty, mipmap_level, layers, background)
+            request = surface.tile_request(tx, ty, readonly=False)
+            dst = request.__enter__()
+            requests.append(request)
+            dst_tiles.append((tx, ty, dst))
+        if layers is None:
+            layers = self.layers
+        if background is None:
+            background = self.background
+        self.tile_index.update_layers(self.layers.get_flat_list())
+        try:
+            # While painting only the current layer changes, so the
+            # layers below it are composited from a cache.
+            cached = self._composite_cache.blit_tiles_into(
+                dst_tiles, mipmap_level, layers, background, self.layer,
+                self.tile_index)
+            if not cached:
+                self.blit_tiles_into(dst_tiles, False, mipmap_level, layers, background)
+        finally:
+            for request in requests:
+                request.__exit__(None, None, None)
 
     def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0, layers=None, background=None):
+        self.blit_tiles_into([(tx, ty, dst)], dst_has_alpha, mipmap_level, layers, background)
+
+    def blit_tiles_into(self, dst_tiles, dst_has_alpha, mipmap_level=0, layers=None, background=None):
+        """Render the layer stack into a list of (tx, ty, dst) tiles."""
         assert dst_has_alpha is False
         if layers is None:
             layers = self.layers
         if background is None:
             background = self.background
+        index = self.tile_index
+        index.update_layers(self.layers.get_flat_list())
 
+        batch = hasattr(background, 'get_tile_rgba')
+        for layer in layers:
+            batch = batch and hasattr(layer, 'add_composite_ops')
+        if not batch:
+            for tx, ty, dst in dst_tiles:
+                self._blit_tile_into_slow(dst, dst_has_alpha, tx, ty, mipmap_level, layers, background)
+            return
+
+        if mipmap_level > 0:
+            # regenerate the outdated mipmap tiles in one batch per layer
+            positions = [(tx, ty) for tx, ty, dst in dst_tiles]
+            for layer in layers:
+                for l in layer.get_flat_list() if layer.is_stack else [layer]:
+                    if tiledsurface.has_tiledict(l._surface): # not loading
+                        l._surface.update_mipmap_tiles(positions, mipmap_level)
+        jobs = []
+        for tx, ty, dst in dst_tiles:
+            assert dst.shape[-1] == 4
+            bg = background.get_tile_rgba(tx, ty, mipmap_level)
+            ops = []
+            for layer in index.filter_layers(layers, tx, ty, mipmap_level):
+                layer.add_composite_ops(ops, tx, ty, mipmap_level)
+            jobs.append((dst, bg, ops))
+        mypaintlib.tile_composite_stack(jobs)
+
+    def _blit_tile_into_slow(self, dst, dst_has_alpha, tx, ty, mipmap_level, layers, background):
+        # one layer at a time, for layers or backgrounds not based
+        # on MyPaintSurface (e.g. with the GEGL backend)
         assert dst.shape[-1] == 4
         if dst.dtype == 'uint8':
             dst_8bit = dst
@@ -546,6 +637,8 @@ class Document():
         junk, ext = os.path.splitext(filename)
         ext = ext.lower().replace('.', '')
         save = getattr(self, 'save_' + ext, self._unsupported)
+        # lazily loaded tiles may still be reading from the file
+        dopeyfile.unmap_file(filename)
         try:
             save(filename, **kwargs)
         except GObject.GError, e:
@@ -691,9 +784,7 @@ class Document():
     def save_ora(self, filename, options=None, **kwargs):
         print 'save_ora:'
         t0 = time.time()
-        tempdir = tempfile.mkdtemp('mypaint')
-        if not isinstance(tempdir, unicode):
-            tempdir = tempdir.decode(sys.getfilesystemencoding())
+        feedback_cb = kwargs.pop('feedback_cb', None)
         # use .tmp extension, so we don't overwrite a valid file if there is an exception
         z = zipfile.ZipFile(filename + '.tmpsave', 'w', compression=zipfile.ZIP_STORED)
         # work around a permission bug in the zipfile library: http://bugs.python.org/issue3394
@@ -709,27 +800,64 @@ class Document():
         a['w'] = str(w0)
         a['h'] = str(h0)
 
-        def store_pixbuf(pixbuf, name):
-            tmp = join(tempdir, 'tmp.png')
+        # The PNGs are encoded by a pool of threads (the heavy lifting
+        # happens without the GIL) into memory. The zip entries are
+        # written here, in the same order as they are queued. At most
+        # ORA_SAVE_THREADS encoded PNGs are kept waiting for the writer.
+        pool = ThreadPool(ORA_SAVE_THREADS)
+        entries = [] # (name, string, AsyncResult or callable)
+
+        def write_entries(max_pending=0):
+            pending = [data for name, data in entries if isinstance(data, AsyncResult)]
+            while entries and len(pending) > max_pending:
+                name, data = entries.pop(0)
+                if isinstance(data, AsyncResult):
+                    data = _wait_for_result(data, feedback_cb)
+                    pending.pop(0)
+                elif callable(data):
+                    data = data()
+                write_file_str(name, data)
+
+        # Layers which did not change since they were last saved to
+        # this file are copied over from it instead of re-encoded.
+        png_options = tuple(sorted(kwargs.items()))
+        previous_zip, previous_pngs = self._open_previous_ora(filename)
+        saved_pngs = weakref.WeakKeyDictionary()
+
+        def encode_pixbuf(pixbuf, name):
             t1 = time.time()
-            pixbuf.savev(tmp, 'png', [], [])
+            ok, data = pixbuf.save_to_bufferv('png', [], [])
+            assert ok
             print '  %.3fs pixbuf saving %s' % (time.time() - t1, name)
-            z.write(tmp, name)
-            os.remove(tmp)
+            return data
 
-        def store_surface(surface, name, rect=[]):
-            tmp = join(tempdir, 'tmp.png')
+        def encode_surface(surface, name, rect):
             t1 = time.time()
-            surface.save_as_png(tmp, *rect, **kwargs)
+            if isinstance(surface, tiledsurface.MyPaintSurface):
+                buf = StringIO()
+                surface.save_as_png(buf, *rect, **kwargs)
+                data = buf.getvalue()
+            else:
+                # (GEGL) surfaces which can only save to a file
+                tempdir = tempfile.mkdtemp('mypaint')
+                tmp = join(tempdir, 'tmp.png')
+                surface.save_as_png(tmp, *rect, **kwargs)
+                data = open(tmp, 'rb').read()
+                os.remove(tmp)
+                os.rmdir(tempdir)
             print '  %.3fs surface saving %s' % (time.time() - t1, name)
-            z.write(tmp, name)
-            os.remove(tmp)
+            return data
+
+        def store_surface(surface, name, rect=[]):
+            entries.append((name, pool.apply_async(encode_surface, (surface, name, rect))))
+            write_entries(ORA_SAVE_THREADS)
 
         def add_layer(x, y, opac, surface, name, layer_name, visible=True,
                       locked=False, selected=False,
                       compositeop=DEFAULT_COMPOSITE_OP, rect=[]):
             layer = ET.Element('layer')
-            store_surface(surface, name, rect)
+            if surface is not None:
+                store_surface(surface, name, rect)
             a = layer.attrib
             if layer_name:
                 a['name'] = layer_name
@@ -754,6 +882,14 @@ class Document():
             for l in reversed(doc_stack):
                 if l.is_stack:
                     new_file_stack = ET.SubElement(file_stack, 'stack')
+                    a = new_file_stack.attrib
+                    if l.name:
+                        a['name'] = l.name
+                    a['opacity'] = str(l.opacity)
+                    a['composite-op'] = l.compositeop
+                    a['isolation'] = 'isolate'
+                    if not l.visible:
+                        a['visibility'] = 'hidden'
                     idx = add_stack_recursive(new_file_stack, l, idx)
                 else:
                     if l.is_empty():
@@ -761,8 +897,17 @@ class Document():
                     opac = l.opacity
                     x, y, w, h = l.get_bbox()
                     sel = (l == self.layer)
-                    el = add_layer(x-x0, y-y0, opac, l._surface,
-                                   'data/layer%03d.png' % idx, l.name, l.visible,
+                    name = 'data/layer%03d.png' % idx
+                    key = (l.content_generation, (x, y, w, h), png_options)
+                    previous = previous_pngs.get(l)
+                    if previous and previous[0] == key:
+                        entries.append((name, functools.partial(previous_zip.read, previous[1])))
+                        surface = None
+                    else:
+                        surface = l._surface
+                    saved_pngs[l] = (key, name)
+                    el = add_layer(x-x0, y-y0, opac, surface,
+                                   name, l.name, l.visible,
                                    locked=l.locked, selected=sel,
                                    compositeop=l.compositeop, rect=(x, y, w, h))
                     file_stack.append(el)
@@ -772,65 +917,97 @@ class Document():
                     l.save_strokemap_to_file(sio, -x, -y)
                     data = sio.getvalue(); sio.close()
                     name = 'data/layer%03d_strokemap.dat' % idx
-                    el.attrib['mypaint_strokemap_v2'] = name
-                    write_file_str(name, data)
+                    el.attrib['mypaint_strokemap_v3'] = name
+                    entries.append((name, data))
                     idx += 1
             return idx
 
-        add_stack_recursive(stack, self.layers)
-
-        ani_data = self.ani.xsheet_as_str()
-        write_file_str('animation.xsheet', ani_data)
-
-        # save background as layer (solid color or tiled)
-        bg = self.background
-        # save as fully rendered layer
-        x, y, w, h = self.get_bbox()
-        l = add_layer(x-x0, y-y0, 1.0, bg, 'data/background.png', 'background',
-                      locked=True, selected=False,
-                      compositeop=DEFAULT_COMPOSITE_OP,
-                      rect=(x,y,w,h))
-        stack.append(l)
-        x, y, w, h = bg.get_bbox()
-        # save as single pattern (with corrected origin)
-        store_surface(bg, 'data/background_tile.png', rect=(x+x0, y+y0, w, h))
-        l.attrib['background_tile'] = 'data/background_tile.png'
-
-        # preview (256x256)
-        t2 = time.time()
-        print '  starting to render full image for thumbnail...'
-
-        thumbnail_pixbuf = self.render_thumbnail()
-        store_pixbuf(thumbnail_pixbuf, 'Thumbnails/thumbnail.png')
-        print '  total %.3fs spent on thumbnail' % (time.time() - t2)
+        try:
+            add_stack_recursive(stack, self.layers)
+
+            ani_data = self.ani.xsheet_as_str()
+            entries.append(('animation.xsheet', ani_data))
+
+            # save background as layer (solid color or tiled)
+            bg = self.background
+            # save as fully rendered layer
+            x, y, w, h = self.get_bbox()
+            l = add_layer(x-x0, y-y0, 1.0, bg, 'data/background.png', 'background',
+                          locked=True, selected=False,
+                          compositeop=DEFAULT_COMPOSITE_OP,
+                          rect=(x,y,w,h))
+            stack.append(l)
+            x, y, w, h = bg.get_bbox()
+            # save as single pattern (with corrected origin)
+            store_surface(bg, 'data/background_tile.png', rect=(x+x0, y+y0, w, h))
+            l.attrib['background_tile'] = 'data/background_tile.png'
+
+            # preview (256x256), rendered from a mipmap level here
+            # because rendering reads the document; only encoded in the pool
+            t2 = time.time()
+            thumbnail_pixbuf = self.render_thumbnail()
+            print '  total %.3fs spent on thumbnail' % (time.time() - t2)
+            name = 'Thumbnails/thumbnail.png'
+            entries.append((name, pool.apply_async(encode_pixbuf, (thumbnail_pixbuf, name))))
+
+            write_entries()
+        finally:
+            pool.close()
+            pool.join()
+            if previous_zip:
+                previous_zip.close()
 
         helpers.indent_etree(image)
         xml = ET.tostring(image, encoding='UTF-8')
 
         write_file_str('stack.xml', xml)
         z.close()
-        os.rmdir(tempdir)
         if os.path.exists(filename):
             os.remove(filename) # windows needs that
         os.rename(filename + '.tmpsave', filename)
+        st = os.stat(filename)
+        self._ora_saved = (os.path.abspath(filename), st.st_mtime, st.st_size, saved_pngs)
 
         print '%.3fs save_ora total' % (time.time() - t0)
 
         return thumbnail_pixbuf
 
+    def _open_previous_ora(self, filename):
+        """Open the ORA file last saved by save_ora(), if it is still there.
+
+        Returns the opened ZipFile and a dict mapping layers to their
+        (key, zip entry name) as saved, or (None, {}) if the file was
+        saved to a different location or changed in the meantime.
+        """
+        if self._ora_saved is None:
+            return None, {}
+        path, mtime, size, pngs = self._ora_saved
+        if path != os.path.abspath(filename):
+            return None, {}
+        try:
+            st = os.stat(filename)
+            if (st.st_mtime, st.st_size) != (mtime, size):
+                return None, {}
+            return zipfile.ZipFile(filename), pngs
+        except (OSError, IOError, zipfile.BadZipfile), e:
+            print 'Not reusing layers of the previous ORA file:', e
+            return None, {}
+
     @staticmethod
     def __xsd2bool(v):
         v = str(v).lower()
         if v in ['true', '1']: return True
         else: return False
 
-    def load_ora(self, filename, feedback_cb=None):
-        """Loads from an OpenRaster file"""
+    def load_ora(self, filename, feedback_cb=None, lazy=False):
+        """Loads from an OpenRaster file
+
+        The layer PNGs are decoded straight from the zip file by a pool
+        of threads. With lazy=True, each layer is only decoded when its
+        tiles are first needed, usually when it is first rendered.
+        """
         print 'load_ora:'
         t0 = time.time()
-        tempdir = tempfile.mkdtemp('mypaint')
-        if not isinstance(tempdir, unicode):
-            tempdir = tempdir.decode(sys.getfilesystemencoding())
         z = zipfile.ZipFile(filename)
         print 'mimetype:', z.read('mimetype').strip()
         xml = z.read('stack.xml')
@@ -840,24 +1017,62 @@ class Document():
         w = int(image.attrib['w'])
         h = int(image.attrib['h'])
 
-        def get_pixbuf(filename):
-            t1 = time.time()
-
+        def open_file(filename):
             try:
-                fp = z.open(filename, mode='r')
+                return z.open(filename, mode='r')
             except KeyError:
                 # support for bad zip files (saved by old versions of the GIMP ORA plugin)
-                fp = z.open(filename.encode('utf-8'), mode='r')
                 print 'WARNING: bad OpenRaster ZIP file. There is an utf-8 encoded filename that does not have the utf-8 flag set:', repr(filename)
+                return z.open(filename.encode('utf-8'), mode='r')
 
+        def get_pixbuf(filename):
+            t1 = time.time()
+            fp = open_file(filename)
             res = self._pixbuf_from_stream(fp, feedback_cb)
             fp.close()
             print '  %.3fs loading %s' % (time.time() - t1, filename)
             return res
-        
+
+        def read_file(filename):
+            fp = open_file(filename)
+            data = fp.read()
+            fp.close()
+            return data
+
+        def decode_png(data, x, y):
+            surface = tiledsurface.Surface()
+            surface.load_from_png_data(data, x, y)
+            return surface
+
+        # The layer PNGs are decoded by a pool of threads while the
+        # layers are added one by one below. At most ORA_LOAD_THREADS of
+        # them are read and queued ahead of the layer being added. The
+        # zip file is only read from this thread.
+        pool = ThreadPool(ORA_LOAD_THREADS)
+        layer_pngs = [] # (layer element, x, y), in the order of loading
+        decoded = {} # layer element -> AsyncResult
+
+        def find_layer_pngs(element, x=0, y=0):
+            x += int(element.attrib.get('x', 0))
+            y += int(element.attrib.get('y', 0))
+            if element.tag == 'layer':
+                src = element.attrib.get('src', '')
+                if 'background_tile' in element.attrib or not src.lower().endswith('.png'):
+                    return
+                layer_pngs.append((element, x, y))
+            elif element.tag == 'stack':
+                for sub_element in element:
+                    find_layer_pngs(sub_element, x, y)
+
+        def queue_layer_pngs():
+            while layer_pngs and len(decoded) < ORA_LOAD_THREADS:
+                element, x, y = layer_pngs.pop(0)
+                args = (read_file(element.attrib['src']), x, y)
+                decoded[element] = pool.apply_async(decode_png, args)
+
         self.clear() # this leaves one empty layer
         self.set_frame(width=w, height=h)
-        
+
         # returns selected layer
         def load_layer(element, stack, x=0,y=0):
             if 'x' in element.attrib:
@@ -891,16 +1106,21 @@ class Document():
                 visible = not 'hidden' in a.get('visibility', 'visible')
                 self.add_layer(insert_idx=0, name=name, stack=stack)
                 t1 = time.time()
-
-                # extract the png form the zip into a file first
-                # the overhead for doing so seems to be neglegible (around 5%)
-                z.extract(src, tempdir)
-                tmp_filename = join(tempdir, src)
-                self.load_layer_from_png(tmp_filename, x, y, feedback_cb)
-                os.remove(tmp_filename)
-
                 layer = stack[0]
 
+                if lazy:
+                    # not undoable, but the command stack gets cleared by load()
+                    layer._surface.load_from_png_data(read_file(src), x, y, lazy=True)
+                else:
+                    queue_layer_pngs()
+                    result = decoded.pop(element, None)
+                    queue_layer_pngs()
+                    if result is None:
+                        # not queued, e.g. an unusable background tile
+                        result = pool.apply_async(decode_png, (read_file(src), x, y))
+                    surface = _wait_for_result(result, feedback_cb)
+                    self.do(command.LoadLayer(self, surface))
+
                 self.set_layer_opacity(helpers.clamp(opac, 0.0, 1.0), layer)
                 self.set_layer_compositeop(compositeop, layer)
                 self.set_layer_visibility(visible, layer)
@@ -908,14 +1128,13 @@ class Document():
 
                 print '  %.3fs loading and converting layer png' % (time.time() - t1)
                 # strokemap
-                fname = a.get('mypaint_strokemap_v2', None)
+                fname, version = _get_strokemap(a)
                 if fname:
                     if x % N or y % N:
                         print 'Warning: dropping non-aligned strokemap'
                     else:
-                        sio = StringIO(z.read(fname))
-                        layer.load_strokemap_from_file(sio, x, y)
-                        sio.close()
+                        layer.load_strokemap_from_string(z.read(fname), x, y, version,
+                                                         lazy=True)
                 
                 if selected:
                     return layer
@@ -925,8 +1144,15 @@ class Document():
             elif element.tag == 'stack':
                 sub_stack = self.layers
                 if stack is not None:
-                    self.add_group(None, stack=stack, index=0)
+                    a = element.attrib
+                    self.add_group(None, name=a.get('name', ''), stack=stack, index=0)
                     sub_stack = stack[0]
+                    opac = float(a.get('opacity', '1.0'))
+                    sub_stack.opacity = helpers.clamp(opac, 0.0, 1.0)
+                    compositeop = str(a.get('composite-op', DEFAULT_COMPOSITE_OP))
+                    if compositeop in VALID_COMPOSITE_OPS:
+                        sub_stack.compositeop = compositeop
+                    sub_stack.visible = not 'hidden' in a.get('visibility', 'visible')
                 selected_layer = None
                 for sub_element in element:
                     selected_sub_layer = load_layer(sub_element, sub_stack, x, y)
@@ -937,7 +1163,13 @@ class Document():
                 print 'Warning: ignoring unsupported tag:', element.tag
 
         
-        selected_layer = load_layer(stack, None)
+        try:
+            if not lazy:
+                find_layer_pngs(stack)
+            selected_layer = load_layer(stack, None)
+        finally:
+            pool.close()
+            pool.join()
 
         if len(self.layers) == 1:
             # no assertion (allow empty documents)
@@ -960,11 +1192,468 @@ class Document():
 
         z.close()
 
-        # remove empty directories created by zipfile's extract()
-        for root, dirs, files in os.walk(tempdir, topdown=False):
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(tempdir)
-
         print '%.3fs load_ora total' % (time.time() - t0)
+
+    def save_dopey(self, filename, **kwargs):
+        """Saves to the native tiled format, see lib/dopeyfile.py
+
+        Tiles are written as they are in memory (in parallel, where
+        they need compressing), so this is much faster than save_ora.
+        """
+        print 'save_dopey:'
+        t0 = time.time()
+        feedback_cb = kwargs.pop('feedback_cb', None)
+        image = ET.Element('image')
+        a = image.attrib
+        x, y, w, h = self.get_frame()
+        a['frame-x'], a['frame-y'], a['frame-w'], a['frame-h'] = str(x), str(y), str(w), str(h)
+        a['frame-enabled'] = 'true' if self.frame_enabled else 'false'
+        stack = ET.SubElement(image, 'stack')
+
+        # use .tmp extension, so we don't overwrite a valid file if there is an exception
+        f = open(filename + '.tmpsave', 'wb')
+        writer = dopeyfile.Writer(f)
+        pool = ThreadPool(ORA_SAVE_THREADS)
+
+        def add_stack_recursive(file_stack, doc_stack, idx=0):
+            for l in reversed(doc_stack):
+                if l.is_stack:
+                    el = ET.SubElement(file_stack, 'stack')
+                    idx = add_stack_recursive(el, l, idx)
+                else:
+                    el = ET.SubElement(file_stack, 'layer')
+                    name = 'layer%03d' % idx
+                    el.attrib['src'] = name
+                    writer.add_tiles(name, l._surface.tiledict, pool.imap)
+                    if l == self.layer:
+                        el.attrib['selected'] = 'true'
+                    if l.locked:
+                        el.attrib['edit-locked'] = 'true'
+                    sio = StringIO()
+                    l.save_strokemap_to_file(sio, 0, 0)
+                    el.attrib['mypaint_strokemap_v3'] = name + '_strokemap.dat'
+                    writer.add_entry(name + '_strokemap.dat', sio.getvalue())
+                    sio.close()
+                    idx += 1
+                    if feedback_cb:
+                        feedback_cb()
+                a = el.attrib
+                if l.name:
+                    a['name'] = l.name
+                a['opacity'] = str(l.opacity)
+                a['composite-op'] = l.compositeop
+                a['visibility'] = 'visible' if l.visible else 'hidden'
+            return idx
+
+        try:
+            add_stack_recursive(stack, self.layers)
+
+            bg = self.background
+            el = ET.SubElement(image, 'background')
+            el.attrib['w'], el.attrib['h'] = [str(v) for v in bg.looped_size]
+            writer.add_tiles('background', bg.tiledict, pool.imap)
+
+            writer.add_entry('animation.xsheet', self.ani.xsheet_as_str())
+            helpers.indent_etree(image)
+            writer.add_entry('stack.xml', ET.tostring(image, encoding='UTF-8'))
+            writer.close()
+        finally:
+            pool.close()
+            pool.join()
+            f.close()
+
+        if os.path.exists(filename):
+            os.remove(filename) # windows needs that
+        os.rename(filename + '.tmpsave', filename)
+        print '%.3fs save_dopey total' % (time.time() - t0)
+
+    def load_dopey(self, filename, feedback_cb=None, lazy=False):
+        """Loads from the native tiled format, see lib/dopeyfile.py
+
+        The tiles are decompressed when they are first used. With
+        lazy=True, they are not even read from the file before.
+        """
+        print 'load_dopey:'
+        t0 = time.time()
+        try:
+            reader = dopeyfile.Reader(filename)
+        except dopeyfile.FormatError, e:
+            raise SaveLoadError, _('Error while loading: %s') % e
+        try:
+            image = ET.fromstring(reader.read('stack.xml'))
+
+            self.clear() # this leaves one empty layer
+            a = image.attrib
+            self.set_frame(x=a['frame-x'], y=a['frame-y'],
+                           width=a['frame-w'], height=a['frame-h'])
+            self.set_frame_enabled(a.get('frame-enabled') == 'true')
+
+            el = image.find('background')
+            if el is not None:
+                w, h = int(el.attrib['w']), int(el.attrib['h'])
+                bg = numpy.zeros((h, w, 4), 'uint16')
+                for (tx, ty), t in reader.load_tiles('background').iteritems():
+                    bg[ty*N:(ty+1)*N, tx*N:(tx+1)*N] = t.rgba
+                self.set_background(bg)
+
+            # returns selected layer
+            def load_layer(element, stack):
+                a = element.attrib
+                opac = helpers.clamp(float(a.get('opacity', '1.0')), 0.0, 1.0)
+                compositeop = str(a.get('composite-op', DEFAULT_COMPOSITE_OP))
+                if compositeop not in VALID_COMPOSITE_OPS:
+                    compositeop = DEFAULT_COMPOSITE_OP
+                visible = not 'hidden' in a.get('visibility', 'visible')
+
+                if element.tag == 'layer':
+                    self.add_layer(insert_idx=0, name=a.get('name', ''), stack=stack)
+                    layer = stack[0]
+                    # the tiles are readonly, like those of any snapshot
+                    sshot = tiledsurface.SurfaceSnapshot()
+                    sshot.tiledict = reader.load_tiles(a['src'], lazy)
+                    layer._surface.load_snapshot(sshot)
+
+                    self.set_layer_opacity(opac, layer)
+                    self.set_layer_compositeop(compositeop, layer)
+                    self.set_layer_visibility(visible, layer)
+                    self.set_layer_locked(self.__xsd2bool(a.get('edit-locked', 'false')), layer)
+
+                    fname, version = _get_strokemap(a)
+                    if fname:
+                        layer.load_strokemap_from_string(reader.read(fname), 0, 0, version,
+                                                         lazy=True)
+                    if feedback_cb:
+                        feedback_cb()
+                    if self.__xsd2bool(a.get('selected', 'false')):
+                        return layer
+                    return None
+
+                elif element.tag == 'stack':
+                    sub_stack = self.layers
+                    if stack is not None:
+                        self.add_group(None, name=a.get('name', ''), stack=stack, index=0)
+                        sub_stack = stack[0]
+                        sub_stack.opacity = opac
+                        sub_stack.compositeop = compositeop
+                        sub_stack.visible = visible
+                    selected_layer = None
+                    for sub_element in element:
+                        selected_sub_layer = load_layer(sub_element, sub_stack)
+                        if selected_sub_layer is not None:
+                            selected_layer = selected_sub_layer
+                    return selected_layer
+                else:
+                    print 'Warning: ignoring unsupported tag:', element.tag
+
+            selected_layer = load_layer(image.find('stack'), None)
+
+            if len(self.layers) > 1:
+                # remove the still present initial empty top layer
+                self.select_layer(self.layers[-1])
+                self.remove_layer()
+
+            self.ani.str_to_xsheet(reader.read('animation.xsheet'))
+            if selected_layer is not None:
+                self.select_layer(selected_layer)
+        finally:
+            reader.close()
+
+        print '%.3fs load_dopey total' % (time.time() - t0)
         
+
+
+def _wait_for_result(result, feedback_cb=None):
+    """Wait for a thread pool AsyncResult, keeping the GUI responsive."""
+    while not result.ready():
+        result.wait(0.1)
+        if feedback_cb:
+            feedback_cb()
+    return result.get()
+
+
+def _get_strokemap(attrib):
+    """Returns (name, version) of the strokemap of a stack.xml layer."""
+    for version in (3, 2):
+        name = attrib.get('mypaint_strokemap_v%d' % version)
+        if name:
+            return name, version
+    return None, None
+
+
+class _LayerCompositeCache:
+    """Flattened tiles of the layers below the current layer.
+
+    The cached tiles contain the background with all layers under the
+    current layer composited on top, exactly as a full render would
+    have them at that point. The current layer and the layers above it
+    are composited over them as usual. (Flattening the layers above
+    too would round differently from a full render.)
+
+    Tiles are cached separately for each combination of background and
+    layers below (their order, visibility, opacity and blending modes),
+    so renders of different layer lists don't evict each other. They
+    are invalidated through the content observers of the layers they
+    were made from.
+    """
+
+    def __init__(self):
+        # key -> set of the leaf layers below, most recently used last
+        self._stacks = OrderedDict()
+        self._tiles = OrderedDict() # (key, mipmap_level, tx, ty) -> rgba
+        self._observed = weakref.WeakKeyDictionary()
+
+    def clear(self):
+        self._stacks.clear()
+        self._tiles.clear()
+
+    def _signature(self, layers):
+        res = []
+        for l in layers:
+            if l.is_stack:
+                res.append((l, l.effective_opacity, l.compositeop, l.get_signature()))
+            else:
+                res.append((l, l.effective_opacity, l.compositeop))
+        return tuple(res)
+
+    def _observe(self, l):
+        if l in self._observed:
+            return
+        self_ref = weakref.ref(self)
+        def layer_modified_cb(*bbox):
+            cache = self_ref()
+            if cache is not None:
+                cache.layer_modified(l, *bbox)
+        l.content_observers.append(layer_modified_cb)
+        self._observed[l] = True
+
+    def layer_modified(self, l, x, y, w, h):
+        keys = set([key for key, leaves in self._stacks.iteritems() if l in leaves])
+        if not keys:
+            return
+        everything = (w == 0 and h == 0)
+        for tile_key in self._tiles.keys():
+            key, level, tx, ty = tile_key
+            if key not in keys:
+                continue
+            size = N << level
+            if not everything:
+                if tx*size >= x+w or (tx+1)*size <= x:
+                    continue
+                if ty*size >= y+h or (ty+1)*size <= y:
+                    continue
+            del self._tiles[tile_key]
+
+    def _use_stack(self, key, below):
+        if key in self._stacks:
+            self._stacks[key] = self._stacks.pop(key) # most recently used
+            return
+        leaves = set()
+        for l in below:
+            leaves.update(l.get_flat_list() if l.is_stack else [l])
+        for l in leaves:
+            self._observe(l)
+        self._stacks[key] = leaves
+        while len(self._stacks) > COMPOSITE_CACHE_STACKS:
+            old, leaves = self._stacks.popitem(last=False)
+            for tile_key in self._tiles.keys():
+                if tile_key[0] == old:
+                    del self._tiles[tile_key]
+
+    def _get(self, key):
+        res = self._tiles.pop(key)
+        self._tiles[key] = res # most recently used
+        return res
+
+    def _put(self, key, rgba):
+        self._tiles[key] = rgba
+        while len(self._tiles) > COMPOSITE_CACHE_TILES:
+            self._tiles.popitem(last=False)
+
+    def blit_tiles_into(self, dst_tiles, mipmap_level, layers, background, current, index):
+        """Render like Document.blit_tiles_into(), using the cache.
+
+        Returns False if the layers cannot be cached, in which case
+        nothing was rendered.
+        """
+        idx = None
+        for i, l in enumerate(layers):
+            if l is current:
+                idx = i
+        if idx is None or not hasattr(background, 'get_tile_rgba'):
+            return False
+        below = list(layers[:idx])
+        above = list(layers[idx+1:])
+        leaves = []
+        for l in below + above + [current]:
+            if l.is_stack:
+                leaves.extend(l.get_flat_list())
+            else:
+                leaves.append(l)
+        for l in leaves:
+            if not hasattr(l, 'add_composite_ops') or not hasattr(l, 'content_observers'):
+                return False
+
+        key = (background, self._signature(below))
+        self._use_stack(key, below)
+
+        # look up the cached tiles, filling in the missing ones in one batch
+        fill_jobs = []
+        cached = []
+        for tx, ty, dst in dst_tiles:
+            below_key = (key, mipmap_level, tx, ty)
+            if below_key in self._tiles:
+                below_rgba = self._get(below_key)
+            else:
+                below_rgba = background.get_tile_rgba(tx, ty, mipmap_level)
+                ops = []
+                for l in index.filter_layers(below, tx, ty, mipmap_level):
+                    l.add_composite_ops(ops, tx, ty, mipmap_level)
+                if ops:
+                    bg = below_rgba
+                    below_rgba = numpy.empty((N, N, 4), 'uint16')
+                    fill_jobs.append((below_rgba, bg, ops))
+                self._put(below_key, below_rgba)
+            cached.append(below_rgba)
+        if fill_jobs:
+            mypaintlib.tile_composite_stack(fill_jobs)
+
+        jobs = []
+        for (tx, ty, dst), below_rgba in zip(dst_tiles, cached):
+            assert dst.shape[-1] == 4
+            ops = []
+            for l in index.filter_layers([current] + above, tx, ty, mipmap_level):
+                l.add_composite_ops(ops, tx, ty, mipmap_level)
+            jobs.append((dst, below_rgba, ops))
+        mypaintlib.tile_composite_stack(jobs)
+        return True
+
+
+class LayerTileIndex:
+    """Spatial index of the tiles that hold data, for many layers.
+
+    For every mipmap level this maps a tile position to the layers with
+    non-transparent tiles there, so that compositing can skip the layers
+    which are empty at a tile (most of them, with many animation cels).
+    It is kept up to date through the content observers of the layers.
+    Layers without a tile dictionary (GEGL backend, or a pending lazy
+    load) are not indexed, and always reported as possibly having data.
+    """
+
+    def __init__(self):
+        # per mipmap level: (tx, ty) -> {layer: number of level 0 tiles}
+        self._levels = [{} for i in xrange(tiledsurface.MAX_MIPMAP_LEVEL+1)]
+        self._layer_tiles = {} # layer -> set of level 0 tile positions
+        self._layers = None
+        self._observed = weakref.WeakKeyDictionary()
+
+    def update_layers(self, layers):
+        """Set the (flat) list of layers to index."""
+        if layers == self._layers:
+            return
+        self._layers = list(layers)
+        new = set(l for l in layers if tiledsurface.has_tiledict(l._surface))
+        for l in set(self._layer_tiles) - new:
+            self._unindex(l)
+        for l in layers:
+            # also the unindexed ones, to notice when they get loaded
+            self._observe(l)
+        for l in new - set(self._layer_tiles):
+            self._index(l)
+
+    def _index(self, l):
+        self._layer_tiles[l] = set()
+        self._scan(l, l._surface.tiledict.keys())
+
+    def _unindex(self, l):
+        for pos in self._layer_tiles.pop(l):
+            self._remove(l, pos)
+
+    def _observe(self, l):
+        if l in self._observed:
+            return
+        self_ref = weakref.ref(self)
+        def layer_modified_cb(x, y, w, h):
+            index = self_ref()
+            if index is not None:
+                index.layer_modified(l, x, y, w, h)
+        l.content_observers.append(layer_modified_cb)
+        self._observed[l] = True
+
+    def layer_modified(self, l, x, y, w, h):
+        tiles = self._layer_tiles.get(l)
+        indexable = tiledsurface.has_tiledict(l._surface)
+        if tiles is None:
+            if indexable and self._layers is not None and l in self._layers:
+                self._index(l) # e.g. a lazy load has finished
+            return
+        if not indexable:
+            self._unindex(l)
+            return
+        tiledict = l._surface.tiledict
+        tx1, ty1 = x // N, y // N
+        tx2, ty2 = (x+w-1) // N, (y+h-1) // N
+        count = (tx2-tx1+1) * (ty2-ty1+1)
+        if (w == 0 and h == 0) or count > len(tiledict) + len(tiles):
+            positions = set(tiledict.keys()) | tiles
+        else:
+            positions = [(tx, ty) for tx in xrange(tx1, tx2+1) for ty in xrange(ty1, ty2+1)]
+        self._scan(l, positions)
+
+    def _scan(self, l, positions):
+        tiles = self._layer_tiles[l]
+        tiledict = l._surface.tiledict
+        transparent_tile = tiledsurface.transparent_tile
+        for pos in positions:
+            t = tiledict.get(pos)
+            has_data = t is not None and t is not transparent_tile
+            if has_data and pos not in tiles:
+                tiles.add(pos)
+                self._add(l, pos)
+            elif not has_data and pos in tiles:
+                tiles.remove(pos)
+                self._remove(l, pos)
+
+    def _add(self, l, (tx, ty)):
+        for level, d in enumerate(self._levels):
+            counts = d.setdefault((tx >> level, ty >> level), {})
+            counts[l] = counts.get(l, 0) + 1
+
+    def _remove(self, l, (tx, ty)):
+        for level, d in enumerate(self._levels):
+            pos = (tx >> level, ty >> level)
+            counts = d[pos]
+            counts[l] -= 1
+            if not counts[l]:
+                del counts[l]
+                if not counts:
+                    del d[pos]
+
+    def filter_layers(self, layers, tx, ty, mipmap_level=0):
+        """Return the layers which may have data at a tile, in order.
+
+        Stacks are always included.
+        """
+        if mipmap_level >= len(self._levels):
+            return layers
+        occupied = self._levels[mipmap_level].get((tx, ty), ())
+        indexed = self._layer_tiles
+        return [l for l in layers if l.is_stack or l in occupied or l not in indexed]
+
+    def get_layers_at_tiles(self, layers, tiles):
+        """Return the layers which may have data at any of the tiles."""
+        occupied = set()
+        for pos in tiles:
+            occupied.update(self._levels[0].get(pos, ()))
+        indexed = self._layer_tiles
+        return [l for l in layers if l in occupied or l not in indexed]
+
+    def get_bbox(self, layers):
+        """Return the bounding box of the data in a list of layers."""
+        res = helpers.Rect()
+        for l in layers:
+            tiles = self._layer_tiles.get(l)
+            if tiles is None:
+                res.expandToIncludeRect(l.get_bbox())
+            else:
+                res.expandToIncludeRect(tiledsurface.get_tiles_bbox(tiles))
+        return res
@@ -0,0 +1,272 @@
+# This file is part of MyPaint.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Native tiled document container (.dopey files)
+
+Unlike in OpenRaster files, layers are not stored as PNG images but as
+the tiles of their surfaces, each one zlib compressed on its own. An
+index at the end of the file maps the tile positions of each layer to
+their chunks, so single tiles can be read without touching the rest of
+the file. The document structure is described by a stack.xml entry,
+like in OpenRaster.
+
+File layout (numbers are big endian):
+
+    MAGIC
+    chunks          tile data and named entries, back to back
+    index           zlib compressed, see Writer.close()
+    index offset    uint64
+    index length    uint32
+    MAGIC
+
+A tile chunk holds the zlib compressed rgba16 pixels (little endian).
+This is also how TileMemory keeps cold tiles, so those are saved and
+loaded without recompressing, and loaded tiles are only decompressed
+when they are first used. Uniformly colored tiles are stored as their
+color. A tile shared between layers is only stored once.
+"""
+
+import os
+import sys
+import zlib
+import mmap
+import struct
+import weakref
+import itertools
+from collections import OrderedDict
+
+from numpy import *
+
+import tiledsurface
+
+N = tiledsurface.N
+
+MAGIC = 'DOPEY\x00\x01\x00'
+
+# kinds of tile chunks
+TILE_ZLIB = 0
+TILE_UNIFORM = 1
+
+_count = struct.Struct('>I')
+_name = struct.Struct('>H')
+_entry = struct.Struct('>QI')
+_tile = struct.Struct('>iiBQI')
+_color = struct.Struct('>4H')
+_footer = struct.Struct('>QI8s')
+
+_little_endian = sys.byteorder == 'little'
+
+
+class FormatError(Exception):
+    pass
+
+
+# Lazily loaded tiles whose data is still in the memory map of their file,
+# by the absolute path of the file, see unmap_file()
+_mapped_tiles = {} # path -> WeakSet of Tiles
+
+def unmap_file(filename):
+    """Copy the data of lazily loaded tiles out of a file's memory map.
+
+    The map stays alive as long as a tile refers to it, so this must be
+    called before the file is replaced (Windows can't remove a mapped
+    file). Tiles which were already decompressed are skipped.
+    """
+    tiles = _mapped_tiles.pop(os.path.abspath(filename), None)
+    for t in list(tiles or []):
+        tiledsurface.tile_memory.unmap(t)
+
+
+def encode_tile(tile):
+    """Returns the (kind, data) chunk storing a Tile"""
+    if tile is tiledsurface.transparent_tile:
+        return TILE_UNIFORM, _color.pack(0, 0, 0, 0)
+    if tile.uniform is not None:
+        return TILE_UNIFORM, _color.pack(*tile.uniform)
+    if _little_endian:
+        return TILE_ZLIB, tile.get_compressed()
+    return TILE_ZLIB, zlib.compress(tile.rgba.astype('<u2').tostring(), 1)
+
+def decode_tile(kind, data, mapped=False):
+    """Returns a readonly Tile from a chunk, see encode_tile()
+
+    With mapped=True, data is a buffer into a memory mapped file, which
+    the tile keeps until it is decompressed or unmapped.
+    """
+    if kind == TILE_UNIFORM:
+        return tiledsurface.get_uniform_tile(_color.unpack(str(data)))
+    if kind != TILE_ZLIB:
+        raise FormatError, 'unknown tile kind %d' % kind
+    if _little_endian:
+        t = tiledsurface.Tile.from_compressed(data, mapped)
+    else:
+        t = tiledsurface.Tile()
+        rgba = fromstring(zlib.decompress(data), '<u2').astype('uint16')
+        t.rgba = rgba.reshape((N, N, 4))
+    t.readonly = True
+    return t
+
+
+class Writer:
+    """Writes a container to a file object, front to back."""
+
+    def __init__(self, f):
+        self._f = f
+        self._offset = 0
+        self._entries = [] # (name, offset, length)
+        self._tables = OrderedDict() # name -> [(tx, ty, kind, offset, length)]
+        self._chunks = {} # id(tile) -> (kind, offset, length)
+        self._tiles = [] # keeps the tiles alive, for the ids above
+        self._write(MAGIC)
+
+    def _write(self, data):
+        offset = self._offset
+        self._f.write(data)
+        self._offset += len(data)
+        return offset, len(data)
+
+    def add_entry(self, name, data):
+        """Stores a named string"""
+        offset, length = self._write(data)
+        self._entries.append((name, offset, length))
+
+    def add_tiles(self, table, tiledict, map=itertools.imap):
+        """Adds the tiles of a tiledict to a (possibly new) table.
+
+        The tiles are encoded with encode_tile() through map, e.g. the
+        imap() method of a thread pool (zlib releases the GIL).
+        """
+        records = self._tables.setdefault(table, [])
+        new = OrderedDict()
+        positions = []
+        for (tx, ty), tile in tiledict.iteritems():
+            key = id(tile)
+            if key not in self._chunks:
+                new[key] = tile
+            positions.append((tx, ty, key))
+        for key, (kind, data) in itertools.izip(new, map(encode_tile, new.values())):
+            offset, length = self._write(data)
+            self._chunks[key] = (kind, offset, length)
+        self._tiles.extend(new.itervalues())
+        for tx, ty, key in positions:
+            records.append((tx, ty) + self._chunks[key])
+
+    def close(self):
+        """Writes the index. Does not close the file object."""
+        parts = [_count.pack(len(self._entries))]
+        for name, offset, length in self._entries:
+            parts += [_name.pack(len(name)), name, _entry.pack(offset, length)]
+        parts.append(_count.pack(len(self._tables)))
+        for name, records in self._tables.iteritems():
+            parts += [_name.pack(len(name)), name, _count.pack(len(records))]
+            parts += [_tile.pack(*r) for r in records]
+        offset, length = self._write(zlib.compress(''.join(parts)))
+        self._write(_footer.pack(offset, length, MAGIC))
+        self._tiles = []
+
+
+class Reader:
+    """Random access to the entries and tiles of a container file."""
+
+    def __init__(self, filename):
+        self._path = os.path.abspath(filename)
+        self._file = open(filename, 'rb')
+        try:
+            self._read_index()
+        except:
+            self._file.close()
+            raise
+        # Tiles stored in the same chunk are loaded as the same Tile.
+        self._tiles = weakref.WeakValueDictionary() # offset -> Tile
+
+    def _read_index(self):
+        try:
+            m = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # e.g. an empty file
+            raise FormatError, 'not a native document'
+        self._map = m
+        if len(m) < len(MAGIC) + _footer.size or m[:len(MAGIC)] != MAGIC:
+            raise FormatError, 'not a native document'
+        offset, length, magic = _footer.unpack(m[-_footer.size:])
+        if magic != MAGIC or offset + length > len(m):
+            raise FormatError, 'truncated native document'
+        try:
+            self._parse_index(zlib.decompress(m[offset:offset+length]))
+        except (zlib.error, struct.error), e:
+            raise FormatError, 'corrupt index: %s' % e
+
+    def _parse_index(self, index):
+        pos = [0]
+        def unpack(s):
+            res = s.unpack_from(index, pos[0])
+            pos[0] += s.size
+            return res
+        def unpack_name():
+            length, = unpack(_name)
+            name = index[pos[0]:pos[0]+length]
+            pos[0] += length
+            return name
+
+        self.entries = {} # name -> (offset, length)
+        count, = unpack(_count)
+        for i in xrange(count):
+            name = unpack_name()
+            self.entries[name] = unpack(_entry)
+        self.tables = OrderedDict() # name -> {(tx, ty): (kind, offset, length)}
+        count, = unpack(_count)
+        for i in xrange(count):
+            name = unpack_name()
+            tiles = self.tables[name] = {}
+            n, = unpack(_count)
+            for j in xrange(n):
+                tx, ty, kind, offset, length = unpack(_tile)
+                tiles[tx, ty] = (kind, offset, length)
+
+    def read(self, name):
+        """Returns a named entry"""
+        offset, length = self.entries[name]
+        return self._map[offset:offset+length]
+
+    def _load_tile(self, kind, offset, length, lazy):
+        t = self._tiles.get(offset)
+        if t is None:
+            if lazy:
+                data = buffer(self._map, offset, length)
+            else:
+                data = self._map[offset:offset+length]
+            t = self._tiles[offset] = decode_tile(kind, data, lazy)
+            if lazy:
+                tiles = _mapped_tiles.setdefault(self._path, weakref.WeakSet())
+                tiles.add(t)
+        return t
+
+    def load_tile(self, table, tx, ty, lazy=False):
+        """Returns a single readonly Tile, or None"""
+        chunk = self.tables[table].get((tx, ty))
+        if chunk is None:
+            return None
+        return self._load_tile(*chunk, lazy=lazy)
+
+    def load_tiles(self, table, lazy=False):
+        """Returns a tiledict with the readonly tiles of a table.
+
+        The tiles stay compressed until their pixels are accessed. With
+        lazy=True they are not even read from the file until then.
+        """
+        tiles = self.tables[table]
+        res = {}
+        # read in file order
+        for pos in sorted(tiles, key=lambda pos: tiles[pos][1]):
+            res[pos] = self._load_tile(*tiles[pos], lazy=lazy)
+        return res
+
+    def close(self):
+        # The map itself stays around while lazily loaded tiles refer
+        # to it, and is unmapped when the last one is gone.
+        self._file.close()
+        self._map = None
@@ -1,6 +1,10 @@
 #define PNG_SKIP_SETJMP_CHECK
 #include "png.h"
 #include "lcms2.h"
+#include <zlib.h>
+
+#include <vector>
+#include <algorithm>
 
 #ifndef SWIG
 static void png_write_error_callback(png_structp png_save_ptr, png_const_charp error_msg)
@@ -146,10 +150,407 @@ save_png_fast_progressive (char *filename,
 }
 
 #ifndef SWIG
+
+// Parallel PNG writing. The image data of a PNG is one zlib stream.
+// Like pigz we deflate strips of scanlines independently, each ending
+// on a byte boundary (Z_SYNC_FLUSH), and with the end of the previous
+// strip as preset dictionary. Concatenated they form a valid stream;
+// the adler32 checksums are combined in order.
+
+static const int PNG_DEFLATE_WINDOW = 32768;
+
+// Max. number of strips pulled from the generator before compressing
+// them in parallel.
+static const int PNG_STRIPS_PER_BATCH = 16;
+
+struct PNGStrip {
+  std::vector<unsigned char> filtered; // filter byte + pixels, per row
+  std::vector<unsigned char> dictionary;
+  std::vector<unsigned char> compressed;
+  size_t length; // of the uncompressed data
+  uLong adler;
+  bool last;
+  bool failed;
+};
+
+// Where the PNG data goes: a file, or a Python callable (e.g. the write
+// method of a file-like object) which gets called with a string. Chunks
+// are collected in the buffer until png_flush_output().
+struct PNGOutput {
+  FILE *fp;
+  PyObject *write_func;
+  std::vector<unsigned char> buffer;
+};
+
+static void
+png_append_bytes(PNGOutput &out, const unsigned char *data, size_t len)
+{
+  out.buffer.insert(out.buffer.end(), data, data+len);
+}
+
+static void
+png_append_chunk(PNGOutput &out, const char *type,
+                 const unsigned char *data, size_t len)
+{
+  unsigned char header[8];
+  unsigned char footer[4];
+  header[0] = (len >> 24) & 0xff;
+  header[1] = (len >> 16) & 0xff;
+  header[2] = (len >> 8) & 0xff;
+  header[3] = len & 0xff;
+  memcpy(header+4, type, 4);
+  uLong crc = crc32(0, header+4, 4);
+  if (len) crc = crc32(crc, data, len);
+  footer[0] = (crc >> 24) & 0xff;
+  footer[1] = (crc >> 16) & 0xff;
+  footer[2] = (crc >> 8) & 0xff;
+  footer[3] = crc & 0xff;
+  png_append_bytes(out, header, 8);
+  if (len) png_append_bytes(out, data, len);
+  png_append_bytes(out, footer, 4);
+}
+
+// Must be called with the GIL held. Returns false with a Python
+// exception set on errors.
+static bool
+png_flush_output(PNGOutput &out)
+{
+  if (out.buffer.empty()) {
+    return true;
+  }
+  bool ok = true;
+  if (out.fp) {
+    Py_BEGIN_ALLOW_THREADS
+    ok = (fwrite(&out.buffer[0], 1, out.buffer.size(), out.fp) == out.buffer.size());
+    Py_END_ALLOW_THREADS
+    if (!ok) {
+      PyErr_SetFromErrno(PyExc_IOError);
+    }
+  }
+  else {
+    PyObject *res = PyObject_CallFunction(out.write_func, "s#",
+                                          (char *)&out.buffer[0],
+                                          (int)out.buffer.size());
+    ok = (res != NULL);
+    Py_XDECREF(res);
+  }
+  out.buffer.clear();
+  return ok;
+}
+
+static void
+png_put_uint32(unsigned char *p, uint32_t v)
+{
+  p[0] = (v >> 24) & 0xff;
+  p[1] = (v >> 16) & 0xff;
+  p[2] = (v >> 8) & 0xff;
+  p[3] = v & 0xff;
+}
+
+// Copy rgba or rgbu rows into PNG scanlines, with the "sub" filter
+// (same as the libpng based writer above).
+static void
+png_filter_rows_sub(const uint8_t *src, npy_intp src_stride, int rows, int w,
+                    bool has_alpha, unsigned char *dst)
+{
+  const int bpp = has_alpha ? 4 : 3;
+  for (int y=0; y<rows; y++) {
+    const uint8_t *s = src + y*src_stride;
+    *dst++ = 1; // PNG_FILTER_VALUE_SUB
+    for (int c=0; c<bpp; c++) {
+      dst[c] = s[c];
+    }
+    for (int x=1; x<w; x++) {
+      for (int c=0; c<bpp; c++) {
+        dst[x*bpp+c] = s[x*4+c] - s[(x-1)*4+c];
+      }
+    }
+    dst += w*bpp;
+  }
+}
+
+static void
+png_deflate_strip(PNGStrip &strip, int compression_level)
+{
+  z_stream zs;
+  memset(&zs, 0, sizeof(zs));
+  // raw deflate, the zlib header is written separately
+  if (deflateInit2(&zs, compression_level, Z_DEFLATED, -15, 8,
+                   Z_DEFAULT_STRATEGY) != Z_OK) {
+    strip.failed = true;
+    return;
+  }
+  if (!strip.dictionary.empty()) {
+    deflateSetDictionary(&zs, &strip.dictionary[0], strip.dictionary.size());
+  }
+  const size_t len = strip.filtered.size();
+  strip.adler = adler32(adler32(0, NULL, 0), &strip.filtered[0], len);
+  // room for the empty stored block of the sync flush
+  strip.compressed.resize(deflateBound(&zs, len) + 16);
+  zs.next_in = &strip.filtered[0];
+  zs.avail_in = len;
+  size_t done = 0;
+  int res;
+  do {
+    if (done == strip.compressed.size()) {
+      strip.compressed.resize(done*2);
+    }
+    zs.next_out = &strip.compressed[done];
+    zs.avail_out = strip.compressed.size() - done;
+    res = deflate(&zs, strip.last ? Z_FINISH : Z_SYNC_FLUSH);
+    done = strip.compressed.size() - zs.avail_out;
+  } while (res == Z_OK && zs.avail_out == 0);
+  if (res != Z_OK && res != Z_STREAM_END) {
+    strip.failed = true;
+  }
+  strip.compressed.resize(done);
+  deflateEnd(&zs);
+  // only the output is needed from here on
+  std::vector<unsigned char>().swap(strip.filtered);
+  std::vector<unsigned char>().swap(strip.dictionary);
+}
+
+static PyObject *
+png_write_parallel(PNGOutput &out,
+                   int w, int h,
+                   bool has_alpha,
+                   PyObject *data_generator,
+                   bool write_legacy_png,
+                   int compression_level)
+{
+  PyObject * result = NULL;
+  PyObject *iterator = NULL;
+  bool ok = true;
+  const int bpp = has_alpha ? 4 : 3;
+  const size_t row_bytes = 1 + (size_t)w*bpp;
+  std::vector<unsigned char> window; // end of the previous strip
+  uLong adler = adler32(0, NULL, 0);
+  int y = 0;
+
+  {
+    static const unsigned char signature[8] = {137, 80, 78, 71, 13, 10, 26, 10};
+    png_append_bytes(out, signature, 8);
+
+    unsigned char ihdr[13];
+    png_put_uint32(ihdr, w);
+    png_put_uint32(ihdr+4, h);
+    ihdr[8] = 8; // bits per channel
+    ihdr[9] = has_alpha ? PNG_COLOR_TYPE_RGB_ALPHA : PNG_COLOR_TYPE_RGB;
+    ihdr[10] = PNG_COMPRESSION_TYPE_BASE;
+    ihdr[11] = PNG_FILTER_TYPE_BASE;
+    ihdr[12] = PNG_INTERLACE_NONE;
+    png_append_chunk(out, "IHDR", ihdr, 13);
+
+    if (! write_legacy_png) {
+      // the same chunks as png_set_sRGB_gAMA_and_cHRM() writes
+      unsigned char srgb[1] = {PNG_sRGB_INTENT_PERCEPTUAL};
+      png_append_chunk(out, "sRGB", srgb, 1);
+      unsigned char gama[4];
+      png_put_uint32(gama, 45455);
+      png_append_chunk(out, "gAMA", gama, 4);
+      static const uint32_t chrm_values[8] = {31270, 32900, 64000, 33000,
+                                              30000, 60000, 15000, 6000};
+      unsigned char chrm[32];
+      for (int i=0; i<8; i++) {
+        png_put_uint32(chrm+i*4, chrm_values[i]);
+      }
+      png_append_chunk(out, "cHRM", chrm, 32);
+    }
+
+    // zlib header: deflate with a 32K window, no preset dictionary
+    unsigned char zheader[2] = {0x78, 0x01};
+    if (compression_level >= 7) zheader[1] = 0xda;
+    else if (compression_level >= 6) zheader[1] = 0x9c;
+    else if (compression_level >= 2) zheader[1] = 0x5e;
+    png_append_chunk(out, "IDAT", zheader, 2);
+  }
+
+  iterator = PyObject_GetIter(data_generator);
+  if (!iterator) goto cleanup;
+
+  while (y < h) {
+    std::vector<PNGStrip> strips;
+    strips.reserve(PNG_STRIPS_PER_BATCH);
+    while (y < h && (int)strips.size() < PNG_STRIPS_PER_BATCH) {
+      PyObject * obj = PyIter_Next(iterator);
+      if (PyErr_Occurred()) goto cleanup;
+      PyArrayObject* arr = (PyArrayObject*)obj;
+      assert(arr); // iterator should have data
+      assert(PyArray_ISALIGNED(arr));
+      assert(PyArray_NDIM(arr) == 3);
+      assert(PyArray_DIM(arr, 1) == w);
+      assert(PyArray_DIM(arr, 2) == 4); // rgbu
+      assert(PyArray_TYPE(arr) == NPY_UINT8);
+      assert(PyArray_STRIDE(arr, 1) == 4);
+      assert(PyArray_STRIDE(arr, 2) == 1);
+
+      const int rows = PyArray_DIM(arr, 0);
+      assert(rows > 0);
+      y += rows;
+      assert(y <= h);
+
+      strips.resize(strips.size()+1);
+      PNGStrip &strip = strips.back();
+      strip.last = (y == h);
+      strip.failed = false;
+      strip.length = rows*row_bytes;
+      strip.filtered.resize(strip.length);
+      // the generator may reuse the array, so the rows are copied
+      Py_BEGIN_ALLOW_THREADS
+      png_filter_rows_sub((const uint8_t *)PyArray_DATA(arr), PyArray_STRIDE(arr, 0),
+                          rows, w, has_alpha, &strip.filtered[0]);
+      Py_END_ALLOW_THREADS
+      Py_DECREF(arr);
+
+      strip.dictionary.swap(window);
+      const size_t n = std::min(strip.filtered.size(), (size_t)PNG_DEFLATE_WINDOW);
+      window.assign(strip.filtered.end() - n, strip.filtered.end());
+      if (n < PNG_DEFLATE_WINDOW && !strip.dictionary.empty()) {
+        // short strip, keep the tail of the older data too
+        const size_t keep = std::min(strip.dictionary.size(), PNG_DEFLATE_WINDOW - n);
+        window.insert(window.begin(), strip.dictionary.end() - keep, strip.dictionary.end());
+      }
+    }
+
+    const int n = strips.size();
+    Py_BEGIN_ALLOW_THREADS
+    #pragma omp parallel for schedule(dynamic)
+    for (int i=0; i<n; i++) {
+      png_deflate_strip(strips[i], compression_level);
+    }
+    for (int i=0; i<n; i++) {
+      PNGStrip &strip = strips[i];
+      if (strip.failed) {
+        ok = false;
+        break;
+      }
+      adler = adler32_combine(adler, strip.adler, strip.length);
+      png_append_chunk(out, "IDAT", strip.compressed.empty() ? NULL : &strip.compressed[0],
+                       strip.compressed.size());
+    }
+    Py_END_ALLOW_THREADS
+    if (!ok) {
+      PyErr_SetString(PyExc_RuntimeError, "Error compressing PNG data");
+      goto cleanup;
+    }
+    if (!png_flush_output(out)) goto cleanup;
+  }
+  assert(y == h);
+  {
+    PyObject * obj = PyIter_Next(iterator);
+    assert(!obj); // iterator should be finished
+    if (PyErr_Occurred()) goto cleanup;
+  }
+
+  {
+    unsigned char trailer[4];
+    png_put_uint32(trailer, adler);
+    png_append_chunk(out, "IDAT", trailer, 4);
+    png_append_chunk(out, "IEND", NULL, 0);
+  }
+  if (!png_flush_output(out)) goto cleanup;
+
+  result = Py_BuildValue("{}");
+
+ cleanup:
+  if (iterator) Py_DECREF(iterator);
+  return result;
+}
+
+#endif /* #ifndef SWIG */
+
+/** save_png_fast_parallel:
+ *
+ * Same as save_png_fast_progressive(), but the scanlines are filtered and
+ * compressed on all cores. Up to PNG_STRIPS_PER_BATCH arrays are taken from
+ * the data generator, then they are compressed in parallel without holding
+ * the GIL. The writer may run in a background thread meanwhile, with the
+ * rows rendered by the main thread (see pixbufsurface.save_as_png).
+ *
+ * @compression_level: zlib level, 1 (fastest) to 9 (smallest file)
+ */
+
+PyObject *
+save_png_fast_parallel (char *filename,
+                        int w, int h,
+                        bool has_alpha,
+                        PyObject *data_generator,
+                        bool write_legacy_png,
+                        int compression_level)
+{
+  PNGOutput out;
+  out.write_func = NULL;
+  out.fp = fopen(filename, "wb");
+  if (!out.fp) {
+    PyErr_SetFromErrno(PyExc_IOError);
+    return NULL;
+  }
+  PyObject *result = png_write_parallel(out, w, h, has_alpha, data_generator,
+                                        write_legacy_png, compression_level);
+  if (fclose(out.fp) != 0 && result) {
+    Py_DECREF(result);
+    result = NULL;
+    PyErr_SetFromErrno(PyExc_IOError);
+  }
+  return result;
+}
+
+/** write_png_fast_parallel:
+ *
+ * Same as save_png_fast_parallel(), but the PNG data is passed to the
+ * write_func callable (e.g. the write method of a StringIO) instead of
+ * being written to a file. Used to store PNGs in a zip file without
+ * temporary files.
+ */
+
+PyObject *
+write_png_fast_parallel (PyObject *write_func,
+                         int w, int h,
+                         bool has_alpha,
+                         PyObject *data_generator,
+                         bool write_legacy_png,
+                         int compression_level)
+{
+  PNGOutput out;
+  out.fp = NULL;
+  out.write_func = write_func;
+  return png_write_parallel(out, w, h, has_alpha, data_generator,
+                            write_legacy_png, compression_level);
+}
+
+#ifndef SWIG
+
+// Passed to libpng as error and (when reading from memory) io pointer.
+struct PNGReadState {
+  // set while decoding without the GIL
+  PyThreadState *thread_state;
+  // PNG data in memory, NULL when reading from a file
+  const char *data;
+  size_t size;
+  size_t pos;
+};
+
+static void
+png_read_from_memory (png_structp png_read_ptr, png_bytep out, png_size_t len)
+{
+  PNGReadState *state = (PNGReadState *)png_get_io_ptr(png_read_ptr);
+  if (len > state->size - state->pos) {
+    png_error(png_read_ptr, "unexpected end of data");
+  }
+  memcpy(out, state->data + state->pos, len);
+  state->pos += len;
+}
+
 static void
 png_read_error_callback (png_structp png_read_ptr,
                          png_const_charp error_msg)
 {
+  PNGReadState *state = (PNGReadState *)png_get_error_ptr(png_read_ptr);
+  if (state && state->thread_state) {
+    // failed while decoding rows, get the GIL back to raise the error
+    PyEval_RestoreThread(state->thread_state);
+    state->thread_state = NULL;
+  }
   // we don't trust libpng to call the error callback only once, so
   // check for already-set error
   if (!PyErr_Occurred()) {
@@ -175,31 +576,14 @@ log_lcms2_error (cmsContext context_id, cmsUInt32Number err_code,
 }
 
 
-/** load_png_fast_progressive:
- *
- * @filename: filename to load, in the system encoding
- * @get_buffer_callback: a Python callable returning writeable arrays
- * returns: a dict of flags describing what was read.
- *
- * Read a PNG progressively as 8bit RGBA. The callback must have the signature
- *
- *   numpy_array = callback(full_image_width, full_image_height)
- *
- * @get_buffer_callback  must return a writeable array of the image width.  If
- * the height is smaller than the image height, the callback will be called
- * again until the full image has been processed. The buffer will be written
- * with 8-bit RGBA data
- *
- * In the return dict, a true value for the "possible_legacy_png" key means
- * that no colour management chunks were found. This *might* be due to the PNG
- * file being a file written by an old version of MyPaint. Those versions
- * assumed sRGB in, sRGB out, but also used incorrect nonlinear compositing.
- * The flag is meaningful in (some) ORA files, not so much when loading a PNG.
- */
+#ifndef SWIG
 
-PyObject *
-load_png_fast_progressive (char *filename,
-                           PyObject *get_buffer_callback)
+// Reads from the file, or from the data in state if filename is NULL.
+// The rows are decoded without holding the GIL.
+static PyObject *
+png_load_progressive (char *filename,
+                      PNGReadState *state,
+                      PyObject *get_buffer_callback)
 {
   // Note: we are not using the method that libpng calls "Reading PNG
   // files progressively". That method would involve feeding the data
@@ -259,15 +643,17 @@ load_png_fast_progressive (char *filename,
 
   cmsSetLogErrorHandler(log_lcms2_error);
 
-  fp = fopen(filename, "rb");
-  if (!fp) {
-    PyErr_SetFromErrno(PyExc_IOError);
-    //PyErr_Format(PyExc_IOError, "Could not open PNG file for writing: %s",
-    //             filename);
-    goto cleanup;
+  if (filename) {
+    fp = fopen(filename, "rb");
+    if (!fp) {
+      PyErr_SetFromErrno(PyExc_IOError);
+      //PyErr_Format(PyExc_IOError, "Could not open PNG file for writing: %s",
+      //             filename);
+      goto cleanup;
+    }
   }
 
-  png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)NULL,
+  png_ptr = png_create_read_struct (PNG_LIBPNG_VER_STRING, (png_voidp)state,
                                     png_read_error_callback, NULL);
   if (!png_ptr) {
     PyErr_SetString(PyExc_MemoryError, "png_create_write_struct() failed");
@@ -284,7 +670,11 @@ load_png_fast_progressive (char *filename,
     goto cleanup;
   }
 
-  png_init_io(png_ptr, fp);
+  if (fp) {
+    png_init_io(png_ptr, fp);
+  } else {
+    png_set_read_fn(png_ptr, state, png_read_from_memory);
+  }
 
   png_read_info(png_ptr, info_ptr);
 
@@ -481,6 +871,7 @@ load_png_fast_progressive (char *filename,
       input_buf_row_pointers[row] = input_buffer + (row * input_buf_row_stride);
     }
 
+    state->thread_state = PyEval_SaveThread();
     png_read_rows(png_ptr, input_buf_row_pointers, NULL, rows);
     rows_left -= rows;
 
@@ -500,6 +891,8 @@ load_png_fast_progressive (char *filename,
         pyarr_row[pyarr_alpha_byte] = input_row[buf_alpha_byte];
       }
     }
+    PyEval_RestoreThread(state->thread_state);
+    state->thread_state = NULL;
 
     free(input_buf_row_pointers);
     free(input_buffer);
@@ -527,3 +920,56 @@ load_png_fast_progressive (char *filename,
 
   return result;
 }
+
+#endif /* #ifndef SWIG */
+
+/** load_png_fast_progressive:
+ *
+ * @filename: filename to load, in the system encoding
+ * @get_buffer_callback: a Python callable returning writeable arrays
+ * returns: a dict of flags describing what was read.
+ *
+ * Read a PNG progressively as 8bit RGBA. The callback must have the signature
+ *
+ *   numpy_array = callback(full_image_width, full_image_height)
+ *
+ * @get_buffer_callback  must return a writeable array of the image width.  If
+ * the height is smaller than the image height, the callback will be called
+ * again until the full image has been processed. The buffer will be written
+ * with 8-bit RGBA data
+ *
+ * In the return dict, a true value for the "possible_legacy_png" key means
+ * that no colour management chunks were found. This *might* be due to the PNG
+ * file being a file written by an old version of MyPaint. Those versions
+ * assumed sRGB in, sRGB out, but also used incorrect nonlinear compositing.
+ * The flag is meaningful in (some) ORA files, not so much when loading a PNG.
+ */
+
+PyObject *
+load_png_fast_progressive (char *filename,
+                           PyObject *get_buffer_callback)
+{
+  PNGReadState state = {NULL, NULL, 0, 0};
+  return png_load_progressive(filename, &state, get_buffer_callback);
+}
+
+/** load_png_fast_from_data:
+ *
+ * Same as load_png_fast_progressive(), but reads the PNG from a string,
+ * e.g. the contents of a zip file entry. Most of the work happens
+ * without holding the GIL, so several PNGs can be decoded in parallel
+ * from Python threads.
+ */
+
+PyObject *
+load_png_fast_from_data (PyObject *data,
+                         PyObject *get_buffer_callback)
+{
+  char *buf;
+  Py_ssize_t size;
+  if (PyString_AsStringAndSize(data, &buf, &size) < 0) {
+    return NULL;
+  }
+  PNGReadState state = {NULL, buf, (size_t)size, 0};
+  return png_load_progressive(NULL, &state, get_buffer_callback);
+}
@@ -8,6 +8,7 @@
 
 import struct
 import zlib
+from collections import OrderedDict
 from numpy import *
 from gettext import gettext as _
 
@@ -16,6 +17,11 @@ import strokemap
 import mypaintlib
 import helpers
 
+N = tiledsurface.N
+
+# Number of composited tiles kept per layer group (32 KiB each).
+GROUP_CACHE_TILES = 512
+
 COMPOSITE_OPS = [
     # (internal-name, display-name, description)
     ("svg:src-over", _("Normal"),
@@ -66,6 +72,10 @@ COMPOSITE_OPS = [
 DEFAULT_COMPOSITE_OP = COMPOSITE_OPS[0][0]
 VALID_COMPOSITE_OPS = set([n for n,d,s in COMPOSITE_OPS])
 
+# strokemap file records: 'b' + brush, 's' + stroke, closed by '}'
+_brush_header = struct.Struct('>I') # length
+_stroke_header = struct.Struct('>II') # brush id, length
+
 class Layer:
     """Representation of a layer in the document model.
 
@@ -87,12 +97,20 @@ class Layer:
         #: with the bounding box of the changed region (x, y, w, h).
         self.content_observers = []
 
+        #: Incremented whenever the contents change. Used to find out
+        #: whether the layer needs to be saved again.
+        self.content_generation = 0
+
+        #: Finds the strokes touching a pixel, see get_stroke_info_at().
+        self._stroke_index = strokemap.StrokeIndex()
+
         # Forward from surface implementation
         self._surface.observers.append(self._notify_content_observers)
 
         self.clear()
 
     def _notify_content_observers(self, *args):
+        self.content_generation += 1
         for f in self.content_observers:
             f(*args)
 
@@ -130,8 +148,19 @@ class Layer:
 
     def clear(self):
         self.strokes = [] # contains StrokeShape instances (not stroke.Stroke)
+        self.__dict__.pop('_lazy_strokemap', None)
         self._surface.clear()
 
+    def __getattr__(self, name):
+        # parses a lazily loaded strokemap, see load_strokemap_from_string()
+        if name == 'strokes':
+            lazy = self.__dict__.pop('_lazy_strokemap', None)
+            if lazy is not None:
+                self.strokes = []
+                self.load_strokemap_from_string(*lazy)
+                return self.strokes
+        raise AttributeError, name
+
     def load_from_surface(self, surface):
         self.strokes = []
         self._surface.load_from_surface(surface)
@@ -159,6 +188,27 @@ class Layer:
             shape.translate(dx, dy)
 
 
+    def transform(self, matrix, filter=mypaintlib.TransformFilterBilinear):
+        """Transform a layer non-interactively.
+
+        The matrix is a (xx, yx, xy, yy, x0, y0) tuple in cairo order.
+        The strokemap cannot be transformed and is discarded.
+        """
+        transform = self.get_transform()
+        transform.update(matrix, filter)
+        transform.process(n=-1)
+        transform.cleanup()
+        self.strokes = []
+
+
+    def get_transform(self):
+        """Get an interactive transformation object for this layer.
+
+        The strokemap must be discarded by the caller once done.
+        """
+        return self._surface.get_transform()
+
+
     def get_move(self, x, y):
         """Get a translation/move object for this layer.
         """
@@ -177,40 +227,63 @@ class Layer:
 
 
     def save_strokemap_to_file(self, f, translate_x, translate_y):
+        if 'strokes' not in self.__dict__:
+            data, x, y, version = self._lazy_strokemap
+            if version >= 3 and x + translate_x == 0 and y + translate_y == 0:
+                # not parsed, so unchanged since loading
+                f.write(data)
+                return
         brush2id = {}
         for stroke in self.strokes:
             s = stroke.brush_string
+            parts = []
             # save brush (if not already known)
             if s not in brush2id:
                 brush2id[s] = len(brush2id)
                 s = zlib.compress(s)
-                f.write('b')
-                f.write(struct.pack('>I', len(s)))
-                f.write(s)
+                parts += ['b', _brush_header.pack(len(s)), s]
             # save stroke
             s = stroke.save_to_string(translate_x, translate_y)
-            f.write('s')
-            f.write(struct.pack('>II', brush2id[stroke.brush_string], len(s)))
-            f.write(s)
+            parts += ['s', _stroke_header.pack(brush2id[stroke.brush_string], len(s)), s]
+            f.write(''.join(parts))
         f.write('}')
 
 
-    def load_strokemap_from_file(self, f, translate_x, translate_y):
+    def load_strokemap_from_file(self, f, translate_x, translate_y, version=3):
+        self.load_strokemap_from_string(f.read(), translate_x, translate_y, version)
+
+
+    def load_strokemap_from_string(self, data, translate_x, translate_y, version=3,
+                                   lazy=False):
+        """Loads a strokemap saved by save_strokemap_to_file()
+
+        The strokes are parsed in place, without copying them out of data.
+        With lazy=True, this only happens when the strokes are first used.
+        """
         assert not self.strokes
+        if lazy:
+            del self.strokes
+            self._lazy_strokemap = (data, translate_x, translate_y, version)
+            return
         brushes = []
+        pos = 0
         while True:
-            t = f.read(1)
+            t = data[pos:pos+1]
+            pos += 1
             if t == 'b':
-                length, = struct.unpack('>I', f.read(4))
-                tmp = f.read(length)
-                brushes.append(zlib.decompress(tmp))
+                length, = _brush_header.unpack_from(data, pos)
+                pos += _brush_header.size
+                brushes.append(zlib.decompress(buffer(data, pos, length)))
+                pos += length
             elif t == 's':
-                brush_id, length = struct.unpack('>II', f.read(2*4))
+                brush_id, length = _stroke_header.unpack_from(data, pos)
+                pos += _stroke_header.size
                 stroke = strokemap.StrokeShape()
-                tmp = f.read(length)
-                stroke.init_from_string(tmp, translate_x, translate_y)
+                stroke.init_from_string(buffer(data, pos, length),
+                                        translate_x, translate_y, version)
                 stroke.brush_string = brushes[brush_id]
                 self.strokes.append(stroke)
+                pos += length
             elif t == '}':
                 break
             else:
@@ -224,6 +297,21 @@ class Layer:
             mode=self.compositeop
             )
 
+    def add_composite_ops(self, ops, tx, ty, mipmap_level=0):
+        """Append what composite_tile() would do to a list of ops.
+
+        The ops are (src, mode, opacity) tuples for
+        mypaintlib.tile_composite_stack().
+        """
+        opacity = self.effective_opacity
+        if opacity == 0.0:
+            return
+        src = self._surface.get_tile_rgba(tx, ty, mipmap_level)
+        if src is None:
+            return
+        mode = tiledsurface.svg2mypaintlibmode[self.compositeop]
+        ops.append((src, mode, opacity))
+
     def merge_into(self, dst):
         """
         Merge this layer into dst, modifying only dst.
@@ -243,6 +331,8 @@ class Layer:
                     opacity=self.effective_opacity,
                     mode=self.compositeop)
         dst.opacity = 1.0
+        bbox = tiledsurface.get_tiles_bbox(dst._surface.get_tiles())
+        dst._surface.notify_observers(*bbox)
 
     def convert_to_normal_mode(self, get_bg):
         """
@@ -269,12 +359,12 @@ class Layer:
 
                 # recalculate layer in normal mode
                 mypaintlib.tile_flat2rgba(dst, bg)
+        bbox = tiledsurface.get_tiles_bbox(self._surface.get_tiles())
+        self._surface.notify_observers(*bbox)
 
     def get_stroke_info_at(self, x, y):
         x, y = int(x), int(y)
-        for s in reversed(self.strokes):
-            if s.touches_pixel(x, y):
-                return s
+        return self._stroke_index.get_stroke_at(self.strokes, x, y)
 
     def get_last_stroke_info(self):
         if not self.strokes:
@@ -289,7 +379,12 @@ class Layer:
 
 class LayerStack(list):
     """Representation of a stack of layers in the document.
-       Can hold nested substacks for grouping layers."""
+       Can hold nested substacks for grouping layers.
+
+    A stack is rendered isolated: its children are composited into a
+    transparent tile first, which is then blended with the stack's own
+    mode and opacity. These tiles are cached, and invalidated through the
+    content observers of the children."""
     
     def __init__(self, doc, parent=None, name=''):
         list.__init__(self)
@@ -301,33 +396,84 @@ class LayerStack(list):
         self.compositeop = DEFAULT_COMPOSITE_OP
         self.name = name
         self.is_stack = True
-    
+
+        #: List of content observers, see Layer.content_observers.
+        #: Changes of the children are forwarded to them.
+        self.content_observers = []
+
+        # (mipmap_level, tx, ty) -> rgba or None, most recently used last
+        self._tile_cache = OrderedDict()
+        self._tile_cache_key = None
+
+    def get_effective_opacity(self):
+        if self.visible:
+            return self.opacity
+        else:
+            return 0.0
+    effective_opacity = property(get_effective_opacity)
+
+    def _child_added(self, item):
+        item.parent = self
+        item.content_observers.append(self._child_modified_cb)
+
+    def _child_removed(self, item):
+        item.parent = None
+        if self._child_modified_cb in item.content_observers:
+            item.content_observers.remove(self._child_modified_cb)
+
+    def _child_modified_cb(self, x, y, w, h):
+        if w == 0 and h == 0:
+            self._tile_cache.clear()
+        else:
+            for key in self._tile_cache.keys():
+                level, tx, ty = key
+                size = N << level
+                if tx*size >= x+w or (tx+1)*size <= x:
+                    continue
+                if ty*size >= y+h or (ty+1)*size <= y:
+                    continue
+                del self._tile_cache[key]
+        for f in self.content_observers:
+            f(x, y, w, h)
+
+    def get_signature(self):
+        """Return a value that changes when the rendering of the children
+        changes for other reasons than their content."""
+        res = []
+        for layer in self:
+            if layer.is_stack:
+                res.append((layer, layer.effective_opacity, layer.compositeop,
+                            layer.get_signature()))
+            else:
+                res.append((layer, layer.effective_opacity, layer.compositeop))
+        return tuple(res)
+
     def get_index(self):
         if not self.parent:
             return None
         return self.parent.index(self)
     
     def append(self, item):
-        item.parent = self
         list.append(self, item)
+        self._child_added(item)
         self.doc.call_doc_observers(("inserted", item))
     
     def remove(self, item):
         self.doc.call_doc_observers(("beforedelete", item))
         list.remove(self, item)
-        item.parent = None
+        self._child_removed(item)
     
     def insert(self, idx, item):
-        item.parent = self
         list.insert(self, idx, item)
+        self._child_added(item)
         self.doc.call_doc_observers(("inserted", item))
         
     def __setitem__(self, idx, value):
         print "SETITEM CALLED!"
         old = self[idx]
         list.__setitem__(self, idx, value)
-        old.parent = None
-        value.parent = self #FIXME: Call doc observers
+        self._child_removed(old)
+        self._child_added(value) #FIXME: Call doc observers
     
     def __eq__(self, other):
         return id(self) == id(other)
@@ -348,10 +494,57 @@ class LayerStack(list):
             else:
                 func(x)
     
-    def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level):
-        if self.visible:
-            for layer in self:
-                 layer.composite_tile(dst, dst_has_alpha, tx, ty, mipmap_level)
+    def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
+        opacity = self.effective_opacity
+        if opacity == 0.0:
+            return
+        src = self.get_tile_rgba(tx, ty, mipmap_level)
+        if src is None:
+            return
+        func = tiledsurface.svg2composite_func[self.compositeop]
+        func(src, dst, dst_has_alpha, opacity)
+
+    def add_composite_ops(self, ops, tx, ty, mipmap_level=0):
+        opacity = self.effective_opacity
+        if opacity == 0.0:
+            return
+        src = self.get_tile_rgba(tx, ty, mipmap_level)
+        if src is None:
+            return
+        mode = tiledsurface.svg2mypaintlibmode[self.compositeop]
+        ops.append((src, mode, opacity))
+
+    def get_tile_rgba(self, tx, ty, mipmap_level=0):
+        """Return the isolated composite of the children, or None if transparent.
+
+        The result is cached and must not be modified. With a single
+        normal child at full opacity it is that child's tile itself, so
+        it is only valid until the children change: don't keep it.
+        """
+        key = self.get_signature()
+        if key != self._tile_cache_key:
+            self._tile_cache.clear()
+            self._tile_cache_key = key
+        pos = (mipmap_level, tx, ty)
+        if pos in self._tile_cache:
+            rgba = self._tile_cache.pop(pos)
+            self._tile_cache[pos] = rgba
+            return rgba
+        ops = []
+        for layer in self.doc.tile_index.filter_layers(self, tx, ty, mipmap_level):
+            layer.add_composite_ops(ops, tx, ty, mipmap_level)
+        if not ops:
+            rgba = None
+        elif len(ops) == 1 and ops[0][1:] == (mypaintlib.BlendingModeNormal, 1.0):
+            # a single child as it is, no need to copy
+            rgba = ops[0][0]
+        else:
+            rgba = empty((N, N, 4), 'uint16')
+            mypaintlib.tile_composite_stack([(rgba, None, ops, True)])
+        self._tile_cache[pos] = rgba
+        while len(self._tile_cache) > GROUP_CACHE_TILES:
+            self._tile_cache.popitem(last=False)
+        return rgba
     
     def get_bbox(self):
         bbox = helpers.Rect()
@@ -34,5 +34,6 @@ PyObject * gdkpixbuf_get_pixels_array(PyObject *pixbuf_pyobject);
 
 %init %{
 import_array();
+init_pixops();
 %}
 
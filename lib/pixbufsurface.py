@@ -8,6 +8,8 @@
 
 import sys
 import contextlib
+import threading
+import Queue
 import numpy
 
 from gi.repository import GdkPixbuf
@@ -112,6 +114,13 @@ class Surface:
 # throttle excesssive calls to the save/render feedback_cb
 TILES_PER_CALLBACK = 256
 
+# zlib compression level for PNG export, from 1 (fastest, larger files)
+# to 9 (slowest, smallest files)
+PNG_COMPRESSION_LEVEL = 2
+
+# number of rendered tile rows that may wait for compression
+PNG_PREFETCH_ROWS = 32
+
 def render_as_pixbuf(surface, *rect, **kwargs):
     alpha = kwargs.get('alpha', False)
     mipmap_level = kwargs.get('mipmap_level', 0)
@@ -120,8 +129,18 @@ def render_as_pixbuf(surface, *rect, **kwargs):
         rect = surface.get_bbox()
     x, y, w, h, = rect
     s = Surface(x, y, w, h)
+    tiles = s.get_tiles()
+    if hasattr(surface, 'blit_tiles_into'):
+        # convert a batch of tiles per call, in parallel
+        for i in xrange(0, len(tiles), TILES_PER_CALLBACK):
+            dst_tiles = [(tx, ty, s.tile_memory_dict[(tx, ty)])
+                         for tx, ty in tiles[i:i+TILES_PER_CALLBACK]]
+            surface.blit_tiles_into(dst_tiles, alpha, mipmap_level=mipmap_level)
+            if feedback_cb:
+                feedback_cb()
+        return s.pixbuf
     tn = 0
-    for tx, ty in s.get_tiles():
+    for tx, ty in tiles:
         with s.tile_request(tx, ty, readonly=False) as dst:
             surface.blit_tile_into(dst, alpha, tx, ty, mipmap_level=mipmap_level)
             if feedback_cb and tn % TILES_PER_CALLBACK == 0:
@@ -133,6 +152,7 @@ def save_as_png(surface, filename, *rect, **kwargs):
     alpha = kwargs['alpha']
     feedback_cb = kwargs.get('feedback_cb', None)
     write_legacy_png = kwargs.get("write_legacy_png", True)
+    compression_level = kwargs.get("compression_level", PNG_COMPRESSION_LEVEL)
     if not rect:
         rect = surface.get_bbox()
     x, y, w, h = rect
@@ -154,8 +174,9 @@ def save_as_png(surface, filename, *rect, **kwargs):
     first_row = render_ty
     last_row = render_ty+render_th-1
 
+    batch = hasattr(surface, 'blit_tiles_into')
+
     def render_tile_scanlines():
-        feedback_counter = 0
         for ty in range(render_ty, render_ty+render_th):
             skip_rendering = False
             if kwargs.get('single_tile_pattern', False):
@@ -163,15 +184,16 @@ def save_as_png(surface, filename, *rect, **kwargs):
                 if ty != first_row:
                     skip_rendering = True
 
-            for tx_rel in xrange(render_tw):
-                # render one tile
-                dst = arr[:,tx_rel*N:(tx_rel+1)*N,:]
-                if not skip_rendering:
-                    surface.blit_tile_into(dst, alpha, render_tx+tx_rel, ty)
-
-                if feedback_cb and feedback_counter % TILES_PER_CALLBACK == 0:
-                    feedback_cb()
-                feedback_counter += 1
+            if not skip_rendering:
+                if batch:
+                    # render the whole tile row in one call
+                    dst_tiles = [(render_tx+tx_rel, ty, arr[:,tx_rel*N:(tx_rel+1)*N,:])
+                                 for tx_rel in xrange(render_tw)]
+                    surface.blit_tiles_into(dst_tiles, alpha)
+                else:
+                    for tx_rel in xrange(render_tw):
+                        dst = arr[:,tx_rel*N:(tx_rel+1)*N,:]
+                        surface.blit_tile_into(dst, alpha, render_tx+tx_rel, ty)
 
             # yield a numpy array of the scanline without padding
             res = arr_xcrop
@@ -179,10 +201,93 @@ def save_as_png(surface, filename, *rect, **kwargs):
                 res = res[:y+h-ty*N,:,:]
             if ty == first_row:
                 res = res[y-render_ty*N:,:,:]
-            yield res
+            # arr is reused for the next row while this one is compressed
+            yield res.copy()
+
+    def write_png(scanlines):
+        if hasattr(filename, 'write'):
+            # file-like object, e.g. a StringIO
+            mypaintlib.write_png_fast_parallel(filename.write, w, h, alpha,
+                                               scanlines,
+                                               write_legacy_png, compression_level)
+        else:
+            filename_sys = filename.encode(sys.getfilesystemencoding())
+            # FIXME: should not do that, should use open(unicode_object)
+            mypaintlib.save_png_fast_parallel(filename_sys, w, h, alpha,
+                                              scanlines,
+                                              write_legacy_png, compression_level)
+
+    # The tile rows are rendered here, on the calling thread, because
+    # rendering reads document state (layer caches, mipmaps, tile
+    # memory) which the GUI may change during feedback_cb. Only the PNG
+    # writer runs in a background thread; it compresses the previous
+    # rows on the other cores (without the GIL) meanwhile.
+    with _background_consumer(write_png, PNG_PREFETCH_ROWS) as put:
+        for res in render_tile_scanlines():
+            put(res)
+            if feedback_cb:
+                feedback_cb()
+
 
-    filename_sys = filename.encode(sys.getfilesystemencoding())
-    # FIXME: should not do that, should use open(unicode_object)
-    mypaintlib.save_png_fast_progressive(filename_sys, w, h, alpha,
-                                         render_tile_scanlines(),
-                                         write_legacy_png)
+@contextlib.contextmanager
+def _background_consumer(consume, size):
+    """Call consume(iterable) in a background thread, feeding it from here.
+
+    Yields a put function which passes one item to the iterable; at most
+    size items wait to be consumed. The iterable ends when the with
+    block is left, and the thread is joined. An exception raised by
+    consume is re-raised by put or at the end of the with block. If the
+    with block raises, the iterable raises too, to stop consume.
+    """
+    queue = Queue.Queue(size)
+    done = threading.Event()
+    failed = [] # exc_info of consume
+    end = object()
+    abort = object()
+
+    def items():
+        while True:
+            item = queue.get()
+            if item is end:
+                return
+            if item is abort:
+                raise RuntimeError('aborted by the producer')
+            yield item
+
+    def run():
+        try:
+            consume(items())
+        except Exception:
+            failed.append(sys.exc_info())
+        finally:
+            done.set()
+
+    def queue_put(item):
+        while not done.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def reraise():
+        if failed:
+            exc_type, exc_value, tb = failed[0]
+            raise exc_type, exc_value, tb
+
+    def put(item):
+        reraise()
+        queue_put(item)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield put
+    except:
+        queue_put(abort)
+        thread.join()
+        raise
+    queue_put(end)
+    thread.join()
+    reraise()
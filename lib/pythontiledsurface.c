@@ -9,10 +9,45 @@
 
 #include "pythontiledsurface.h"
 
+// C-side cache of the tile memory handed out by tiledsurface.py
+//
+// Within an atomic section, the Python tile store (and the copy-on-write and
+// mipmap-dirty bookkeeping it does in _get_tile_numpy) only needs to be
+// consulted once per tile: the first writable request makes a private copy
+// and marks the mipmaps dirty, after which the same memory stays valid until
+// the final end_atomic(). Later requests for the same tile are answered from
+// this table, so the OpenMP tile processing in brushlib does not have to
+// re-enter Python (and serialize on the GIL) for every dab.
+//
+// The cache is emptied when the outermost atomic section ends, and whenever
+// the Python side changes its tile store via invalidate_tile_cache().
+typedef struct {
+    int tx;
+    int ty;
+    uint16_t *buffer;
+    gboolean writable;
+} TileCacheEntry;
+
+static guint
+tile_cache_hash(gconstpointer key)
+{
+    const TileCacheEntry *entry = (const TileCacheEntry *)key;
+    return ((guint)entry->tx * 73856093u) ^ ((guint)entry->ty * 19349663u);
+}
+
+static gboolean
+tile_cache_equal(gconstpointer a, gconstpointer b)
+{
+    const TileCacheEntry *entry_a = (const TileCacheEntry *)a;
+    const TileCacheEntry *entry_b = (const TileCacheEntry *)b;
+    return entry_a->tx == entry_b->tx && entry_a->ty == entry_b->ty;
+}
+
 struct _MyPaintPythonTiledSurface {
     MyPaintTiledSurface parent;
     PyObject * py_obj;
     int atomic;
+    GHashTable *tile_cache; // NULL if disabled
 };
 
 // Forward declare
@@ -37,6 +72,8 @@ MyPaintRectangle *end_atomic(MyPaintSurface *surface)
     self->atomic--;
 
     if (self->atomic == 0) {
+        // Tile memory is only guaranteed to stay valid until here
+        mypaint_python_tiled_surface_invalidate_tile_cache(self);
         if (bbox->width > 0) {
             PyObject* res;
             res = PyObject_CallMethod(self->py_obj, "notify_observers", "(iiii)",
@@ -57,6 +94,25 @@ tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTiledSurfaceTileRe
     const int tx = request->tx;
     const int ty = request->ty;
     PyArrayObject* rgba = NULL;
+    const gboolean use_cache = self->tile_cache && self->atomic > 0;
+
+    if (use_cache) {
+        TileCacheEntry key;
+        key.tx = tx;
+        key.ty = ty;
+        uint16_t *cached = NULL;
+#pragma omp critical (tile_cache)
+{
+        TileCacheEntry *entry = (TileCacheEntry *)g_hash_table_lookup(self->tile_cache, &key);
+        if (entry && (entry->writable || readonly)) {
+            cached = entry->buffer;
+        }
+}
+        if (cached) {
+            request->buffer = cached;
+            return;
+        }
+    }
 
 #pragma omp critical
 {
@@ -83,6 +139,18 @@ tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTiledSurfaceTileRe
     }
 } // #end pragma opt critical
 
+    if (use_cache && request->buffer) {
+        TileCacheEntry *entry = (TileCacheEntry *)malloc(sizeof(TileCacheEntry));
+        entry->tx = tx;
+        entry->ty = ty;
+        entry->buffer = request->buffer;
+        entry->writable = !readonly;
+#pragma omp critical (tile_cache)
+{
+        // replaces (and frees) any readonly entry for the same tile
+        g_hash_table_replace(self->tile_cache, entry, entry);
+}
+    }
 
 }
 
@@ -107,13 +175,35 @@ mypaint_python_tiled_surface_new(PyObject *py_object)
 
     self->py_obj = py_object; // no need to incref
     self->atomic = 0;
+    self->tile_cache = NULL;
 
     return self;
 }
 
+void
+mypaint_python_tiled_surface_set_tile_cache_enabled(MyPaintPythonTiledSurface *self, gboolean enabled)
+{
+    if (enabled && !self->tile_cache) {
+        self->tile_cache = g_hash_table_new_full(tile_cache_hash, tile_cache_equal, NULL, free);
+    }
+    else if (!enabled && self->tile_cache) {
+        g_hash_table_destroy(self->tile_cache);
+        self->tile_cache = NULL;
+    }
+}
+
+void
+mypaint_python_tiled_surface_invalidate_tile_cache(MyPaintPythonTiledSurface *self)
+{
+    if (self->tile_cache) {
+        g_hash_table_remove_all(self->tile_cache);
+    }
+}
+
 void free_tiledsurf(MyPaintSurface *surface)
 {
     MyPaintPythonTiledSurface *self = (MyPaintPythonTiledSurface *)surface;
+    mypaint_python_tiled_surface_set_tile_cache_enabled(self, FALSE);
     mypaint_tiled_surface_destroy(&self->parent);
     free(self);
 }
@@ -12,6 +12,12 @@ typedef struct _MyPaintPythonTiledSurface MyPaintPythonTiledSurface;
 MyPaintPythonTiledSurface *
 mypaint_python_tiled_surface_new(PyObject *py_object);
 
+void
+mypaint_python_tiled_surface_set_tile_cache_enabled(MyPaintPythonTiledSurface *self, gboolean enabled);
+
+void
+mypaint_python_tiled_surface_invalidate_tile_cache(MyPaintPythonTiledSurface *self);
+
 MyPaintSurface *
 mypaint_python_surface_factory(gpointer user_data);
 
@@ -9,91 +9,196 @@
 import time
 import struct
 import zlib
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from numpy import *
 import mypaintlib
 
 import tiledsurface
-import idletask
 
 N = tiledsurface.N
 
+# Number of worker threads computing the shapes of strokes.
+STROKEMAP_THREADS = 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# tile record in saved strokes: tx, ty, length of the mask
+_tile_header = struct.Struct('>iiI')
+
+# Incremented whenever the tiles of an existing StrokeShape change.
+_translations = 0
+
+# size of an uncompressed mask
+MASK_BYTES = N*N/8
+
+# Number of uncompressed masks a StrokeIndex keeps for picking.
+MASK_CACHE_SIZE = 256
+
+
+def pack_bitmap(bitmap):
+    """Returns the 1-bit mask of an (N, N) array, as a string
+
+    Bits are set for nonzero pixels, row by row, the first pixel in the
+    highest bit. The bits are zlib compressed unless that would make
+    them larger, which only happens for very busy masks; the two forms
+    are told apart by their length.
+    """
+    return _compress_mask(packbits(bitmap != 0).tostring())
+
+def _compress_mask(bits):
+    data = zlib.compress(bits)
+    if len(data) < MASK_BYTES:
+        return data
+    return bits
+
+def get_mask_bits(data):
+    """Returns the uncompressed bits of a mask, see pack_bitmap()"""
+    if len(data) == MASK_BYTES:
+        return data
+    return zlib.decompress(data)
+
+def get_mask_bit(data, x, y):
+    """Returns the bit of pixel (x, y) of a mask, see pack_bitmap()
+
+    A compressed mask is only inflated up to the byte of the pixel.
+    """
+    i = (y*N + x) >> 3
+    if len(data) != MASK_BYTES:
+        data = zlib.decompressobj().decompress(data, i+1)
+    return ord(data[i]) >> (7 - (x & 7)) & 1
+
+def unpack_bitmap(data):
+    """Returns the (N, N) uint8 array of a mask, see pack_bitmap()"""
+    bitmap = unpackbits(fromstring(get_mask_bits(data), dtype='uint8'))
+    bitmap.shape = (N, N)
+    return bitmap
+
+def union_bitmaps(a, b):
+    """Returns the union of two masks, see pack_bitmap()"""
+    a = fromstring(get_mask_bits(a), dtype='uint8')
+    b = fromstring(get_mask_bits(b), dtype='uint8')
+    return _compress_mask(bitwise_or(a, b).tostring())
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(STROKEMAP_THREADS)
+        return _pool
+
 
 class StrokeShape:
     """The shape of a single brushstroke.
 
     This class stores the shape of a stroke in as a 1-bit bitmap. The
-    information is stored in compressed memory blocks of the size of a
-    tile (for fast lookup).
+    information is stored in bit-packed, usually zlib compressed blocks
+    of the size of a tile, see pack_bitmap(). Looking up a pixel only
+    inflates its block up to the pixel; StrokeIndex keeps the blocks it
+    tests uncompressed. Tiles with no pixels set are not stored.
+
+    The shape is computed (and translated) by worker threads, which
+    replace the strokemap dict once they are done. Everything reading
+    it calls finish() first.
     """
     def __init__(self):
-        self.tasks = idletask.Processor(max_pending=6)
         self.strokemap = {}
+        self._result = None # AsyncResult of the pending work
+
+    def _start(self, func):
+        self.finish()
+        self._result = _get_pool().apply_async(func)
+
+    def finish(self):
+        """Waits for pending work on the shape."""
+        result, self._result = self._result, None
+        if result is not None:
+            result.get()
 
     def init_from_snapshots(self, snapshot_before, snapshot_after):
         assert not self.strokemap
         # extract the layer from each snapshot
         a, b = snapshot_before.tiledict, snapshot_after.tiledict
         # enumerate all tiles that have changed
-        a_tiles = set(a.iteritems())
-        b_tiles = set(b.iteritems())
-        changes = a_tiles.symmetric_difference(b_tiles)
-        tiles_modified = set([pos for pos, data in changes])
-
-        # for each tile, calculate the exact difference (not now, later, when idle)
-        queue = []
-        for tx, ty in tiles_modified:
-            def work(tx=tx, ty=ty):
+        candidates = tiledsurface.get_snapshot_changes(snapshot_before, snapshot_after)
+        if candidates is not None:
+            tiles_modified = set([pos for pos in candidates if a.get(pos) is not b.get(pos)])
+        else:
+            a_tiles = set(a.iteritems())
+            b_tiles = set(b.iteritems())
+            changes = a_tiles.symmetric_difference(b_tiles)
+            tiles_modified = set([pos for pos, data in changes])
+
+        # for each tile, calculate the exact difference (not now, in a
+        # worker thread; the snapshots don't change)
+        def work():
+            strokemap = {}
+            data = empty((N, N), 'uint8')
+            for tx, ty in tiles_modified:
                 # get the pixel data to compare
                 a_data = a.get((tx, ty), tiledsurface.transparent_tile).rgba
                 b_data = b.get((tx, ty), tiledsurface.transparent_tile).rgba
 
-                data = empty((N, N), 'uint8')
                 mypaintlib.tile_perceptual_change_strokemap(a_data, b_data, data)
 
-                data_compressed = zlib.compress(data.tostring())
-                self.strokemap[tx, ty] = data_compressed
+                if data.any():
+                    strokemap[tx, ty] = pack_bitmap(data)
+            self.strokemap = strokemap
 
-            self.tasks.add_work(work, weight=1.0/len(tiles_modified))
+        if tiles_modified:
+            self._start(work)
 
-    def init_from_string(self, data, translate_x, translate_y):
+    def init_from_string(self, data, translate_x, translate_y, version=3):
+        """Loads the tiles saved by save_to_string()
+
+        The data can also be a buffer, e.g. into a strokemap file.
+        Version 2 strings, with zlib compressed uint8 tiles, are
+        converted.
+        """
         assert not self.strokemap
         assert translate_x % N == 0
         assert translate_y % N == 0
         translate_x /= N
         translate_y /= N
-        while data:
-            tx, ty, size = struct.unpack('>iiI', data[:3*4])
-            compressed_bitmap = data[3*4:size+3*4]
-            self.strokemap[tx + translate_x, ty + translate_y] = compressed_bitmap
-            data = data[size+3*4:]
+        pos = 0
+        while pos < len(data):
+            tx, ty, size = _tile_header.unpack_from(data, pos)
+            pos += _tile_header.size
+            bitmap = data[pos:pos+size]
+            pos += size
+            if version < 3:
+                bitmap = fromstring(zlib.decompress(bitmap), dtype='uint8')
+                if not bitmap.any():
+                    continue
+                bitmap = pack_bitmap(bitmap)
+            self.strokemap[tx + translate_x, ty + translate_y] = bitmap
 
     def save_to_string(self, translate_x, translate_y):
         assert translate_x % N == 0
         assert translate_y % N == 0
         translate_x /= N
         translate_y /= N
-        self.tasks.finish_all()
-        data = ''
-        for (tx, ty), compressed_bitmap in self.strokemap.iteritems():
+        self.finish()
+        parts = []
+        for (tx, ty), bitmap in self.strokemap.iteritems():
             tx, ty = tx + translate_x, ty + translate_y
-            data += struct.pack('>iiI', tx, ty, len(compressed_bitmap))
-            data += compressed_bitmap
-        return data
+            parts.append(_tile_header.pack(tx, ty, len(bitmap)))
+            parts.append(bitmap)
+        return ''.join(parts)
 
     def touches_pixel(self, x, y):
-        self.tasks.finish_all()
+        self.finish()
         data = self.strokemap.get((x/N, y/N))
         if data:
-            data = fromstring(zlib.decompress(data), dtype='uint8')
-            data.shape = (N, N)
-            return data[y%N, x%N]
+            return get_mask_bit(data, x%N, y%N)
 
     def render_overlay(self, layer):
         surf = layer._surface # FIXME: Don't touch inner details of layer
-        self.tasks.finish_all()
+        self.finish()
         for (tx, ty), data in self.strokemap.iteritems():
-            data = fromstring(zlib.decompress(data), dtype='uint8')
-            data.shape = (N, N)
+            data = unpack_bitmap(data)
 
             with surf.tile_request(tx, ty, readonly=False) as rgba:
                 # neutral gray, 50% opaque
@@ -105,40 +210,90 @@ class StrokeShape:
     def translate(self, dx, dy):
         """Translate the shape by (dx, dy).
         """
+        global _translations
         # Finish any previous translations or handling of painted strokes
-        self.tasks.finish_all()
+        self.finish()
+        _translations += 1
         src_strokemap = self.strokemap
-        self.strokemap = {}
         slices_x = tiledsurface.calc_translation_slices(int(dx))
         slices_y = tiledsurface.calc_translation_slices(int(dy))
-        tmp_strokemap = {}
-        is_integral = len(slices_x) == 1 and len(slices_y) == 1
-        for (src_tx, src_ty), src in src_strokemap.iteritems():
-            def __translate_tile(src_tx=src_tx, src_ty=src_ty, src=src):
-                src = fromstring(zlib.decompress(src), dtype='uint8')
-                src.shape = (N, N)
+        if len(slices_x) == 1 and len(slices_y) == 1:
+            # Whole tiles: the masks stay the same.
+            (_, (tdx, _, _)), = slices_x
+            (_, (tdy, _, _)), = slices_y
+            self.strokemap = dict(((tx + tdx, ty + tdy), data)
+                for (tx, ty), data in src_strokemap.iteritems())
+            return
+        def work():
+            strokemap = {}
+            for (src_tx, src_ty), src in src_strokemap.iteritems():
+                src = unpack_bitmap(src)
                 for (src_x0, src_x1), (tmp_tdx, tmp_x0, tmp_x1) in slices_x:
                     for (src_y0, src_y1), (tmp_tdy, tmp_y0, tmp_y1) in slices_y:
-                        tmp_tx = src_tx + tmp_tdx
-                        tmp_ty = src_ty + tmp_tdy
-                        if is_integral:
-                            tmp_strokemap[tmp_tx, tmp_ty] = src
-                        else:
-                            tmp = tmp_strokemap.get((tmp_tx, tmp_ty), None)
-                            if tmp is None:
-                                tmp = zeros((N, N), 'uint8')
-                                tmp_strokemap[tmp_tx, tmp_ty] = tmp
-                            tmp[tmp_y0:tmp_y1, tmp_x0:tmp_x1] \
-                              = src[src_y0:src_y1, src_x0:src_x1]
-            self.tasks.add_work(__translate_tile, weight=0.1/len(src_strokemap))
-        # Recompression of any tile can only start after all the above is
-        # complete. Luckily the idle-processor does things in order.
-        def __start_tile_recompression():
-            for (tx, ty), data in tmp_strokemap.iteritems():
-                def __recompress_tile(tx=tx, ty=ty, data=data):
-                    if not data.any():
-                        return
-                    data_compressed = zlib.compress(data.tostring())
-                    self.strokemap[tx, ty] = data_compressed
-                self.tasks.add_work(__recompress_tile, weight=0.1/len(tmp_strokemap))
-        self.tasks.add_work(__start_tile_recompression, weight=0)
+                        part = src[src_y0:src_y1, src_x0:src_x1]
+                        if not part.any():
+                            continue
+                        tmp = zeros((N, N), 'uint8')
+                        tmp[tmp_y0:tmp_y1, tmp_x0:tmp_x1] = part
+                        tmp = pack_bitmap(tmp)
+                        pos = (src_tx + tmp_tdx, src_ty + tmp_tdy)
+                        if pos in strokemap:
+                            tmp = union_bitmaps(strokemap[pos], tmp)
+                        strokemap[pos] = tmp
+            self.strokemap = strokemap
+        self._start(work)
+
+
+class StrokeIndex:
+    """Finds the strokes of a layer which touch a pixel.
+
+    For each tile, the index keeps the strokes of the list that have a
+    bitmap there, so picking only tests the strokes which can actually
+    touch the pixel. The index follows changes of the list it was used
+    with: strokes appended to it are indexed as they come, anything
+    else (a new list, translated strokes) rebuilds it.
+
+    The most recently tested masks are kept uncompressed, so repeated
+    picks around the same spot do not decompress them again.
+    """
+
+    def __init__(self):
+        self._strokes = None
+        self._count = 0
+        self._translations = None
+        self._tiles = {} # (tx, ty) -> [StrokeShape], oldest first
+        self._bits = OrderedDict() # (id(shape), tx, ty) -> mask bits
+
+    def _update(self, strokes):
+        if strokes is not self._strokes or len(strokes) < self._count \
+                or self._translations != _translations:
+            self._strokes = strokes
+            self._count = 0
+            self._tiles = {}
+            self._bits.clear()
+        for shape in strokes[self._count:]:
+            shape.finish()
+            for pos in shape.strokemap:
+                self._tiles.setdefault(pos, []).append(shape)
+        self._count = len(strokes)
+        self._translations = _translations
+
+    def get_stroke_at(self, strokes, x, y):
+        """Returns the topmost stroke of the list touching a pixel"""
+        self._update(strokes)
+        tx, ty = x/N, y/N
+        for shape in reversed(self._tiles.get((tx, ty), ())):
+            if get_mask_bit(self._get_bits(shape, tx, ty), x%N, y%N):
+                return shape
+
+    def _get_bits(self, shape, tx, ty):
+        # The indexed shapes are alive and unchanged until the next
+        # rebuild, which empties the cache, so their ids are unique.
+        key = (id(shape), tx, ty)
+        bits = self._bits.pop(key, None)
+        if bits is None:
+            bits = get_mask_bits(shape.strokemap[tx, ty])
+            while len(self._bits) >= MASK_CACHE_SIZE:
+                self._bits.popitem(last=False)
+        self._bits[key] = bits
+        return bits
@@ -31,6 +31,18 @@ public:
       mypaint_surface_unref((MyPaintSurface *)c_surface);
   }
 
+  // Enables the C-side cache of tile memory, so repeated tile requests
+  // within an atomic section don't call back into _get_tile_numpy().
+  void set_tile_cache_enabled(bool enabled) {
+    mypaint_python_tiled_surface_set_tile_cache_enabled(c_surface, enabled);
+  }
+
+  // Must be called when the Python tile store changes during an atomic
+  // section by other means than _get_tile_numpy().
+  void invalidate_tile_cache() {
+    mypaint_python_tiled_surface_invalidate_tile_cache(c_surface);
+  }
+
   void set_symmetry_state(bool active, float center_x) {
     mypaint_tiled_surface_set_symmetry_state((MyPaintTiledSurface *)c_surface, active, center_x);
   }
@@ -15,6 +15,14 @@ import sys
 import os
 import contextlib
 import functools
+import weakref
+import zlib
+import struct
+import hashlib
+import threading
+import tempfile
+import mmap
+from collections import OrderedDict
 
 import mypaintlib
 import helpers
@@ -24,22 +32,387 @@ TILE_SIZE = N = mypaintlib.TILE_SIZE
 MAX_MIPMAP_LEVEL = 4
 
 use_gegl = True if os.environ.get('MYPAINT_ENABLE_GEGL', 0) else False
+use_tile_cache = False if os.environ.get('MYPAINT_DISABLE_TILE_CACHE', 0) else True
+# memory for uncompressed tiles in MiB, 0 means unlimited
+tile_memory_budget_mb = int(os.environ.get('MYPAINT_TILE_MEMORY_BUDGET_MB', 0))
+# directory for a swap file receiving cold tiles (default budget: 1 GiB)
+tile_swap_dir = os.environ.get('MYPAINT_TILE_SWAP_DIR', None)
 
 from layer import DEFAULT_COMPOSITE_OP
 
 import pixbufsurface
 
+from gi.repository import GObject
+
+
+class TileSwapFile:
+    """Memory-mapped temporary file holding the pixels of cold tiles.
+
+    The file is divided into slots of one uncompressed tile each. Freed
+    slots are reused; the file grows as needed and is deleted when
+    closed (or when the process exits).
+    """
+
+    SLOT_SIZE = N*N*4*2
+    GROW_SLOTS = 1024
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(prefix='mypaint-swap-', dir=directory)
+        self._map = None
+        self._slots = 0
+        self._free = []
+
+    def _grow(self):
+        slots = self._slots + max(self.GROW_SLOTS, self._slots)
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(slots * self.SLOT_SIZE)
+        self._map = mmap.mmap(self._file.fileno(), slots * self.SLOT_SIZE)
+        self._free.extend(reversed(xrange(self._slots, slots)))
+        self._slots = slots
+
+    def write(self, rgba):
+        """Stores the pixels of a tile, returns the slot"""
+        if not self._free:
+            self._grow()
+        slot = self._free.pop()
+        offset = slot * self.SLOT_SIZE
+        self._map[offset:offset+self.SLOT_SIZE] = rgba.tostring()
+        return slot
+
+    def read(self, slot):
+        offset = slot * self.SLOT_SIZE
+        rgba = fromstring(self._map[offset:offset+self.SLOT_SIZE], 'uint16')
+        return rgba.reshape((N, N, 4))
+
+    def free(self, slot):
+        self._free.append(slot)
+
+    def get_size(self):
+        return self._slots * self.SLOT_SIZE
+
+    def get_used(self):
+        return (self._slots - len(self._free)) * self.SLOT_SIZE
+
+
+class TileMemory:
+    """Moves the least recently used tiles out of memory when over budget.
+
+    Uncompressed tiles are kept in LRU order. When their total size
+    exceeds the budget, the coldest ones are zlib compressed, or written
+    to a TileSwapFile if one is set, while the application is idle (never
+    from inside an atomic section, where brushlib may still hold pointers
+    to tile memory). Accessing Tile.rgba transparently loads the tile
+    again.
+    """
+
+    # time to spend compressing per idle callback
+    IDLE_SLICE = 0.01
+    TILE_BYTES = N*N*4*2
+
+    def __init__(self, budget=0, swap=None):
+        self.budget = budget # bytes, 0 means unlimited
+        self.swap = swap # TileSwapFile, or None to compress in memory
+        self._lru = OrderedDict() # id(tile) -> weakref, uncompressed tiles
+        # cold tiles: id(tile) -> (weakref, compressed size, None)
+        #                    or (weakref, slot, TileSwapFile)
+        self._cold = {}
+        self._mapped = set() # ids of cold tiles with data in a mapped file
+        self._dead = [] # ids of garbage collected tiles, see _cleanup()
+        self._lock = threading.RLock()
+        self._idle_scheduled = False
+        self._atomic = 0 # surfaces inside begin_atomic()/end_atomic()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.compressions = 0
+
+    def set_budget(self, budget):
+        with self._lock:
+            self.budget = budget
+            self._schedule()
+
+    def set_swap(self, swap):
+        """Use a TileSwapFile for tiles evicted from now on"""
+        with self._lock:
+            self.swap = swap
+
+    def touch(self, tile):
+        """Record an access to the uncompressed tile"""
+        if not self.budget or tile.pinned:
+            return
+        key = id(tile)
+        with self._lock:
+            self._cleanup()
+            self.hits += 1
+            ref = self._lru.pop(key, None)
+            if ref is None:
+                ref = weakref.ref(tile, functools.partial(self._tile_died, key))
+                self.raw_bytes += self.TILE_BYTES
+                self._schedule()
+            self._lru[key] = ref
+
+    def load(self, tile):
+        """Bring back the pixels of a cold tile"""
+        with self._lock:
+            self._cleanup()
+            if tile._rgba is not None:
+                # another thread was faster
+                return tile._rgba
+            key = id(tile)
+            if key not in self._cold:
+                raise AttributeError, 'rgba'
+            self.misses += 1
+            ref, size, swap = self._cold.pop(key)
+            if swap is not None:
+                rgba = swap.read(size)
+                swap.free(size)
+            else:
+                rgba = fromstring(zlib.decompress(tile._compressed), 'uint16')
+                rgba = rgba.reshape((N, N, 4))
+                tile._compressed = None
+                self._mapped.discard(key)
+                self.compressed_bytes -= size
+            tile._rgba = rgba
+            self.raw_bytes += self.TILE_BYTES
+            self._lru[key] = ref
+            self._schedule()
+            return rgba
+
+    def add_compressed(self, tile, data, mapped=False):
+        """Track a new tile whose pixels are only available compressed
+
+        With mapped=True, data is a buffer into a memory mapped file. It
+        does not count towards compressed_bytes until copied by unmap().
+        """
+        with self._lock:
+            self._cleanup()
+            key = id(tile)
+            ref = weakref.ref(tile, functools.partial(self._tile_died, key))
+            tile._rgba = None
+            tile._compressed = data
+            if mapped:
+                self._mapped.add(key)
+                size = 0
+            else:
+                size = len(data)
+            self.compressed_bytes += size
+            self._cold[key] = (ref, size, None)
+
+    def unmap(self, tile):
+        """Copy the compressed data of a tile out of its mapped file"""
+        with self._lock:
+            self._cleanup()
+            key = id(tile)
+            if key not in self._mapped:
+                return # not mapped, or already decompressed
+            self._mapped.remove(key)
+            tile._compressed = str(tile._compressed)
+            ref, size, swap = self._cold[key]
+            size = len(tile._compressed)
+            self.compressed_bytes += size
+            self._cold[key] = (ref, size, swap)
+
+    def forget(self, tile):
+        """Stop tracking a tile whose pixel memory gets replaced"""
+        with self._lock:
+            self._cleanup()
+            self._remove(id(tile))
+            tile._compressed = None
+
+    def _tile_died(self, key, ref):
+        # Can be called by the garbage collector in the middle of
+        # modifying the OrderedDict, so only take a note.
+        self._dead.append(key)
+
+    def _cleanup(self):
+        while self._dead:
+            self._remove(self._dead.pop())
+
+    def _remove(self, key):
+        self._mapped.discard(key)
+        if self._lru.pop(key, None) is not None:
+            self.raw_bytes -= self.TILE_BYTES
+        entry = self._cold.pop(key, None)
+        if entry is not None:
+            ref, size, swap = entry
+            if swap is not None:
+                swap.free(size)
+            else:
+                self.compressed_bytes -= size
+
+    def begin_atomic(self):
+        """Called when a surface starts an atomic section.
+
+        Until it ends, brushlib may hold pointers to the pixels of any
+        tile, so none are compressed.
+        """
+        with self._lock:
+            self._atomic += 1
+
+    def end_atomic(self):
+        with self._lock:
+            self._atomic -= 1
+            if not self._atomic:
+                self._schedule()
+
+    def _schedule(self):
+        if self.budget and self.raw_bytes > self.budget and not self._idle_scheduled:
+            self._idle_scheduled = True
+            GObject.idle_add(self._idle_cb)
+
+    def _idle_cb(self):
+        with self._lock:
+            more = self.compress_cold_tiles(time.time() + self.IDLE_SLICE)
+            if not more or self._atomic:
+                # rescheduled by end_atomic()
+                self._idle_scheduled = False
+                return False
+            return True
+
+    def compress_cold_tiles(self, deadline=None):
+        """Evict the coldest tiles from memory until the budget is met.
+
+        Does nothing while brushlib is working on a surface, i.e. inside
+        begin_atomic()/end_atomic(). Returns True if there is more work
+        to do after the deadline.
+        """
+        with self._lock:
+            self._cleanup()
+            in_use = []
+            while not self._atomic and self.budget and self.raw_bytes > self.budget and self._lru:
+                if deadline is not None and time.time() > deadline:
+                    break
+                key, ref = self._lru.popitem(last=False)
+                tile = ref()
+                if tile is None:
+                    self.raw_bytes -= self.TILE_BYTES
+                    continue
+                rgba = tile._rgba
+                # Somebody else still holds the pixel memory? (references:
+                # the tile, the local variable and the getrefcount argument)
+                if sys.getrefcount(rgba) > 3:
+                    in_use.append((key, ref))
+                    continue
+                if self.swap is not None:
+                    slot = self.swap.write(rgba)
+                    self._cold[key] = (ref, slot, self.swap)
+                else:
+                    data = zlib.compress(rgba.tostring(), 1)
+                    tile._compressed = data
+                    self.compressed_bytes += len(data)
+                    self._cold[key] = (ref, len(data), None)
+                tile._rgba = None
+                del rgba
+                self.raw_bytes -= self.TILE_BYTES
+                self.compressions += 1
+            for key, ref in in_use:
+                self._lru[key] = ref
+            over_budget = self.budget and self.raw_bytes > self.budget
+            return bool(over_budget and len(self._lru) > len(in_use))
+
+    def get_stats(self):
+        with self._lock:
+            self._cleanup()
+            accesses = self.hits + self.misses
+            swapped = [e for e in self._cold.itervalues() if e[2] is not None]
+            return {
+                'budget': self.budget,
+                'raw_tiles': len(self._lru),
+                'raw_bytes': self.raw_bytes,
+                'compressed_tiles': len(self._cold) - len(swapped),
+                'compressed_bytes': self.compressed_bytes,
+                'swapped_tiles': len(swapped),
+                'swap_file_size': self.swap.get_size() if self.swap else 0,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits)/accesses if accesses else 1.0,
+                'compressions': self.compressions,
+                }
+
+tile_memory = TileMemory(tile_memory_budget_mb * 1024 * 1024)
+if tile_swap_dir:
+    if not tile_memory.budget:
+        tile_memory.set_budget(1024 * 1024 * 1024)
+    tile_memory.set_swap(TileSwapFile(tile_swap_dir))
+
+def set_tile_memory_budget(budget):
+    """Sets the memory for uncompressed tiles in bytes (0: unlimited)"""
+    tile_memory.set_budget(budget)
+
+def set_tile_swap_dir(directory):
+    """Swap cold tiles to a file in directory instead of compressing them
+
+    Use None to keep cold tiles compressed in memory again.
+    """
+    swap = None
+    if directory is not None:
+        swap = TileSwapFile(directory)
+    tile_memory.set_swap(swap)
+
+def get_tile_memory_stats():
+    """Returns a dict with memory usage and hit/miss counts"""
+    return tile_memory.get_stats()
+
+
+class Tile(object):
+    # never compressed, the pixel memory is compared by identity
+    pinned = False
+    # color of a shared uniform tile, see get_uniform_tile()
+    uniform = None
 
-class Tile:
     def __init__(self, copy_from=None):
         # note: pixels are stored with premultiplied alpha
         #       15bits are used, but fully opaque or white is stored as 2**15 (requiring 16 bits)
         #       This is to allow many calcuations to divide by 2**15 instead of (2**16-1)
+        self._compressed = None # zlib'd pixels while the tile is cold
         if copy_from is None:
-            self.rgba = zeros((N, N, 4), 'uint16')
+            self._rgba = zeros((N, N, 4), 'uint16')
         else:
-            self.rgba = copy_from.rgba.copy()
+            self._rgba = copy_from.rgba.copy()
         self.readonly = False
+        tile_memory.touch(self)
+
+    def _get_rgba(self):
+        rgba = self._rgba
+        if rgba is None:
+            return tile_memory.load(self)
+        tile_memory.touch(self)
+        return rgba
+
+    def _set_rgba(self, rgba):
+        tile_memory.forget(self)
+        self._rgba = rgba
+        tile_memory.touch(self)
+
+    def _del_rgba(self):
+        tile_memory.forget(self)
+        self._rgba = None
+
+    rgba = property(_get_rgba, _set_rgba, _del_rgba)
+
+    @classmethod
+    def from_compressed(cls, data, mapped=False):
+        """New tile from zlib compressed pixels, see get_compressed()
+
+        The pixels are decompressed when they are first accessed. See
+        TileMemory.add_compressed() for mapped.
+        """
+        t = cls.__new__(cls)
+        t.readonly = False
+        tile_memory.add_compressed(t, data, mapped)
+        return t
+
+    def get_compressed(self):
+        """Returns the zlib compressed pixels (native byte order)
+
+        Cold tiles already have them, see TileMemory.
+        """
+        data = self._compressed
+        if data is None:
+            data = zlib.compress(self.rgba.tostring(), 1)
+        return data
 
     def copy(self):
         return Tile(copy_from=self)
@@ -71,11 +444,50 @@ for svg_id, mode_enum in svg2mypaintlibmode.iteritems():
 
 # tile for read-only operations on empty spots
 transparent_tile = Tile()
+tile_memory.forget(transparent_tile)
+transparent_tile.pinned = True
 transparent_tile.readonly = True
 
 # tile with invalid pixel memory (needs refresh)
 mipmap_dirty_tile = Tile()
 del mipmap_dirty_tile.rgba
+mipmap_dirty_tile.pinned = True
+
+# Guards the mipmap_dirty_tile entries of all surfaces; mipmaps are also
+# regenerated by worker threads, e.g. when saving.
+_mipmap_lock = threading.RLock()
+
+# shared readonly tiles for uniformly colored areas, by color and pixel memory
+uniform_tiles = weakref.WeakValueDictionary()
+_uniform_tiles_by_data = weakref.WeakValueDictionary()
+
+def get_uniform_tile(color):
+    """Returns the shared readonly tile filled with a single color.
+
+    The color is a premultiplied fix15 (r, g, b, a) tuple. Like
+    transparent_tile (which is returned for an all-zero color) the
+    tile is replaced by a private copy on the first write.
+    """
+    if not any(color):
+        return transparent_tile
+    t = uniform_tiles.get(color)
+    if t is None:
+        t = Tile()
+        tile_memory.forget(t)
+        t.pinned = True
+        t.rgba[:,:] = color
+        t.readonly = True
+        t.uniform = color
+        t.rgba8_cache = {}
+        uniform_tiles[color] = t
+        _uniform_tiles_by_data[id(t.rgba)] = t
+    return t
+
+def _get_uniform_tile_by_data(rgba):
+    t = _uniform_tiles_by_data.get(id(rgba))
+    if t is not None and t.rgba is rgba:
+        return t
+    return None
 
 def get_tiles_bbox(tiles):
     res = helpers.Rect()
@@ -83,8 +495,47 @@ def get_tiles_bbox(tiles):
         res.expandToIncludeRect(helpers.Rect(N*tx, N*ty, N, N))
     return res
 
+def has_tiledict(surface):
+    """Whether a surface has a tiledict, without triggering a lazy load.
+
+    False for GEGL surfaces, and for surfaces which are waiting for a
+    lazy PNG load (see MyPaintSurface.load_from_png_data).
+    """
+    return 'tiledict' in surface.__dict__
+
 class SurfaceSnapshot:
-    pass
+    # Positions which may differ from the previous snapshot of the same
+    # surface (None: unknown), and a weakref to that previous snapshot.
+    changed = None
+    prev = None
+
+# how many snapshots get_snapshot_changes() will walk back
+MAX_SNAPSHOT_CHAIN = 32
+
+def get_snapshot_changes(a, b):
+    """Positions of the tiles which may differ between two snapshots.
+
+    Uses the dirty journals recorded by MyPaintSurface.save_snapshot(),
+    so the cost is proportional to the number of tiles that were
+    modified, not to the size of the layer. Returns None if the two
+    snapshots are not closely related; the caller has to compare the
+    full tiledicts in that case.
+    """
+    if a is b:
+        return set()
+    for newer, older in [(a, b), (b, a)]:
+        changes = set()
+        sshot = newer
+        for i in xrange(MAX_SNAPSHOT_CHAIN):
+            if sshot.changed is None or sshot.prev is None:
+                break
+            changes.update(sshot.changed)
+            sshot = sshot.prev()
+            if sshot is older:
+                return changes
+            if sshot is None:
+                break
+    return None
 
 if use_gegl:
 
@@ -111,6 +562,16 @@ if use_gegl:
         def load_from_png(self, path, x, y, *args, **kwargs):
             return self.load_from_png_c(str(path))
 
+        def load_from_png_data(self, data, x, y, *args, **kwargs):
+            # GEGL can only load from files
+            fd, path = tempfile.mkstemp('.png')
+            try:
+                os.write(fd, data)
+                os.close(fd)
+                return self.load_from_png(path, x, y)
+            finally:
+                os.remove(path)
+
         def save_snapshot(self):
             sshot = SurfaceSnapshot()
             sshot.tiledict = {}
@@ -146,7 +607,20 @@ class MyPaintSurface(mypaintlib.TiledSurface):
     def __init__(self, mipmap_level=0, looped=False, looped_size=(0,0)):
         mypaintlib.TiledSurface.__init__(self, self)
         self.tiledict = {}
+        self._lazy_png = None # see load_from_png_data()
         self.observers = []
+        self._mipmap_dirty = set() # positions of mipmap_dirty_tile
+
+        # Dirty journal: positions written since the last snapshot was
+        # saved or loaded (None: unknown, e.g. after bulk operations).
+        # Tiles not in the journal are known to be readonly.
+        self._journal = None
+        self._snapshot = None # weakref to the last snapshot
+
+        # Let the C++ half remember tile memory for the duration of an
+        # atomic section (see pythontiledsurface.c). The tiledict stays
+        # the authoritative tile store.
+        self.set_tile_cache_enabled(use_tile_cache)
 
         # Used to implement repeating surfaces, like Background
         if looped_size[0] % N or looped_size[1] % N:
@@ -162,13 +636,27 @@ class MyPaintSurface(mypaintlib.TiledSurface):
             self.mipmap = Surface(mipmap_level+1)
             self.mipmap.parent = self
 
+    def begin_atomic(self):
+        tile_memory.begin_atomic()
+        mypaintlib.TiledSurface.begin_atomic(self)
+
+    def end_atomic(self):
+        try:
+            return mypaintlib.TiledSurface.end_atomic(self)
+        finally:
+            tile_memory.end_atomic()
+
     def notify_observers(self, *args):
         for f in self.observers:
             f(*args)
 
     def clear(self):
         tiles = self.tiledict.keys()
-        self.tiledict = {}
+        with _mipmap_lock:
+            self.tiledict = {}
+            self._mipmap_dirty = set()
+        self.invalidate_tile_cache()
+        self._journal = None
         self.notify_observers(*get_tiles_bbox(tiles))
         if self.mipmap: self.mipmap.clear()
 
@@ -193,73 +681,152 @@ class MyPaintSurface(mypaintlib.TiledSurface):
             ty = ty % (self.looped_size[1] / N)
 
         t = self.tiledict.get((tx, ty))
+        if t is mipmap_dirty_tile:
+            # regenerate this mipmap tile (batches of tiles are updated
+            # up front with update_mipmap_tiles())
+            self._update_mipmap_tiles([(tx, ty)])
+            t = self.tiledict.get((tx, ty))
         if t is None:
             if readonly:
                 t = transparent_tile
             else:
                 t = Tile()
                 self.tiledict[(tx, ty)] = t
-        if t is mipmap_dirty_tile:
-            # regenerate mipmap
-            t = Tile()
-            self.tiledict[(tx, ty)] = t
-            empty = True
-            for x in xrange(2):
-                for y in xrange(2):
-                    with self.parent.tile_request(tx*2 + x, ty*2 + y, True) as src:
-                        mypaintlib.tile_downscale_rgba16(src, t.rgba, x*N/2, y*N/2)
-                        if src is not transparent_tile.rgba:
-                            empty = False
-            if empty:
-                # rare case, no need to speed it up
-                del self.tiledict[(tx, ty)]
-                t = transparent_tile
         if t.readonly and not readonly:
             # shared memory, get a private copy for writing
             t = t.copy()
             self.tiledict[(tx, ty)] = t
         if not readonly:
             # assert self.mipmap_level == 0
+            if self._journal is not None:
+                self._journal.add((tx, ty))
             self._mark_mipmap_dirty(tx, ty)
         return t.rgba
 
     def _set_tile_numpy(self, tx, ty, obj, readonly):
         pass # Data can be modified directly, no action needed
 
+    def update_mipmap_tiles(self, positions, mipmap_level):
+        """Regenerate the outdated tiles at positions of a mipmap level.
+
+        Tiles are also regenerated when they are requested. This only
+        does it for many tiles in one batch, e.g. before rendering.
+        """
+        surface = self
+        while surface.mipmap_level < mipmap_level and surface.mipmap:
+            surface = surface.mipmap
+        if surface.mipmap_level > 0:
+            surface._update_mipmap_tiles(positions)
+
+    def _update_mipmap_tiles(self, positions=None):
+        """Regenerate outdated mipmap tiles from the parent level.
+
+        All tiles are downscaled in a single C call, which runs in
+        parallel and without the GIL. Limited to the given positions
+        if specified.
+        """
+        with _mipmap_lock:
+            if positions is None:
+                dirty = self._mipmap_dirty
+                self._mipmap_dirty = set()
+            else:
+                dirty = self._mipmap_dirty.intersection(positions)
+                self._mipmap_dirty.difference_update(dirty)
+            dirty = [pos for pos in dirty if self.tiledict.get(pos) is mipmap_dirty_tile]
+            if not dirty:
+                return
+
+            parent = self.parent
+            if parent.mipmap_level > 0:
+                # the source tiles must be up to date first
+                needed = set()
+                for tx, ty in dirty:
+                    for x in xrange(2):
+                        for y in xrange(2):
+                            needed.add((tx*2 + x, ty*2 + y))
+                parent._update_mipmap_tiles(needed)
+
+            jobs = []
+            tiles = []
+            for tx, ty in dirty:
+                t = None
+                for x in xrange(2):
+                    for y in xrange(2):
+                        src = parent.tiledict.get((tx*2 + x, ty*2 + y))
+                        if src is None or src is transparent_tile:
+                            continue # the quarter stays transparent
+                        if t is None:
+                            t = Tile()
+                        jobs.append((src.rgba, t.rgba, x*N/2, y*N/2))
+                tiles.append(((tx, ty), t))
+            mypaintlib.tile_downscale_rgba16_batch(jobs)
+            # publish the tiles only once they are complete
+            for pos, t in tiles:
+                if t is None:
+                    del self.tiledict[pos]
+                else:
+                    self.tiledict[pos] = t
+
     def _mark_mipmap_dirty(self, tx, ty):
-        if self.mipmap_level > 0:
-            self.tiledict[(tx, ty)] = mipmap_dirty_tile
-        if self.mipmap:
-            self.mipmap._mark_mipmap_dirty(tx/2, ty/2)
+        with _mipmap_lock:
+            if self.mipmap_level > 0:
+                self.tiledict[(tx, ty)] = mipmap_dirty_tile
+                self._mipmap_dirty.add((tx, ty))
+            if self.mipmap:
+                self.mipmap._mark_mipmap_dirty(tx/2, ty/2)
 
     def blit_tile_into(self, dst, dst_has_alpha, tx, ty, mipmap_level=0):
         # used mainly for saving (transparent PNG)
+        self.blit_tiles_into([(tx, ty, dst)], dst_has_alpha, mipmap_level)
 
-        #assert dst_has_alpha is True
+    def blit_tiles_into(self, dst_tiles, dst_has_alpha, mipmap_level=0):
+        """Copy a list of (tx, ty, dst) tiles of this surface into NumPy arrays.
 
+        Conversions to 8 bit are collected and done in one call, in
+        parallel and without holding the GIL.
+        """
         if self.mipmap_level < mipmap_level:
-            return self.mipmap.blit_tile_into(dst, dst_has_alpha, tx, ty, mipmap_level)
-
-        assert dst.shape[2] == 4
-
-        with self.tile_request(tx, ty, readonly=True) as src:
-
-            if src is transparent_tile.rgba:
-                #dst[:] = 0 # <-- notably slower than memset()
-                mypaintlib.tile_clear(dst)
-            else:
-
-                if dst.dtype == 'uint16':
+            return self.mipmap.blit_tiles_into(dst_tiles, dst_has_alpha, mipmap_level)
+        if self.mipmap_level > 0:
+            self._update_mipmap_tiles([(tx, ty) for tx, ty, dst in dst_tiles])
+
+        convert_jobs = []
+        for tx, ty, dst in dst_tiles:
+            assert dst.shape[2] == 4
+            with self.tile_request(tx, ty, readonly=True) as src:
+
+                if src is transparent_tile.rgba:
+                    #dst[:] = 0 # <-- notably slower than memset()
+                    mypaintlib.tile_clear(dst)
+                    continue
+                uniform_tile = None
+                if dst.dtype == 'uint8':
+                    uniform_tile = _get_uniform_tile_by_data(src)
+                if uniform_tile is not None:
+                    # the converted pixels are the same for every use
+                    # (including the dithering noise), only convert once
+                    cache = uniform_tile.rgba8_cache
+                    converted = cache.get(dst_has_alpha)
+                    if converted is None:
+                        converted = empty((N, N, 4), 'uint8')
+                        if dst_has_alpha:
+                            mypaintlib.tile_convert_rgba16_to_rgba8(src, converted)
+                        else:
+                            mypaintlib.tile_convert_rgbu16_to_rgbu8(src, converted)
+                        cache[dst_has_alpha] = converted
+                    dst[:,:,:] = converted
+                elif dst.dtype == 'uint16':
                     # this will do memcpy, not worth to bother skipping the u channel
                     mypaintlib.tile_copy_rgba16_into_rgba16(src, dst)
                 elif dst.dtype == 'uint8':
-                    if dst_has_alpha:
-                        mypaintlib.tile_convert_rgba16_to_rgba8(src, dst)
-                    else:
-                        mypaintlib.tile_convert_rgbu16_to_rgbu8(src, dst)
+                    # the tile data is only read, so it stays valid
+                    # after the request has ended
+                    convert_jobs.append((src, dst))
                 else:
                     raise ValueError, 'Unsupported destination buffer type'
 
+        mypaintlib.tile_convert_rgba16_to_rgba8_batch(convert_jobs, dst_has_alpha)
+
     def composite_tile(self, dst, dst_has_alpha, tx, ty, mipmap_level=0, opacity=1.0,
                        mode=DEFAULT_COMPOSITE_OP):
         """Composite one tile of this surface over a NumPy array.
@@ -272,44 +839,122 @@ class MyPaintSurface(mypaintlib.TiledSurface):
             return
 
         with self.tile_request(tx, ty, readonly=True) as src:
+            if src is transparent_tile.rgba:
+                return
+            if mode == DEFAULT_COMPOSITE_OP and opacity == 1.0:
+                uniform_tile = _get_uniform_tile_by_data(src)
+                if uniform_tile is not None and uniform_tile.uniform[3] == 1<<15:
+                    # opaque normal blending, the result is just the source
+                    mypaintlib.tile_copy_rgba16_into_rgba16(src, dst)
+                    return
             func = svg2composite_func[mode]
             func(src, dst, dst_has_alpha, opacity)
 
+    def get_tile_rgba(self, tx, ty, mipmap_level=0):
+        """Return the RGBA data of a tile for reading, or None if transparent.
+
+        Used to hand many tiles over to mypaintlib.tile_composite_stack().
+        """
+        if self.mipmap_level < mipmap_level:
+            return self.mipmap.get_tile_rgba(tx, ty, mipmap_level)
+        if not self.looped and (tx, ty) not in self.tiledict:
+            return None
+        with self.tile_request(tx, ty, readonly=True) as src:
+            if src is transparent_tile.rgba:
+                return None
+            return src
+
     def save_snapshot(self):
+        prev = self._snapshot and self._snapshot()
+        # cached writable tile memory is about to be shared with the snapshot
+        self.invalidate_tile_cache()
+        if prev is not None and self._journal is not None:
+            if not self._journal:
+                # nothing was written since, happens once per stroke
+                return prev
+            # only the tiles written since the last snapshot can be writable
+            self._deduplicate_tiles(self._journal)
+            for pos in self._journal:
+                t = self.tiledict.get(pos)
+                if t is not None:
+                    t.readonly = True
+        else:
+            prev = None
+            self._deduplicate_tiles(self.tiledict.keys())
+            for t in self.tiledict.itervalues():
+                t.readonly = True
         sshot = SurfaceSnapshot()
-        for t in self.tiledict.itervalues():
-            t.readonly = True
         sshot.tiledict = self.tiledict.copy()
+        if prev is not None:
+            sshot.changed = frozenset(self._journal)
+            sshot.prev = weakref.ref(prev)
+        self._snapshot = weakref.ref(sshot)
+        self._journal = set()
         return sshot
 
     def load_snapshot(self, sshot):
-        self._load_tiledict(sshot.tiledict)
-
-    def _load_tiledict(self, d):
-        if d == self.tiledict:
-            # common case optimization, called from split_stroke() via stroke.redo()
-            # testcase: comparison above (if equal) takes 0.6ms, code below 30ms
-            return
-        old = set(self.tiledict.iteritems())
-        self.tiledict = d.copy()
-        new = set(self.tiledict.iteritems())
-        dirty = old.symmetric_difference(new)
-        for pos, tile in dirty:
+        dirty = None
+        current = self._snapshot and self._snapshot()
+        if current is not None and self._journal is not None:
+            dirty = get_snapshot_changes(current, sshot)
+            if dirty is not None:
+                dirty.update(self._journal)
+        self._load_tiledict(sshot.tiledict, dirty)
+        # all tiles of a snapshot are readonly
+        self._snapshot = weakref.ref(sshot)
+        self._journal = set()
+
+    def _load_tiledict(self, d, dirty=None):
+        """Replace the tiledict with a copy of d.
+
+        If the positions which may have changed are known (dirty), only
+        those are compared.
+        """
+        if dirty is not None:
+            old = self.tiledict
+            self.tiledict = d.copy()
+            dirty = [pos for pos in dirty if old.get(pos) is not d.get(pos)]
+        else:
+            if d == self.tiledict:
+                # common case optimization, called from split_stroke() via stroke.redo()
+                # testcase: comparison above (if equal) takes 0.6ms, code below 30ms
+                return
+            old = set(self.tiledict.iteritems())
+            self.tiledict = d.copy()
+            new = set(self.tiledict.iteritems())
+            dirty = [pos for (pos, tile) in old.symmetric_difference(new)]
+        self.invalidate_tile_cache()
+        self._journal = None
+        for pos in dirty:
             self._mark_mipmap_dirty(*pos)
-        bbox = get_tiles_bbox([pos for (pos, tile) in dirty])
+        bbox = get_tiles_bbox(dirty)
         if not bbox.empty():
             self.notify_observers(*bbox)
 
+    def _deduplicate_tiles(self, positions):
+        """Replace uniformly colored tiles by shared readonly ones."""
+        for pos in positions:
+            t = self.tiledict.get(pos)
+            if t is None or t.pinned:
+                continue
+            rgba = t.rgba
+            if mypaintlib.tile_is_uniform_rgba16(rgba):
+                color = tuple([int(c) for c in rgba[0, 0]])
+                self.tiledict[pos] = get_uniform_tile(color)
+
     def load_from_surface(self, other):
         self.load_snapshot(other.save_snapshot())
 
     def _load_from_pixbufsurface(self, s):
         dirty_tiles = set(self.tiledict.keys())
         self.tiledict = {}
+        self.invalidate_tile_cache()
+        self._journal = None
 
         for tx, ty in s.get_tiles():
             with self.tile_request(tx, ty, readonly=False) as dst:
                 s.blit_tile_into(dst, True, tx, ty)
+        self._deduplicate_tiles(self.tiledict.keys())
 
         dirty_tiles.update(self.tiledict.keys())
         bbox = get_tiles_bbox(dirty_tiles)
@@ -331,6 +976,8 @@ class MyPaintSurface(mypaintlib.TiledSurface):
                 for tx in range(w/N):
                     with self.tile_request(tx, ty, readonly=False) as dst:
                         dst[:,:,:] = arr[ty*N:(ty+1)*N, tx*N:(tx+1)*N, :]
+            self._deduplicate_tiles(self.tiledict.keys())
+            self.notify_observers(x, y, w, h)
         else:
             raise ValueError
 
@@ -339,8 +986,46 @@ class MyPaintSurface(mypaintlib.TiledSurface):
     def load_from_png(self, filename, x, y, feedback_cb=None):
         """Load from a PNG, one tilerow at a time, discarding empty tiles.
         """
+        filename_sys = filename.encode(sys.getfilesystemencoding()) # FIXME: should not do that, should use open(unicode_object)
+        load = functools.partial(mypaintlib.load_png_fast_progressive, filename_sys)
+        return self._load_png(load, x, y, feedback_cb)
+
+    def load_from_png_data(self, data, x, y, feedback_cb=None, lazy=False):
+        """Load from the contents of a PNG file, e.g. read from a zip file.
+
+        Decoding and conversion run without holding the GIL, so several
+        surfaces can be loaded from threads in parallel. With lazy=True
+        only the PNG header is read now; the image is decoded when the
+        tiles are first accessed, usually when the layer is first
+        rendered. Returns the bbox of the image, like load_from_png().
+        """
+        if not lazy:
+            load = functools.partial(mypaintlib.load_png_fast_from_data, data)
+            return self._load_png(load, x, y, feedback_cb)
+
+        loader = _LazyPNG(self, data, x, y)
+        self.clear()
+        s = self
+        while s is not None:
+            del s.tiledict # the next access will load it, see __getattr__
+            s._lazy_png = loader
+            s = s.mipmap
+        self.notify_observers(*loader.get_bbox())
+        return loader.frame_size
+
+    def __getattr__(self, name):
+        if name == 'tiledict':
+            loader = self.__dict__.get('_lazy_png')
+            if loader is not None:
+                loader.load()
+                return self.__dict__['tiledict']
+        return mypaintlib.TiledSurface.__getattr__(self, name)
+
+    def _load_png(self, load, x, y, feedback_cb):
         dirty_tiles = set(self.tiledict.keys())
         self.tiledict = {}
+        self.invalidate_tile_cache()
+        self._journal = None
 
         state = {}
         state['buf'] = None # array of height N, width depends on image
@@ -379,17 +1064,20 @@ class MyPaintSurface(mypaintlib.TiledSurface):
 
         def consume_buf():
             ty = state['ty']-1
+            jobs = []
             for i in xrange(state['buf'].shape[1]/N):
                 tx = x/N + i
                 src = state['buf'][:,i*N:(i+1)*N,:]
                 if src[:,:,3].any():
                     with self.tile_request(tx, ty, readonly=False) as dst:
-                        mypaintlib.tile_convert_rgba8_to_rgba16(src, dst)
+                        jobs.append((src, dst))
+            # convert the whole tile row at once, without the GIL
+            mypaintlib.tile_convert_rgba8_to_rgba16_batch(jobs)
 
-        filename_sys = filename.encode(sys.getfilesystemencoding()) # FIXME: should not do that, should use open(unicode_object)
-        flags = mypaintlib.load_png_fast_progressive(filename_sys, get_buffer)
+        flags = load(get_buffer)
         consume_buf() # also process the final chunk of data
         print flags
+        self._deduplicate_tiles(self.tiledict.keys())
 
         dirty_tiles.update(self.tiledict.keys())
         bbox = get_tiles_bbox(dirty_tiles)
@@ -419,9 +1107,13 @@ class MyPaintSurface(mypaintlib.TiledSurface):
         return self.tiledict
 
     def get_bbox(self):
+        if self._lazy_png is not None and not has_tiledict(self):
+            return self._lazy_png.get_bbox()
         return get_tiles_bbox(self.tiledict)
 
     def is_empty(self):
+        if self._lazy_png is not None and not has_tiledict(self):
+            return False
         return not self.tiledict
 
     def remove_empty_tiles(self):
@@ -429,10 +1121,86 @@ class MyPaintSurface(mypaintlib.TiledSurface):
         for pos, data in self.tiledict.items():
             if not data.rgba.any():
                 self.tiledict.pop(pos)
+        self.invalidate_tile_cache()
+        self._journal = None
 
     def get_move(self, x, y):
         return _InteractiveMove(self, x, y)
 
+    def get_transform(self):
+        return _InteractiveTransform(self)
+
+
+_main_thread = threading.current_thread()
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+class _LazyPNG:
+    """PNG data which is decoded into a surface on the first tile access.
+
+    Shared by all mipmap levels of the surface. While it is pending the
+    levels have no tiledict attribute (so that the access goes through
+    MyPaintSurface.__getattr__), and assigning a new tiledict to the
+    surface cancels it.
+    """
+
+    def __init__(self, surface, data, x, y):
+        self.surface = surface
+        self.data = data
+        self.x, self.y = x, y
+        # the IHDR chunk always comes first; anything else is rejected
+        # now, like the eager loader would, not on the first tile access
+        if data[:8] != PNG_SIGNATURE or data[12:16] != 'IHDR' or len(data) < 24:
+            raise RuntimeError, 'Error reading PNG: not a PNG file'
+        w, h = struct.unpack('>II', data[16:24])
+        self.frame_size = (x, y, w, h)
+        self.lock = threading.Lock()
+
+    def get_bbox(self):
+        x, y, w, h = self.frame_size
+        if w <= 0 or h <= 0:
+            return helpers.Rect()
+        return get_tiles_bbox([(x/N, y/N), ((x+w-1)/N, (y+h-1)/N)])
+
+    def load(self):
+        # Other threads (e.g. a background save) wait until the tiles
+        # are complete; they are published only after decoding.
+        with self.lock:
+            top = self.surface
+            if top._lazy_png is not self:
+                return # already loaded
+            tiledict = None
+            if not has_tiledict(top):
+                t0 = time.time()
+                tmp = MyPaintSurface()
+                tmp.load_from_png_data(self.data, self.x, self.y)
+                tiledict = tmp.tiledict
+                print '  %.3fs lazy loading layer png' % (time.time() - t0)
+            s = top.mipmap
+            while s is not None:
+                if not has_tiledict(s):
+                    s.tiledict = {}
+                s._lazy_png = None
+                s = s.mipmap
+            self.data = None
+            if tiledict is not None:
+                top.invalidate_tile_cache()
+                top._journal = None
+                for tx, ty in tiledict:
+                    top._mark_mipmap_dirty(tx, ty)
+                top.tiledict = tiledict
+            top._lazy_png = None
+        if tiledict is not None:
+            bbox = get_tiles_bbox(tiledict)
+            if threading.current_thread() is _main_thread:
+                top.notify_observers(*bbox)
+            else:
+                # observers may update the GUI
+                def notify_cb():
+                    top.notify_observers(*bbox)
+                    return False
+                GObject.idle_add(notify_cb)
+
 
 class _InteractiveMove:
 
@@ -448,10 +1216,20 @@ class _InteractiveMove:
         euclidean = lambda p: math.sqrt((tx - p[0])**2 + (ty - p[1])**2)
         self.chunks.sort(key=manhattan)
         self.chunks_i = 0
+        self.written = set()
+
+    @property
+    def progress(self):
+        """Fraction of the current update which has been processed"""
+        if not self.chunks:
+            return 1.0
+        return min(1.0, float(self.chunks_i) / len(self.chunks))
 
     def update(self, dx, dy):
         # Tiles to be blanked at the end of processing
         self.blanked = set(self.surface.tiledict.keys())
+        # Tiles written since the update, checked for emptiness in cleanup()
+        self.written = set()
         # Calculate offsets
         self.slices_x = calc_translation_slices(int(dx))
         self.slices_y = calc_translation_slices(int(dy))
@@ -459,13 +1237,22 @@ class _InteractiveMove:
 
     def cleanup(self):
         # called at the end of each set of processing batches
+        surface = self.surface
         for b in self.blanked:
-            self.surface.tiledict.pop(b, None)
-            self.surface._mark_mipmap_dirty(*b)
+            surface.tiledict.pop(b, None)
+            surface._mark_mipmap_dirty(*b)
+        # Remove empty tiles created by the move. Only the written tiles
+        # need to be checked, the others are from the (clean) snapshot.
+        surface._deduplicate_tiles(self.written)
+        for pos in self.written:
+            if surface.tiledict.get(pos) is transparent_tile:
+                del surface.tiledict[pos]
+                self.blanked.add(pos)
+        self.written = set()
+        surface.invalidate_tile_cache()
+        surface._journal = None
         bbox = get_tiles_bbox(self.blanked)
-        self.surface.notify_observers(*bbox)
-        # Remove empty tile created by Layer Move
-        self.surface.remove_empty_tiles()
+        surface.notify_observers(*bbox)
 
     def process(self, n=200):
         if self.chunks_i > len(self.chunks):
@@ -473,34 +1260,232 @@ class _InteractiveMove:
         written = set()
         if n <= 0:
             n = len(self.chunks)  # process all remaining
+        surface = self.surface
+        tiledict = surface.tiledict
+        is_integral = len(self.slices_x) == 1 and len(self.slices_y) == 1
+        jobs = []
         for tile_pos in self.chunks[self.chunks_i : self.chunks_i + n]:
             src_tx, src_ty = tile_pos
             src_tile = self.snapshot.tiledict[(src_tx, src_ty)]
-            is_integral = len(self.slices_x) == 1 and len(self.slices_y) == 1
+            if is_integral:
+                # snapshot tiles are readonly, so they can be shared
+                (src_x0, src_x1), (targ_tdx, targ_x0, targ_x1) = self.slices_x[0]
+                (src_y0, src_y1), (targ_tdy, targ_y0, targ_y1) = self.slices_y[0]
+                targ_pos = (src_tx + targ_tdx, src_ty + targ_tdy)
+                tiledict[targ_pos] = src_tile
+                self.blanked.discard(targ_pos)
+                written.add(targ_pos)
+                continue
+            src_rgba = src_tile.rgba
             for (src_x0, src_x1), (targ_tdx, targ_x0, targ_x1) in self.slices_x:
                 for (src_y0, src_y1), (targ_tdy, targ_y0, targ_y1) in self.slices_y:
-                    targ_tx = src_tx + targ_tdx
-                    targ_ty = src_ty + targ_tdy
-                    if is_integral:
-                        self.surface.tiledict[(targ_tx, targ_ty)] = src_tile.copy()
+                    targ_pos = (src_tx + targ_tdx, src_ty + targ_tdy)
+                    targ_tile = None
+                    if targ_pos in self.blanked:
+                        self.blanked.remove(targ_pos)
                     else:
-                        targ_tile = None
-                        if (targ_tx, targ_ty) in self.blanked:
-                            targ_tile = Tile()
-                            self.surface.tiledict[(targ_tx, targ_ty)] = targ_tile
-                            self.blanked.remove( (targ_tx, targ_ty) )
-                        else:
-                            targ_tile = self.surface.tiledict.get((targ_tx, targ_ty), None)
-                        if targ_tile is None:
-                            targ_tile = Tile()
-                            self.surface.tiledict[(targ_tx, targ_ty)] = targ_tile
-                        targ_tile.rgba[targ_y0:targ_y1, targ_x0:targ_x1] = src_tile.rgba[src_y0:src_y1, src_x0:src_x1]
-                    written.add((targ_tx, targ_ty))
-        self.blanked -= written
+                        targ_tile = tiledict.get(targ_pos, None)
+                    if targ_tile is None:
+                        targ_tile = Tile()
+                        tiledict[targ_pos] = targ_tile
+                    jobs.append((src_rgba, targ_tile.rgba, src_x0, src_y0,
+                                 targ_x0, targ_y0, src_x1-src_x0, src_y1-src_y0))
+                    written.add(targ_pos)
+        # all pixel copies of this batch in one go
+        mypaintlib.tile_copy_rgba16_rects(jobs)
+        self.written.update(written)
         for pos in written:
-            self.surface._mark_mipmap_dirty(*pos)
+            surface._mark_mipmap_dirty(*pos)
+        surface.invalidate_tile_cache()
+        surface._journal = None
         bbox = get_tiles_bbox(written) # hopefully relatively contiguous
-        self.surface.notify_observers(*bbox)
+        surface.notify_observers(*bbox)
+        self.chunks_i += n
+        return self.chunks_i < len(self.chunks)
+
+
+class _InteractiveTransform:
+    """Affine transformation of a surface, processed in batches.
+
+    Used like _InteractiveMove: update() starts rendering a new matrix,
+    process() renders some destination tiles, cleanup() removes what is
+    left over from the previous matrix. Only destination tiles covered
+    by the transformed source tiles are rendered. Each one is resampled
+    from a buffer gathered from the source tiles it needs.
+    """
+
+    def __init__(self, surface):
+        self.surface = surface
+        self.snapshot = surface.save_snapshot()
+        # private copy of the untransformed surface, with its own mipmaps
+        self.source = MyPaintSurface()
+        self.source.load_snapshot(self.snapshot)
+        self.chunks = []
+        self.chunks_i = 0
+        self.blanked = set()
+        self.written = set()
+
+    @property
+    def progress(self):
+        """Fraction of the current update which has been processed"""
+        if not self.chunks:
+            return 1.0
+        return min(1.0, float(self.chunks_i) / len(self.chunks))
+
+    def update(self, matrix, filter=mypaintlib.TransformFilterBilinear, preview=False):
+        """Start rendering a new transformation.
+
+        The matrix is a (xx, yx, xy, yy, x0, y0) tuple in cairo order. In
+        preview mode, the source is taken from a mipmap level matching
+        the scale, using nearest neighbour sampling.
+        """
+        xx, yx, xy, yy, x0, y0 = [float(m) for m in matrix]
+        det = xx*yy - xy*yx
+        if abs(det) < 1e-9:
+            raise ValueError, 'Transformation matrix is not invertible'
+        ixx, ixy, iyx, iyy = yy/det, -xy/det, -yx/det, xx/det
+        self.inverse = (ixx, iyx, ixy, iyy,
+                        -(ixx*x0 + ixy*y0), -(iyx*x0 + iyy*y0))
+
+        # Pick a mipmap level so that the remaining downscaling is small
+        # (below 2 for the real filters, below 1 for the preview).
+        stretch = math.sqrt(1.0/abs(det)) # source pixels per pixel
+        level = 0
+        if preview:
+            filter = mypaintlib.TransformFilterNearest
+            if stretch > 1:
+                level = int(math.ceil(math.log(stretch, 2)))
+        elif stretch >= 2:
+            level = int(math.floor(math.log(stretch, 2)))
+        level = min(level, MAX_MIPMAP_LEVEL)
+        source = self.source
+        for i in xrange(level):
+            source = source.mipmap
+        if level > 0:
+            source._update_mipmap_tiles()
+        self.level = level
+        self.filter = filter
+        self.src_tiles = source.tiledict
+
+        # Source pixels needed around the sampled position, along each
+        # source axis (u, v). Lanczos is widened by the stretch along
+        # that axis, like tile_affine_transform_rgba16() does.
+        scale = 2**level
+        if filter == mypaintlib.TransformFilterNearest:
+            self.margin = (1, 1)
+        elif filter == mypaintlib.TransformFilterBilinear:
+            self.margin = (2, 2)
+        else:
+            stretch_u = max(1.0, math.hypot(ixx, ixy) / scale)
+            stretch_v = max(1.0, math.hypot(iyx, iyy) / scale)
+            self.margin = (int(math.ceil(3 * stretch_u)) + 2,
+                           int(math.ceil(3 * stretch_v)) + 2)
+
+        # destination tiles covered by the transformed source tiles,
+        # grown by the margin on each axis (the reach of the filter)
+        margin_u, margin_v = self.margin
+        dst = set()
+        for (tx, ty), tile in self.src_tiles.iteritems():
+            if tile is transparent_tile:
+                continue
+            xs = []
+            ys = []
+            for px in [(tx*N - margin_u)*scale, ((tx+1)*N + margin_u)*scale]:
+                for py in [(ty*N - margin_v)*scale, ((ty+1)*N + margin_v)*scale]:
+                    xs.append(xx*px + xy*py + x0)
+                    ys.append(yx*px + yy*py + y0)
+            dtx0 = int(math.floor(min(xs))) // N
+            dtx1 = int(math.ceil(max(xs))) // N
+            dty0 = int(math.floor(min(ys))) // N
+            dty1 = int(math.ceil(max(ys))) // N
+            for dtx in xrange(dtx0, dtx1 + 1):
+                for dty in xrange(dty0, dty1 + 1):
+                    dst.add((dtx, dty))
+        self.chunks = sorted(dst, key=lambda (tx, ty): (ty, tx))
+        self.chunks_i = 0
+        self.blanked = set(self.surface.tiledict.keys())
+        self.written = set()
+
+    def _render_tile(self, tx, ty):
+        ixx, iyx, ixy, iyy, ix0, iy0 = self.inverse
+        scale = float(2**self.level)
+        margin_u, margin_v = self.margin
+        # inverse mapping of the destination tile corners
+        dst_x0, dst_y0 = tx*N, ty*N
+        us = []
+        vs = []
+        for px in [dst_x0, dst_x0+N]:
+            for py in [dst_y0, dst_y0+N]:
+                us.append((ixx*px + ixy*py + ix0) / scale)
+                vs.append((iyx*px + iyy*py + iy0) / scale)
+        src_x0 = int(math.floor(min(us))) - margin_u
+        src_y0 = int(math.floor(min(vs))) - margin_v
+        src_x1 = int(math.ceil(max(us))) + margin_u
+        src_y1 = int(math.ceil(max(vs))) + margin_v
+
+        # gather the source pixels
+        buf = None
+        for src_ty in xrange(src_y0//N, (src_y1-1)//N + 1):
+            for src_tx in xrange(src_x0//N, (src_x1-1)//N + 1):
+                tile = self.src_tiles.get((src_tx, src_ty))
+                if tile is None or tile is transparent_tile:
+                    continue
+                if buf is None:
+                    buf = zeros((src_y1-src_y0, src_x1-src_x0, 4), 'uint16')
+                x0 = max(src_x0, src_tx*N)
+                x1 = min(src_x1, (src_tx+1)*N)
+                y0 = max(src_y0, src_ty*N)
+                y1 = min(src_y1, (src_ty+1)*N)
+                buf[y0-src_y0:y1-src_y0, x0-src_x0:x1-src_x0] = \
+                    tile.rgba[y0-src_ty*N:y1-src_ty*N, x0-src_tx*N:x1-src_tx*N]
+        if buf is None:
+            return None
+
+        # matrix from destination tile pixels to buffer pixels
+        c0 = (ixx*dst_x0 + ixy*dst_y0 + ix0) / scale - src_x0
+        c1 = (iyx*dst_x0 + iyy*dst_y0 + iy0) / scale - src_y0
+        tile = Tile()
+        mypaintlib.tile_affine_transform_rgba16(self.filter, buf, tile.rgba,
+                                                ixx/scale, iyx/scale,
+                                                ixy/scale, iyy/scale, c0, c1)
+        rgba = tile.rgba
+        if mypaintlib.tile_is_uniform_rgba16(rgba) and not rgba[0, 0].any():
+            return None
+        return tile
+
+    def cleanup(self):
+        # called at the end of each set of processing batches
+        surface = self.surface
+        for b in self.blanked:
+            surface.tiledict.pop(b, None)
+            surface._mark_mipmap_dirty(*b)
+        surface._deduplicate_tiles(self.written)
+        self.written = set()
+        surface.invalidate_tile_cache()
+        surface._journal = None
+        bbox = get_tiles_bbox(self.blanked)
+        surface.notify_observers(*bbox)
+
+    def process(self, n=20):
+        if self.chunks_i > len(self.chunks):
+            return False
+        if n <= 0:
+            n = len(self.chunks)  # process all remaining
+        surface = self.surface
+        processed = self.chunks[self.chunks_i : self.chunks_i + n]
+        for pos in processed:
+            tile = self._render_tile(*pos)
+            if tile is None:
+                continue # stays blanked, or gets removed in cleanup()
+            surface.tiledict[pos] = tile
+            self.blanked.discard(pos)
+            self.written.add(pos)
+        for pos in processed:
+            surface._mark_mipmap_dirty(*pos)
+        surface.invalidate_tile_cache()
+        surface._journal = None
+        bbox = get_tiles_bbox(processed)
+        surface.notify_observers(*bbox)
         self.chunks_i += n
         return self.chunks_i < len(self.chunks)
 
@@ -534,32 +1519,71 @@ def new_surface():
 class BackgroundError(Exception):
     pass
 
+# Tiles of all mipmap levels of the background patterns, by content.
+# They are readonly and shared by all Background surfaces with the same
+# pattern (documents, scratchpad, previews). The most recently used
+# ones are kept even while no Background uses them.
+_background_levels = weakref.WeakValueDictionary()
+_recent_background_levels = OrderedDict()
+BACKGROUND_CACHE_SIZE = 4
+
+class _BackgroundLevels(list):
+    """The tiledicts of the mipmap levels of a background pattern"""
+    size = (N, N) # of the pattern, (width, height)
+
+def get_background_levels(obj):
+    """Returns the cached _BackgroundLevels of a pattern (uint8 or uint16)"""
+    key = (obj.dtype.str, obj.shape, hashlib.sha1(obj.tostring()).digest())
+    levels = _background_levels.get(key)
+    if levels is None:
+        levels = _BackgroundLevels()
+        height, width = obj.shape[0:2]
+        levels.size = (width, height)
+        for mipmap_level in xrange(MAX_MIPMAP_LEVEL+2):
+            if mipmap_level > 0:
+                # every level has the size of the pattern, so it covers
+                # twice the area of the previous one in each direction
+                obj = numpy.zeros((height, width, 4), dtype='uint16')
+                for ty in range(height/N*2):
+                    for tx in range(width/N*2):
+                        with s.tile_request(tx, ty, readonly=True) as src:
+                            mypaintlib.tile_downscale_rgba16(src, obj, tx*N/2, ty*N/2)
+            s = MyPaintSurface(looped=True, looped_size=(width, height))
+            s.load_from_numpy(obj, 0, 0)
+            for t in s.tiledict.itervalues():
+                t.readonly = True
+            levels.append(s.tiledict)
+        _background_levels[key] = levels
+    _recent_background_levels.pop(key, None)
+    _recent_background_levels[key] = levels
+    while len(_recent_background_levels) > BACKGROUND_CACHE_SIZE:
+        _recent_background_levels.popitem(last=False)
+    return levels
+
 class Background(Surface):
     """ """
 
-    def __init__(self, obj, mipmap_level=0):
+    def __init__(self, obj, mipmap_level=0, levels=None):
 
-        if not isinstance(obj, numpy.ndarray):
-            r, g, b = obj
-            obj = numpy.zeros((N, N, 3), dtype='uint8')
-            obj[:,:,:] = r, g, b
+        if levels is None:
+            if not isinstance(obj, numpy.ndarray):
+                r, g, b = obj
+                obj = numpy.zeros((N, N, 3), dtype='uint8')
+                obj[:,:,:] = r, g, b
 
-        height, width = obj.shape[0:2]
-        if height % N or width % N:
-            raise BackgroundError, 'unsupported background tile size: %dx%d' % (width, height)
+            height, width = obj.shape[0:2]
+            if height % N or width % N:
+                raise BackgroundError, 'unsupported background tile size: %dx%d' % (width, height)
+            levels = get_background_levels(obj)
+        width, height = levels.size
 
-        Surface.__init__(self, mipmap_level=0,
+        # (no plain mipmap surfaces, they get replaced below)
+        Surface.__init__(self, mipmap_level=MAX_MIPMAP_LEVEL,
                                       looped=True, looped_size=(width, height))
-        self.load_from_numpy(obj, 0, 0)
+        self.mipmap_level = mipmap_level
+        self._levels = levels # keeps the cache entry alive
+        self.tiledict = levels[mipmap_level].copy()
 
-        # Generate mipmap
         if mipmap_level <= MAX_MIPMAP_LEVEL:
-            mipmap_obj = numpy.zeros((height, width, 4), dtype='uint16')
-            for ty in range(height/N*2):
-                for tx in range(width/N*2):
-                    with self.tile_request(tx, ty, readonly=True) as src:
-                        mypaintlib.tile_downscale_rgba16(src, mipmap_obj, tx*N/2, ty*N/2)
-
-            self.mipmap = Background(mipmap_obj, mipmap_level+1)
+            self.mipmap = Background(None, mipmap_level+1, levels)
             self.mipmap.parent = self
-            self.mipmap_level = mipmap_level
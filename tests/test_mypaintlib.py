@@ -83,6 +83,69 @@ def layerModes():
                 assert not errors.any()
         print 'passed'
 
+def simdKernels():
+    # the instruction set specific kernels give exactly the same results
+    N = mypaintlib.TILE_SIZE
+    src = zeros((N, N, 4), 'uint16')
+    src[:,:,3] = random.randint(0, (1<<15)+1, (N, N))
+    src[::3,:,3] = 0
+    src[::5,:,3] = 1<<15
+    for c in range(3):
+        src[:,:,c] = (src[:,:,3] * random.random((N, N))).astype('uint16')
+    backdrop = src[::-1,::-1].copy()
+
+    def results():
+        res = []
+        for mode in tiledsurface.svg2mypaintlibmode.values():
+            for dst_has_alpha in [False, True]:
+                for opacity in [1.0, 0.7, 0.01]:
+                    dst = backdrop.copy()
+                    mypaintlib.tile_composite(mode, src, dst, dst_has_alpha, opacity)
+                    res.append(dst)
+        dst = zeros((N, N, 4), 'uint8')
+        mypaintlib.tile_convert_rgba16_to_rgba8(src, dst)
+        res.append(dst.copy())
+        mypaintlib.tile_convert_rgbu16_to_rgbu8(src, dst)
+        res.append(dst.copy())
+        return res
+
+    variant = mypaintlib.set_simd_enabled(False)
+    assert variant == 'generic'
+    expected = results()
+    try:
+        for variant in ['sse2', 'avx2']:
+            if mypaintlib.set_simd_variant(variant) != variant:
+                print variant, 'kernels not supported'
+                continue
+            print 'comparing', variant, 'kernels to the generic ones'
+            for a, b in zip(results(), expected):
+                assert (a == b).all()
+    finally:
+        variant = mypaintlib.set_simd_enabled(True)
+    print 'using', variant, 'kernels'
+
+def tileConversionBatch():
+    # the batch conversion gives the same (dithered) result as one call per tile
+    N = mypaintlib.TILE_SIZE
+    srcs = []
+    for i in range(10):
+        src = zeros((N, N, 4), 'uint16')
+        src[:,:,3] = random.randint(0, (1<<15)+1, (N, N))
+        for c in range(3):
+            src[:,:,c] = (src[:,:,3] * random.random((N, N))).astype('uint16')
+        srcs.append(src)
+    for dst_has_alpha in [False, True]:
+        dst = zeros((N, len(srcs)*N, 4), 'uint8')
+        jobs = [(src, dst[:,i*N:(i+1)*N,:]) for i, src in enumerate(srcs)]
+        mypaintlib.tile_convert_rgba16_to_rgba8_batch(jobs, dst_has_alpha)
+        for src, batch_dst in jobs:
+            expected = zeros((N, N, 4), 'uint8')
+            if dst_has_alpha:
+                mypaintlib.tile_convert_rgba16_to_rgba8(src, expected)
+            else:
+                mypaintlib.tile_convert_rgbu16_to_rgbu8(src, expected)
+            assert (batch_dst == expected).all()
+
 def directPaint():
 
     s = tiledsurface.Surface()
@@ -96,6 +159,625 @@ def directPaint():
     s.end_atomic()
     s.save_as_png('test_directPaint.png')
 
+def pngCompressionLevels():
+    # the compression level only changes the file size, not the pixels
+    s = tiledsurface.Surface()
+    s.load_from_png('test_directPaint.png', 0, 0)
+    loaded = []
+    sizes = []
+    for level in [0, 1, 9]:
+        filename = 'test_pngCompressionLevel%d.png' % level
+        s.save_as_png(filename, compression_level=level)
+        sizes.append(os.path.getsize(filename))
+        s2 = tiledsurface.Surface()
+        s2.load_from_png(filename, 0, 0)
+        loaded.append(s2)
+    for s2 in loaded[1:]:
+        assert set(s2.tiledict) == set(loaded[0].tiledict)
+        for pos, tile in s2.tiledict.iteritems():
+            assert (tile.rgba == loaded[0].tiledict[pos].rgba).all()
+    print 'PNG sizes at compression levels 0, 1, 9:', sizes
+    assert sizes[0] > sizes[1] >= sizes[2]
+
+def tileCache():
+    # painting through the C-side tile cache must give the same result as
+    # asking tiledsurface.py for every single tile request
+    events = loadtxt('painting30sec.dat')
+    surfaces = []
+    for enabled in [True, False]:
+        s = tiledsurface.Surface()
+        s.set_tile_cache_enabled(enabled)
+        s.begin_atomic()
+        for t, x, y, pressure in events:
+            r = g = b = 0.5*(1.0+sin(t))
+            s.draw_dab(x, y, 12, r, g, b, pressure, 0.6)
+        s.end_atomic()
+        surfaces.append(s)
+    a, b = surfaces
+    assert set(a.tiledict.keys()) == set(b.tiledict.keys())
+    for pos, tile in a.tiledict.iteritems():
+        assert (tile.rgba == b.tiledict[pos].rgba).all()
+
+def snapshotJournal():
+    # snapshots only record the tiles written since the previous snapshot
+    s = tiledsurface.Surface()
+    events = loadtxt('painting30sec.dat')
+    sshots = [s.save_snapshot()]
+    for i in range(3):
+        s.begin_atomic()
+        for t, x, y, pressure in events[i::3]:
+            s.draw_dab(x + i*100, y, 12, 0.3, 0.6, 0.9, pressure, 0.6)
+        s.end_atomic()
+        sshots.append(s.save_snapshot())
+    assert s.save_snapshot() is sshots[-1] # nothing painted since
+
+    def changed_tiles(a, b):
+        return set([pos for pos in set(a.tiledict) | set(b.tiledict)
+                    if a.tiledict.get(pos) is not b.tiledict.get(pos)])
+    for a in sshots:
+        for b in sshots:
+            changes = tiledsurface.get_snapshot_changes(a, b)
+            assert changes is not None
+            assert changes >= changed_tiles(a, b)
+
+    # undo and redo, in any order
+    for i in [0, 3, 1, 2, 0, 2]:
+        s.load_snapshot(sshots[i])
+        assert s.tiledict == sshots[i].tiledict
+        for tile in s.tiledict.itervalues():
+            assert tile.readonly
+
+def tileCompression():
+    # cold tiles get compressed (or swapped out) and come back unchanged
+    s = tiledsurface.Surface()
+    events = loadtxt('painting30sec.dat')
+    s.begin_atomic()
+    for t, x, y, pressure in events:
+        s.draw_dab(x, y, 12, 0.3, 0.6, 0.9, pressure, 0.6)
+    s.end_atomic()
+    expected = dict([(pos, tile.rgba.copy()) for pos, tile in s.tiledict.iteritems()])
+
+    memory = tiledsurface.tile_memory
+    for swap_dir in [None, '.']:
+        compressions = tiledsurface.get_tile_memory_stats()['compressions']
+        tiledsurface.set_tile_memory_budget(1)
+        tiledsurface.set_tile_swap_dir(swap_dir)
+        try:
+            for tile in s.tiledict.itervalues():
+                tile.rgba # start tracking
+            # brushlib may hold tile pointers during an atomic section
+            s.begin_atomic()
+            memory.compress_cold_tiles()
+            assert tiledsurface.get_tile_memory_stats()['compressions'] == compressions
+            s.end_atomic()
+            memory.compress_cold_tiles()
+            stats = tiledsurface.get_tile_memory_stats()
+            if swap_dir:
+                assert stats['swapped_tiles'] >= len(expected) - 1
+            else:
+                assert stats['compressed_tiles'] >= len(expected) - 1
+            misses = stats['misses']
+            for pos, rgba in expected.iteritems():
+                assert (s.tiledict[pos].rgba == rgba).all()
+            stats = tiledsurface.get_tile_memory_stats()
+            assert stats['misses'] - misses >= len(expected) - 1
+        finally:
+            tiledsurface.set_tile_memory_budget(0)
+            tiledsurface.set_tile_swap_dir(None)
+
+def uniformTiles():
+    # uniformly colored tiles are shared until modified
+    N = mypaintlib.TILE_SIZE
+    color = (1<<14, 1<<13, 1<<12, 1<<15)
+    arr = zeros((2*N, 2*N, 4), 'uint16')
+    arr[:,:] = color
+    arr[N:, N:] = (100, 200, 300, 1<<14) # not opaque
+    s = tiledsurface.Surface()
+    s.load_from_numpy(arr, 0, 0)
+    assert s.tiledict[0, 0] is s.tiledict[1, 0] is s.tiledict[0, 1]
+    assert s.tiledict[0, 0] is tiledsurface.get_uniform_tile(color)
+    assert s.tiledict[0, 0] is not s.tiledict[1, 1]
+
+    # fast paths give the same results as the generic code
+    for tx, ty in [(0, 0), (1, 1)]:
+        dst = zeros((N, N, 4), 'uint16')
+        dst[:,:] = (500, 600, 700, 1<<15)
+        expected = dst.copy()
+        s.composite_tile(dst, True, tx, ty)
+        mypaintlib.tile_composite(mypaintlib.BlendingModeNormal, arr[ty*N:(ty+1)*N, tx*N:(tx+1)*N].copy(), expected, True, 1.0)
+        assert (dst == expected).all()
+        for i in range(2):
+            dst = zeros((N, N, 4), 'uint8')
+            expected = dst.copy()
+            s.blit_tile_into(dst, True, tx, ty)
+            mypaintlib.tile_convert_rgba16_to_rgba8(arr[ty*N:(ty+1)*N, tx*N:(tx+1)*N].copy(), expected)
+            assert (dst == expected).all()
+
+    # copy on write
+    with s.tile_request(0, 0, readonly=False) as rgba:
+        rgba[:] = 0
+    assert s.tiledict[0, 0] is not s.tiledict[1, 0]
+    assert (s.tiledict[1, 0].rgba == color).all()
+
+def backgroundCache():
+    # backgrounds with the same pattern share their tiles, at all levels
+    N = mypaintlib.TILE_SIZE
+    pattern = random.randint(0, 256, (2*N, N, 3)).astype('uint8')
+    a = tiledsurface.Background(pattern)
+    b = tiledsurface.Background(pattern.copy())
+    c = tiledsurface.Background(255 - pattern)
+    levels = 0
+    while a is not None:
+        assert a.looped_size == b.looped_size == (N, 2*N)
+        assert a.tiledict == b.tiledict
+        assert a.tiledict is not b.tiledict
+        assert a.tiledict[0, 1] is not c.tiledict[0, 1]
+        a, b, c = a.mipmap, b.mipmap, c.mipmap
+        levels += 1
+    assert levels == tiledsurface.MAX_MIPMAP_LEVEL + 2
+
+    a = tiledsurface.Background(pattern)
+    expected = zeros((N, N, 4), 'uint16')
+    mypaintlib.tile_downscale_rgba16(a.tiledict[0, 0].rgba, expected, 0, 0)
+    assert (a.mipmap.tiledict[0, 0].rgba[:N/2,:N/2] == expected[:N/2,:N/2]).all()
+
+def mipmapUpdate():
+    # batched mipmap regeneration gives the same result as downscaling
+    # each tile on its own
+    N = mypaintlib.TILE_SIZE
+    s = tiledsurface.Surface()
+    events = loadtxt('painting30sec.dat')
+    s.begin_atomic()
+    for t, x, y, pressure in events:
+        s.draw_dab(x, y, 12, 0.3, 0.6, 0.9, pressure, 0.6)
+    s.end_atomic()
+
+    level = s
+    while level.mipmap:
+        mipmap = level.mipmap
+        positions = set([(tx/2, ty/2) for tx, ty in level.tiledict])
+        for tx, ty in positions:
+            expected = zeros((N, N, 4), 'uint16')
+            for x in range(2):
+                for y in range(2):
+                    with level.tile_request(tx*2 + x, ty*2 + y, readonly=True) as src:
+                        mypaintlib.tile_downscale_rgba16(src, expected, x*N/2, y*N/2)
+            with mipmap.tile_request(tx, ty, readonly=True) as rgba:
+                assert (rgba == expected).all()
+        assert not mipmap._mipmap_dirty
+        level = mipmap
+
+    # a tile request only regenerates what it needs
+    s.begin_atomic()
+    s.draw_dab(10, 10, 5, 0, 0, 0, 1.0, 1.0)
+    s.draw_dab(5*N+10, 10, 5, 0, 0, 0, 1.0, 1.0)
+    s.end_atomic()
+    with s.mipmap.tile_request(0, 0, readonly=True) as rgba:
+        pass
+    assert s.mipmap._mipmap_dirty == set([(2, 0)])
+    s.update_mipmap_tiles([(2, 0)], 1)
+    assert not s.mipmap._mipmap_dirty
+
+def layerMove():
+    # moving the layer gives the same pixels as shifting the array
+    N = mypaintlib.TILE_SIZE
+    arr = zeros((3*N, 3*N, 4), 'uint16')
+    arr[:,:,3] = arange(3*N).reshape(3*N, 1) * 100
+    arr[:,:,0] = arange(3*N) * 100
+    arr[arr[:,:,0] > arr[:,:,3], 0] = 0
+    arr[2*N:, :] = 0 # empty row
+
+    def get_pixels(s, size):
+        res = zeros((size, size, 4), 'uint16')
+        for (tx, ty), tile in s.tiledict.iteritems():
+            assert 0 <= tx < size/N and 0 <= ty < size/N
+            res[ty*N:(ty+1)*N, tx*N:(tx+1)*N] = tile.rgba
+        return res
+
+    for dx, dy in [(N, 2*N), (10, 3), (N+1, 7)]:
+        s = tiledsurface.Surface()
+        s.load_from_numpy(arr, 0, 0)
+        move = s.get_move(0, 0)
+        move.update(dx, dy)
+        while move.process(n=2):
+            assert 0.0 < move.progress < 1.0
+        assert move.progress == 1.0
+        move.cleanup()
+        expected = zeros((5*N, 5*N, 4), 'uint16')
+        expected[dy:dy+3*N, dx:dx+3*N] = arr
+        assert (get_pixels(s, 5*N) == expected).all()
+        # no empty tiles are left behind
+        for tile in s.tiledict.itervalues():
+            assert tile.rgba.any()
+
+def layerTransform():
+    N = mypaintlib.TILE_SIZE
+    arr = zeros((2*N, 2*N, 4), 'uint16')
+    arr[:,:,3] = arange(2*N).reshape(2*N, 1) * 200
+    arr[:,:,1] = arr[:,:,3] / 2
+
+    def get_pixels(s, size):
+        res = zeros((size, size, 4), 'uint16')
+        for (tx, ty), tile in s.tiledict.iteritems():
+            assert 0 <= tx < size/N and 0 <= ty < size/N
+            res[ty*N:(ty+1)*N, tx*N:(tx+1)*N] = tile.rgba
+        return res
+
+    filters = [mypaintlib.TransformFilterNearest,
+               mypaintlib.TransformFilterBilinear,
+               mypaintlib.TransformFilterLanczos3]
+    for f in filters:
+        # whole pixel translations are exact with any filter
+        s = tiledsurface.Surface()
+        s.load_from_numpy(arr, 0, 0)
+        transform = s.get_transform()
+        transform.update((1, 0, 0, 1, 5, N+3), f)
+        while transform.process(n=2):
+            assert 0.0 < transform.progress < 1.0
+        transform.cleanup()
+        expected = zeros((4*N, 4*N, 4), 'uint16')
+        expected[N+3:3*N+3, 5:2*N+5] = arr
+        assert (get_pixels(s, 4*N) == expected).all()
+
+    # nearest neighbour upscaling duplicates pixels
+    s = tiledsurface.Surface()
+    s.load_from_numpy(arr, 0, 0)
+    transform = s.get_transform()
+    transform.update((2, 0, 0, 2, 0, 0), filters[0])
+    transform.process(n=-1)
+    transform.cleanup()
+    assert (get_pixels(s, 4*N) == arr.repeat(2, axis=0).repeat(2, axis=1)).all()
+
+    # upscaling renders the reach of the filter past the box, too
+    s = tiledsurface.Surface()
+    s.load_from_numpy(arr, 0, 0)
+    transform = s.get_transform()
+    transform.update((3, 0, 0, 3, 0, 0), filters[2])
+    assert (-1, -1) in transform.chunks and (6, 6) in transform.chunks
+    transform.process(n=-1)
+    transform.cleanup()
+
+    # anisotropic Lanczos scaling widens the kernel along one axis only;
+    # the tiles match a reference rendered from one buffer (no seams).
+    # The inverse matrix is exact in binary, so the results are too.
+    pattern = arr.copy()
+    pattern[:,:,3] = (arange(2*N).reshape(1, 2*N) * 7 + arange(2*N).reshape(2*N, 1) * 3) % (1<<15)
+    pattern[:,:,1] = pattern[:,:,3] / 3
+    s = tiledsurface.Surface()
+    s.load_from_numpy(pattern, 0, 0)
+    transform = s.get_transform()
+    matrix = (0.125, 0, 0, 8, 20, 4) # xx, yx, xy, yy, x0, y0
+    transform.update(matrix, filters[2])
+    transform.process(n=-1)
+    transform.cleanup()
+    M = 64 # more than the reach of the kernel
+    buf = zeros((2*N+2*M, 2*N+2*M, 4), 'uint16')
+    buf[M:M+2*N, M:M+2*N] = pattern
+    ixx, iyx, ixy, iyy, ix0, iy0 = 8, 0, 0, 0.125, -160, -0.5
+    for tx in range(-1, 2):
+        for ty in range(-1, 3*N/8):
+            expected = zeros((N, N, 4), 'uint16')
+            c0 = ixx*tx*N + ixy*ty*N + ix0 + M
+            c1 = iyx*tx*N + iyy*ty*N + iy0 + M
+            mypaintlib.tile_affine_transform_rgba16(filters[2], buf, expected,
+                                                    ixx, iyx, ixy, iyy, c0, c1)
+            tile = s.tiledict.get((tx, ty))
+            if tile is None:
+                assert not expected.any()
+            else:
+                assert (tile.rgba == expected).all()
+    assert s.tiledict and max(ty for tx, ty in s.tiledict) < 3*N/8
+
+    # a fast preview can be replaced by the real thing
+    s = tiledsurface.Surface()
+    s.load_from_numpy(arr, 0, 0)
+    transform = s.get_transform()
+    transform.update((0.25, 0.1, -0.1, 0.25, 3, 2), preview=True)
+    transform.process(n=-1)
+    transform.update((1, 0, 0, 1, 0, 0), filters[1])
+    transform.process(n=-1)
+    transform.cleanup()
+    assert (get_pixels(s, 2*N) == arr).all()
+
+    # results stay valid premultiplied data
+    for f in filters:
+        s = tiledsurface.Surface()
+        s.load_from_numpy(arr, 0, 0)
+        transform = s.get_transform()
+        transform.update((0.7, 0.7, -0.7, 0.7, 100, 10), f)
+        transform.process(n=-1)
+        transform.cleanup()
+        for tile in s.tiledict.itervalues():
+            assert (tile.rgba[:,:,3] <= 1<<15).all()
+            assert (tile.rgba[:,:,:3] <= tile.rgba[:,:,3:]).all()
+
+def layerStackComposite():
+    # compositing all layers of many tiles in C gives the same pixels
+    # as compositing them one layer at a time
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    doc.add_layer(after=doc.layer)
+    doc.add_layer(after=doc.layer)
+    modes = ['svg:src-over', 'svg:multiply', 'svg:screen']
+    for i, l in enumerate(doc.layers.get_flat_list()):
+        arr = zeros((2*N, 3*N, 4), 'uint16')
+        arr[:,:,3] = random.randint(0, (1<<15)+1, (2*N, 3*N))
+        arr[:,:,i] = arr[:,:,3] / (i+1)
+        arr[N:, i*N:(i+1)*N] = 0 # some transparent tiles
+        l._surface.load_from_numpy(arr, 0, 0)
+        l.compositeop = modes[i]
+        l.opacity = 1.0 - i*0.3
+    layers = doc.layers.get_flat_list()
+    layers[0].visible = False
+
+    tiles = [(tx, ty) for tx in range(-1, 5) for ty in range(-1, 3)]
+    for dtype in ['uint16', 'uint8']:
+        dst_tiles = [(tx, ty, zeros((N, N, 4), dtype)) for tx, ty in tiles]
+        doc.blit_tiles_into(dst_tiles, False)
+        for tx, ty, dst in dst_tiles:
+            expected = zeros((N, N, 4), dtype)
+            doc._blit_tile_into_slow(expected, False, tx, ty, 0, doc.layers, doc.background)
+            assert (dst == expected).all()
+
+def layerCompositeCache():
+    # rendering with the cached layers below the current layer matches
+    # a full render exactly, also after the cached layers change
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    for i in range(4):
+        doc.add_layer(after=doc.layer)
+    layers = doc.layers.get_flat_list()
+    for i, l in enumerate(layers):
+        arr = zeros((2*N, 2*N, 4), 'uint16')
+        arr[:,:,3] = random.randint(0, (1<<15)+1, (2*N, 2*N))
+        arr[:,:,i%3] = arr[:,:,3] / 2
+        l._surface.load_from_numpy(arr, 0, 0)
+    doc.select_layer(layers[2])
+    tiles = [(tx, ty) for tx in range(-1, 3) for ty in range(-1, 3)]
+
+    def check(render_layers=None):
+        s = tiledsurface.Surface()
+        doc.render_into(s, tiles, layers=render_layers)
+        for tx, ty in tiles:
+            expected = zeros((N, N, 4), 'uint16')
+            doc.blit_tile_into(expected, False, tx, ty, layers=render_layers)
+            with s.tile_request(tx, ty, readonly=True) as rendered:
+                assert (rendered == expected).all()
+
+    check()
+    layers[2]._surface.clear() # current layer, not cached
+    check()
+    layers[0]._surface.clear() # below
+    layers[4]._surface.clear() # above
+    check()
+    layers[3].compositeop = 'svg:multiply'
+    check()
+    layers[1].opacity = 0.5
+    check()
+
+    # different layer lists are cached side by side
+    cache = doc._composite_cache
+    check(layers[1:])
+    check()
+    keys = cache._stacks.keys()[-2:]
+    assert len(keys) == 2 and set([key[0] for key in cache._tiles]).issuperset(keys)
+
+def isolatedGroups():
+    # a group is composited on its own, then blended with its mode and
+    # opacity; the cached result follows changes of the children
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    doc.add_layer(after=doc.layer)
+    bottom, top = doc.layers.get_flat_list()
+    doc.add_group(top)
+    group = top.parent
+    assert group is not doc.layers
+    group.compositeop = 'svg:screen'
+    group.opacity = 0.5
+    top.compositeop = 'svg:multiply'
+    for l in [bottom, top]:
+        arr = zeros((N, N, 4), 'uint16')
+        arr[:,:,3] = random.randint(0, (1<<15)+1, (N, N))
+        arr[:,:,1] = arr[:,:,3] / 3
+        l._surface.load_from_numpy(arr, 0, 0)
+
+    def expected_tile(with_group=True):
+        res = zeros((N, N, 4), 'uint16')
+        doc.background.blit_tile_into(res, False, 0, 0)
+        bottom.composite_tile(res, False, 0, 0)
+        if with_group:
+            isolated = zeros((N, N, 4), 'uint16')
+            top.composite_tile(isolated, True, 0, 0)
+            mypaintlib.tile_composite(mypaintlib.BlendingModeScreen, isolated, res, False, 0.5)
+        return res
+
+    dst = zeros((N, N, 4), 'uint16')
+    doc.blit_tile_into(dst, False, 0, 0)
+    assert (dst == expected_tile()).all()
+
+    group.visible = False
+    doc.blit_tile_into(dst, False, 0, 0)
+    assert (dst == expected_tile(with_group=False)).all()
+    group.visible = True
+
+    top._surface.clear()
+    doc.blit_tile_into(dst, False, 0, 0)
+    assert (dst == expected_tile(with_group=False)).all()
+
+    # the cache of the group is bounded
+    limit = document.layer.GROUP_CACHE_TILES
+    for tx in range(limit + 10):
+        group.get_tile_rgba(tx, 0)
+    assert len(group._tile_cache) == limit
+
+def tileIndex():
+    # the document knows which layers have data at which tiles
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    doc.add_layer(after=doc.layer)
+    bottom, top = doc.layers.get_flat_list()
+    arr = zeros((N, N, 4), 'uint8')
+    arr[:,:,3] = 255
+    bottom._surface.load_from_numpy(arr, 0, 0)
+    top._surface.load_from_numpy(arr, 3*N, N)
+    assert doc.get_layers_at(10, 10) == [bottom]
+    assert doc.get_layers_at(3*N+5, N+5) == [top]
+    assert doc.get_layers_at(3*N-2, N+5, radius=5) == [top]
+    assert doc.get_layers_at(2*N, 2*N) == []
+    assert tuple(doc.get_bbox()) == (0, 0, 4*N, 2*N)
+
+    index = doc.tile_index
+    layers = [bottom, top]
+    assert index.filter_layers(layers, 0, 0) == [bottom]
+    assert index.filter_layers(layers, 5, 5) == []
+    assert index.filter_layers(layers, 0, 0, mipmap_level=2) == layers
+
+    # painting and clearing update the index
+    s = top._surface
+    s.begin_atomic()
+    s.draw_dab(N/2, N/2, 5, 0, 0, 0, 1.0, 1.0)
+    s.end_atomic()
+    assert doc.get_layers_at(N/2, N/2) == layers
+    bottom._surface.clear()
+    assert index.filter_layers(layers, 0, 0) == [top]
+    assert tuple(doc.get_bbox()) == (0, 0, 4*N, 2*N)
+    top._surface.clear()
+    assert doc.get_layers_at(3*N+5, N+5) == []
+
+def strokePicking():
+    # picking finds the topmost stroke touching a pixel
+    N = mypaintlib.TILE_SIZE
+    doc = document.Document()
+    l = doc.layer
+    class Stroke:
+        brush_settings = ''
+    def paint(x, y, r):
+        before = l.save_snapshot()
+        s = l._surface
+        s.begin_atomic()
+        s.draw_dab(x, y, r, 0, 0, 0, 1.0, 1.0)
+        s.end_atomic()
+        l.add_stroke(Stroke(), before)
+        return l.strokes[-1]
+    a = paint(N/2, N/2, 10)
+    b = paint(N/2+5, N/2, 10)
+    c = paint(3*N+5, N+5, 3)
+    assert l.get_stroke_info_at(N/2+5, N/2) is b
+    assert l.get_stroke_info_at(N/2-8, N/2) is a
+    assert l.get_stroke_info_at(3*N+5, N+5) is c
+    assert l.get_stroke_info_at(2*N, 2*N) is None
+    # the index follows new strokes, translations and snapshots
+    snapshot = l.save_snapshot()
+    d = paint(N/2-8, N/2, 3)
+    assert l.get_stroke_info_at(N/2-8, N/2) is d
+    l.translate(N, 0)
+    assert l.get_stroke_info_at(N/2+5, N/2) is None
+    assert l.get_stroke_info_at(N+N/2+5, N/2) is b
+    assert l.get_stroke_info_at(4*N+5, N+5) is c
+    l.load_snapshot(snapshot)
+    assert l.get_stroke_info_at(N+N/2-8, N/2) is a
+    # uncompressed masks are cached, up to a limit
+    from lib import strokemap
+    index = l._stroke_index
+    assert 0 < len(index._bits) <= strokemap.MASK_CACHE_SIZE
+    cache_size, strokemap.MASK_CACHE_SIZE = strokemap.MASK_CACHE_SIZE, 1
+    try:
+        small_index = strokemap.StrokeIndex()
+        for i in range(2):
+            assert small_index.get_stroke_at(l.strokes, N+N/2+5, N/2) is b
+            assert small_index.get_stroke_at(l.strokes, N+N/2-8, N/2) is a
+            assert small_index.get_stroke_at(l.strokes, 4*N+5, N+5) is c
+            assert len(small_index._bits) == 1
+    finally:
+        strokemap.MASK_CACHE_SIZE = cache_size
+    # translations empty it
+    assert l.get_stroke_info_at(N+N/2-8, N/2) is a
+    assert len(index._bits) == 2
+    l.translate(N, 0)
+    assert l.get_stroke_info_at(2*N+N/2+5, N/2) is b
+    assert len(index._bits) == 1
+    l.clear()
+    assert l.get_stroke_info_at(N/2, N/2) is None
+
+def strokeMasks():
+    # strokes are stored as 1-bit masks, and version 2 strokemaps load
+    import zlib, struct
+    from lib import strokemap
+    N = mypaintlib.TILE_SIZE
+    bitmap = zeros((N, N), 'uint8')
+    bitmap[3:20, 5:N] = 1
+    bitmap[N-1, N-1] = 1
+    v2 = struct.pack('>iiI', 1, 2, 0) # an empty tile
+    data = zlib.compress(bitmap.tostring())
+    v2 += struct.pack('>iiI', 1, 1, len(data)) + data
+    shape = strokemap.StrokeShape()
+    shape.init_from_string(v2, N, 0, version=2)
+    assert shape.strokemap.keys() == [(2, 1)]
+    # sparse masks are kept compressed
+    assert len(shape.strokemap[2, 1]) < strokemap.MASK_BYTES
+    assert len(strokemap.get_mask_bits(shape.strokemap[2, 1])) == strokemap.MASK_BYTES
+    for x, y in [(5, 3), (N-1, 19), (N-1, N-1), (4, 3), (5, 20), (0, 0)]:
+        assert shape.touches_pixel(2*N+x, N+y) == bitmap[y, x]
+    assert shape.touches_pixel(0, 0) is None
+    # lookups inflate compressed masks only up to the pixel
+    data = shape.strokemap[2, 1]
+    bits = strokemap.get_mask_bits(data)
+    for y in range(N):
+        for x in range(N):
+            bit = strokemap.get_mask_bit(data, x, y)
+            assert bit == strokemap.get_mask_bit(bits, x, y) == bitmap[y, x]
+
+    v3 = shape.save_to_string(-N, 0)
+    shape2 = strokemap.StrokeShape()
+    shape2.init_from_string(v3, N, 0)
+    assert shape2.strokemap == shape.strokemap
+
+    # translations by whole tiles keep the masks, others split them
+    for dx, dy in [(-N, 0), (-N-3, 7), (-2*N+1, -N+5)]:
+        shape = strokemap.StrokeShape()
+        shape.init_from_string(v3, N, 0)
+        shape.translate(dx, dy)
+        shape.finish()
+        res = zeros((4*N, 4*N), 'uint8')
+        for (tx, ty), data in shape.strokemap.iteritems():
+            assert 0 <= tx < 4 and 0 <= ty < 4
+            res[ty*N:(ty+1)*N, tx*N:(tx+1)*N] = strokemap.unpack_bitmap(data)
+        expected = zeros((4*N, 4*N), 'uint8')
+        expected[N+dy:2*N+dy, 2*N+dx:3*N+dx] = bitmap
+        assert (res == expected).all()
+
+    # masks which do not compress are stored as they are
+    noise = (random.random((N, N)) < 0.5).astype('uint8')
+    data = strokemap.pack_bitmap(noise)
+    assert len(data) == strokemap.MASK_BYTES
+    assert (strokemap.unpack_bitmap(data) == noise).all()
+
+    # a layer's strokes are saved and parsed in one piece
+    from cStringIO import StringIO
+    l = document.Document().layer
+    for i in range(3):
+        shape = strokemap.StrokeShape()
+        shape.init_from_string(v3, i*N, 0)
+        shape.brush_string = 'brush %d' % (i % 2)
+        l.strokes.append(shape)
+    f = StringIO()
+    l.save_strokemap_to_file(f, -N, 0)
+    l2 = document.Document().layer
+    l2.load_strokemap_from_string(f.getvalue(), N, 0)
+    assert [s.brush_string for s in l2.strokes] == ['brush 0', 'brush 1', 'brush 0']
+    assert [s.strokemap for s in l2.strokes] == [s.strokemap for s in l.strokes]
+
+    # lazily loaded strokemaps are parsed on first use
+    l3 = document.Document().layer
+    l3.load_strokemap_from_string(f.getvalue(), N, 0, lazy=True)
+    assert 'strokes' not in l3.__dict__
+    f3 = StringIO()
+    l3.save_strokemap_to_file(f3, -N, 0)
+    assert f3.getvalue() == f.getvalue()
+    assert 'strokes' not in l3.__dict__
+    assert l3.get_stroke_info_at(2*N+5, N+3) is l3.strokes[1]
+    assert [s.strokemap for s in l3.strokes] == [s.strokemap for s in l.strokes]
+
 def brushPaint():
 
     s = tiledsurface.Surface()
@@ -237,6 +919,12 @@ def docPaint():
 
     # test save/load
     doc.save('test_f1.ora')
+    # the zip entries are written in a fixed order, whatever order
+    # the layer PNGs finished encoding in
+    import zipfile
+    names = zipfile.ZipFile('test_f1.ora').namelist()
+    assert names[0] == 'mimetype' and names[-1] == 'stack.xml'
+    assert names[-2] == 'Thumbnails/thumbnail.png'
     doc2 = document.Document()
     doc2.load('test_f1.ora')
 
@@ -271,6 +959,151 @@ def docPaint():
     assert pngs_equal('test_docPaint_flat.png', 'correct_docPaint_flat.png')
     assert pngs_equal('test_docPaint_alpha.png', 'correct_docPaint_alpha.png')
 
+def oraIncrementalSave():
+    # layers unchanged since the last save are copied from the old file
+    doc = document.Document()
+    doc.add_layer(1)
+    events = loadtxt('painting30sec.dat')[:300]
+    def paint(l, dx):
+        s = l._surface
+        s.begin_atomic()
+        for t, x, y, pressure in events:
+            s.draw_dab(x+dx, y, 12, 0.5, 0.3, 0.2, pressure, 0.6)
+        s.end_atomic()
+    paint(doc.layers[0], 0)
+    paint(doc.layers[1], 300)
+
+    encoded = []
+    def count_encodes(l):
+        save_as_png = l._surface.save_as_png
+        def f(*args, **kwargs):
+            encoded.append(l)
+            save_as_png(*args, **kwargs)
+        l._surface.save_as_png = f
+    for l in doc.layers:
+        count_encodes(l)
+
+    doc.save('test_incremental.ora')
+    assert len(encoded) == 2
+    del encoded[:]
+    paint(doc.layers[1], 350)
+    doc.save('test_incremental.ora')
+    assert encoded == [doc.layers[1]]
+
+    doc2 = document.Document()
+    doc2.load('test_incremental.ora')
+    assert len(doc2.layers) == 2
+    assert not doc2.layers[0].is_empty() and not doc2.layers[1].is_empty()
+
+def oraLazyLoad():
+    # lazily loaded layers are only decoded on the first tile access
+    doc = document.Document()
+    doc.add_layer(1)
+    events = loadtxt('painting30sec.dat')[:300]
+    for l, dx in zip(doc.layers, [0, 300]):
+        s = l._surface
+        s.begin_atomic()
+        for t, x, y, pressure in events:
+            s.draw_dab(x+dx, y, 12, 0.5, 0.3, 0.2, pressure, 0.6)
+        s.end_atomic()
+    doc.save('test_lazy.ora')
+
+    eager = document.Document()
+    eager.load('test_lazy.ora')
+    lazy = document.Document()
+    lazy.load('test_lazy.ora', lazy=True)
+    assert len(lazy.layers) == len(eager.layers) == 2
+    assert eager.get_bbox() in lazy.get_bbox()
+    for l1, l2 in zip(eager.layers, lazy.layers):
+        assert not tiledsurface.has_tiledict(l2._surface)
+        assert not l2.is_empty()
+        assert l1.get_bbox() in l2.get_bbox()
+        # first access decodes the png
+        assert set(l1._surface.tiledict) == set(l2._surface.tiledict)
+        assert tiledsurface.has_tiledict(l2._surface)
+        for pos, tile in l1._surface.tiledict.iteritems():
+            assert (tile.rgba == l2._surface.tiledict[pos].rgba).all()
+    assert lazy.get_bbox() == eager.get_bbox()
+
+    # broken data is rejected when loading, not on the first tile access
+    s = lazy.layers[0]._surface
+    try:
+        s.load_from_png_data('GIF89a' + '\0'*100, 0, 0, lazy=True)
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'not a PNG file'
+    assert tiledsurface.has_tiledict(s) and not s.is_empty()
+
+def dopeyFile():
+    # native format: lossless, tiles stay compressed until used
+    doc = document.Document()
+    doc.add_layer(1)
+    doc.add_layer(2)
+    events = loadtxt('painting30sec.dat')[:300]
+    for l, dx in zip(doc.layers, [0, 300, 600]):
+        s = l._surface
+        s.begin_atomic()
+        for t, x, y, pressure in events:
+            s.draw_dab(x+dx, y, 12, 0.5, 0.3, 0.2, pressure, 0.6)
+        s.end_atomic()
+    doc.layers[1]._surface.load_from_surface(doc.layers[0]._surface)
+    doc.layers[1].opacity = 0.5
+    doc.layers[2].visible = False
+    doc.layers[2].compositeop = 'svg:multiply'
+    doc.set_background((255, 200, 100))
+    doc.set_frame(x=10, y=20, width=300, height=200)
+    doc.save('test_native.dopey')
+
+    for lazy in [False, True]:
+        doc2 = document.Document()
+        doc2.load('test_native.dopey', lazy=lazy)
+        assert len(doc2.layers) == 3
+        assert tuple(doc2.get_frame()) == tuple(doc.get_frame())
+        for l1, l2 in zip(doc.layers, doc2.layers):
+            assert (l1.opacity, l1.visible, l1.compositeop) == (l2.opacity, l2.visible, l2.compositeop)
+            assert set(l1._surface.tiledict) == set(l2._surface.tiledict)
+            for pos, tile in l1._surface.tiledict.iteritems():
+                t = l2._surface.tiledict[pos]
+                assert t.readonly
+                assert (tile.rgba == t.rgba).all()
+        # tiles shared between layers are stored and loaded once
+        tiles0, tiles1 = doc2.layers[0]._surface.tiledict, doc2.layers[1]._surface.tiledict
+        for pos in tiles0:
+            assert tiles0[pos] is tiles1[pos]
+        with doc2.background.tile_request(0, 0, readonly=True) as rgba:
+            with doc.background.tile_request(0, 0, readonly=True) as expected:
+                assert (rgba == expected).all()
+
+    # converts to and from OpenRaster
+    doc2.save('test_native.ora')
+    doc3 = document.Document()
+    doc3.load('test_native.ora')
+    doc3.save('test_native2.dopey')
+    doc4 = document.Document()
+    doc4.load('test_native2.dopey')
+    for l3, l4 in zip(doc3.layers, doc4.layers):
+        assert set(l3._surface.tiledict) == set(l4._surface.tiledict)
+        for pos, tile in l3._surface.tiledict.iteritems():
+            assert (tile.rgba == l4._surface.tiledict[pos].rgba).all()
+
+    # mapped tile data is not counted as compressed memory, and is
+    # copied out of the file before the file gets replaced
+    tm = tiledsurface.tile_memory
+    before = tm.compressed_bytes
+    doc5 = document.Document()
+    doc5.load('test_native2.dopey', lazy=True)
+    tiles = [t for l in doc5.layers for t in l._surface.tiledict.itervalues()
+             if type(t._compressed) is buffer]
+    assert tiles and tm.compressed_bytes <= before
+    before = tm.compressed_bytes
+    doc5.save('test_native2.dopey')
+    assert not [t for t in tiles if type(t._compressed) is buffer]
+    assert tm.compressed_bytes > before
+    for l4, l5 in zip(doc4.layers, doc5.layers):
+        for pos, tile in l4._surface.tiledict.iteritems():
+            assert (tile.rgba == l5._surface.tiledict[pos].rgba).all()
+
 def saveFrame():
     print 'test-saving various frame sizes...'
     cnt=0
@@ -303,7 +1136,27 @@ options, tests = parser.parse_args()
 
 #tileConversions()
 #layerModes()
+simdKernels()
+tileConversionBatch()
 directPaint()
+pngCompressionLevels()
+tileCache()
+snapshotJournal()
+tileCompression()
+uniformTiles()
+backgroundCache()
+mipmapUpdate()
+layerMove()
+layerTransform()
+layerStackComposite()
+layerCompositeCache()
+isolatedGroups()
+tileIndex()
+strokePicking()
+strokeMasks()
+oraIncrementalSave()
+oraLazyLoad()
+dopeyFile()
 brushPaint()
 
 # FIXME: make these tests pass with MyPaint+GEGL
@@ -157,6 +157,63 @@ def save_ora_again():
     d.save('test_save.ora')
     yield stop_measurement
 
+@nogui_test
+def load_dopey():
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    d.save('test_save.dopey')
+    d = document.Document()
+    yield start_measurement
+    d.load('test_save.dopey')
+    yield stop_measurement
+
+@nogui_test
+def save_dopey():
+    from lib import document
+    d = document.Document()
+    d.load('bigimage.ora')
+    yield start_measurement
+    d.save('test_save.dopey')
+    yield stop_measurement
+
+def big_strokemap_layer(strokes=20000):
+    # a long painting session: many strokes of a few tiles each
+    from lib import layer, strokemap
+    N = strokemap.N
+    mask = ''.join([chr(i % 256) for i in range(N*N/8)])
+    l = layer.Layer()
+    for i in range(strokes):
+        shape = strokemap.StrokeShape()
+        tx, ty = i % 50, i / 50 % 50
+        for dx in range(3):
+            for dy in range(2):
+                shape.strokemap[tx+dx, ty+dy] = mask
+        shape.brush_string = 'brush %d' % (i % 20)
+        l.strokes.append(shape)
+    return l
+
+@nogui_test
+def save_strokemap():
+    from cStringIO import StringIO
+    l = big_strokemap_layer()
+    f = StringIO()
+    yield start_measurement
+    l.save_strokemap_to_file(f, 0, 0)
+    yield stop_measurement
+
+@nogui_test
+def load_strokemap():
+    from cStringIO import StringIO
+    from lib import layer
+    f = StringIO()
+    big_strokemap_layer().save_strokemap_to_file(f, 0, 0)
+    data = f.getvalue()
+    l = layer.Layer()
+    yield start_measurement
+    l.load_strokemap_from_string(data, 0, 0)
+    yield stop_measurement
+
 @nogui_test
 def save_png():
     from lib import document
@@ -175,6 +232,27 @@ def save_png_layer():
     d.layer.save_as_png('test_save.png')
     yield stop_measurement
 
+@nogui_test
+def blendmodes():
+    # C-level benchmark of the tile compositing kernels
+    from lib import mypaintlib, tiledsurface
+    seconds_per_mpixel = 0.0
+    for svg_id, mode in sorted(tiledsurface.svg2mypaintlibmode.items()):
+        for dst_has_alpha in [False, True]:
+            speeds = []
+            for variant in ['generic', 'sse2', 'avx2']:
+                if mypaintlib.set_simd_variant(variant) == variant:
+                    speed = mypaintlib.tile_composite_benchmark(mode, dst_has_alpha, 1000)
+                    speeds.append('%s %7.1f' % (variant, speed))
+            variant = mypaintlib.set_simd_enabled(True)
+            speed = mypaintlib.tile_composite_benchmark(mode, dst_has_alpha, 1000)
+            print '%-16s alpha=%d  %s Mpixels/s, using %s' % (
+                svg_id, dst_has_alpha, '  '.join(speeds), variant)
+            seconds_per_mpixel += 1.0 / speed
+    print 'result =', seconds_per_mpixel
+    if False:
+        yield None # just to make this function iterator
+
 
 @nogui_test
 def brushengine_paint_hires():